@@ -0,0 +1,309 @@
+"""
+    Lightweight metrics - counters, gauges and histograms exposed in Prometheus text format
+        cheap enough to leave on: one lock and a few additions per observation
+        per-request trace logging is switched on by set_trace(True), each line carries the request's correlation id
+    Author: awtestergit
+"""
+
+import time
+import uuid
+import bisect
+import logging
+import contextvars
+from threading import Lock
+from contextlib import contextmanager
+
+# correlation id of the current request, copied into asyncio.to_thread workers with the context
+correlation_id = contextvars.ContextVar('correlation_id', default='')
+
+# seconds, from sub-millisecond frame encoding to minutes of document parsing
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120.)
+RATE_BUCKETS = (1., 5., 10., 20., 30., 50., 75., 100., 150., 200., 500.) # tokens per second
+
+def __format_labels__(names:tuple, values:tuple, extra:str='')->str:
+    labels = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}' if len(labels) > 0 else ''
+
+def __format_value__(value:float)->str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class anb_metric():
+    TYPE = ''
+    def __init__(self, name:str, help:str, labels:tuple=()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.__lock__ = Lock()
+
+    def render(self)->list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        lines.extend(self.__samples__())
+        return lines
+
+    def __samples__(self)->list[str]:
+        raise NotImplementedError("anb_metric base class samples")
+
+class anb_counter(anb_metric):
+    TYPE = 'counter'
+    def __init__(self, name:str, help:str, labels:tuple=()) -> None:
+        super().__init__(name, help, labels)
+        self.values = {} # {label values: count}
+
+    def inc(self, *label_values, value=1):
+        with self.__lock__:
+            self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def __samples__(self)->list[str]:
+        with self.__lock__:
+            values = list(self.values.items())
+        return [f"{self.name}{__format_labels__(self.labels, key)} {__format_value__(value)}" for key, value in values]
+
+class anb_gauge(anb_metric):
+    TYPE = 'gauge'
+    def __init__(self, name:str, help:str, labels:tuple=(), callback=None) -> None:
+        """
+        callback: if set, the value is read from callback() at render, for values kept elsewhere such as session memory
+        """
+        super().__init__(name, help, labels)
+        self.values = {} # {label values: value}
+        self.callback = callback
+
+    def inc(self, *label_values, value=1):
+        with self.__lock__:
+            self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def dec(self, *label_values, value=1):
+        self.inc(*label_values, value=-value)
+
+    def set(self, *label_values, value=0):
+        with self.__lock__:
+            self.values[label_values] = value
+
+    def __samples__(self)->list[str]:
+        if self.callback is not None:
+            try:
+                return [f"{self.name} {__format_value__(self.callback())}"]
+            except:
+                return []
+        with self.__lock__:
+            values = list(self.values.items())
+        return [f"{self.name}{__format_labels__(self.labels, key)} {__format_value__(value)}" for key, value in values]
+
+class anb_histogram(anb_metric):
+    TYPE = 'histogram'
+    def __init__(self, name:str, help:str, labels:tuple=(), buckets:tuple=DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {} # {label values: [bucket counts..., sum, count]}
+
+    def observe(self, *label_values, value=0.):
+        idx = bisect.bisect_left(self.buckets, value) # first bucket with le >= value
+        with self.__lock__:
+            values = self.values.get(label_values, None)
+            if values is None:
+                values = [0] * (len(self.buckets) + 2)
+                self.values[label_values] = values
+            if idx < len(self.buckets): # above the last bucket only counts in +Inf
+                values[idx] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def __samples__(self)->list[str]:
+        with self.__lock__:
+            values = [(key, list(value)) for key, value in self.values.items()]
+        lines = []
+        for key, value in values:
+            cumulative = 0
+            for bucket, count in zip(self.buckets, value[:-2]):
+                cumulative += count
+                le = 'le="' + __format_value__(bucket) + '"'
+                lines.append(f"{self.name}_bucket{__format_labels__(self.labels, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{__format_labels__(self.labels, key, le)} {value[-1]}")
+            lines.append(f"{self.name}_sum{__format_labels__(self.labels, key)} {__format_value__(value[-2])}")
+            lines.append(f"{self.name}_count{__format_labels__(self.labels, key)} {value[-1]}")
+        return lines
+
+class anb_metrics_registry():
+    """
+    the metrics of this process, rendered in the order registered
+    """
+    def __init__(self) -> None:
+        self.metrics = {} # {name: anb_metric}
+        self.trace = False # per-request trace logging
+
+    def register(self, metric:anb_metric)->anb_metric:
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name:str, help:str, labels:tuple=())->anb_counter:
+        return self.register(anb_counter(name, help, labels))
+
+    def gauge(self, name:str, help:str, labels:tuple=(), callback=None)->anb_gauge:
+        return self.register(anb_gauge(name, help, labels, callback=callback))
+
+    def histogram(self, name:str, help:str, labels:tuple=(), buckets:tuple=DEFAULT_BUCKETS)->anb_histogram:
+        return self.register(anb_histogram(name, help, labels, buckets=buckets))
+
+    def render(self)->str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = anb_metrics_registry()
+
+STAGE_SECONDS = registry.histogram('ubox_stage_seconds', 'time spent in a processing stage', labels=('stage',))
+REQUEST_SECONDS = registry.histogram('ubox_request_seconds', 'request latency until the last byte is sent', labels=('endpoint',))
+REQUESTS_TOTAL = registry.counter('ubox_requests_total', 'requests handled', labels=('endpoint', 'status'))
+IN_FLIGHT = registry.gauge('ubox_requests_in_flight', 'requests being handled', labels=('endpoint',))
+TTFT_SECONDS = registry.histogram('ubox_time_to_first_token_seconds', 'time from request to the first generated token', labels=('endpoint',))
+TOKENS_PER_SECOND = registry.histogram('ubox_tokens_per_second', 'generated deltas per second after the first token', labels=('endpoint',), buckets=RATE_BUCKETS)
+
+def set_trace(enabled:bool):
+    registry.trace = enabled
+
+def new_correlation_id(cid:str=None)->str:
+    cid = cid if cid else uuid.uuid4().hex
+    correlation_id.set(cid)
+    return cid
+
+def trace(message:str):
+    """
+    log message with the correlation id if trace is on
+    """
+    if registry.trace:
+        logging.info(f"[{correlation_id.get()}] {message}")
+
+def observe_stage(stage:str, seconds:float):
+    STAGE_SECONDS.observe(stage, value=seconds)
+    if registry.trace:
+        logging.info(f"[{correlation_id.get()}] stage {stage}: {seconds*1000:.1f} ms")
+
+@contextmanager
+def stage(name:str, exclude:'timed_iterator'=None):
+    """
+    time the block as the stage 'name', also when it raises
+    exclude: a timed_iterator consumed in the block, the time of its items is observed as its own stage, not in 'name'
+    """
+    start = time.perf_counter()
+    excluded = exclude.seconds if exclude is not None else 0.
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if exclude is not None:
+            seconds -= exclude.seconds - excluded
+        observe_stage(name, max(0., seconds))
+
+class timed_iterator():
+    """
+    the items of an iterator, each next() is observed as the stage 'name', e.g., pages of a reader consumed by the chunker
+        seconds: total seconds of the items so far
+    """
+    def __init__(self, name:str, items) -> None:
+        self.name = name
+        self.items = iter(items)
+        self.seconds = 0.
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self.items)
+        finally:
+            seconds = time.perf_counter() - start
+            self.seconds += seconds
+            observe_stage(self.name, seconds)
+
+    def close(self):
+        close = getattr(self.items, 'close', None)
+        if close is not None:
+            close()
+
+class stream_meter():
+    """
+    time to first token and tokens per second of one generated stream
+        start: perf_counter at the request start
+    """
+    def __init__(self, endpoint:str, start:float=None) -> None:
+        self.endpoint = endpoint
+        self.start = start if start is not None else time.perf_counter()
+        self.first = None # perf_counter at the first token
+        self.tokens = 0
+        self.encode_seconds = 0. # frame encoding of this stream
+
+    def token(self, count=1):
+        if self.first is None:
+            self.first = time.perf_counter()
+            ttft = self.first - self.start
+            TTFT_SECONDS.observe(self.endpoint, value=ttft)
+            trace(f"{self.endpoint} first token: {ttft*1000:.1f} ms")
+        self.tokens += count
+
+    def done(self):
+        if self.encode_seconds > 0:
+            observe_stage('frame_encode', self.encode_seconds)
+        if self.first is None or self.tokens < 2:
+            return
+        elapsed = time.perf_counter() - self.first
+        if elapsed > 0:
+            rate = (self.tokens - 1) / elapsed
+            TOKENS_PER_SECOND.observe(self.endpoint, value=rate)
+            trace(f"{self.endpoint} {self.tokens} tokens, {rate:.1f} tokens/s")
+
+class MetricsMiddleware():
+    """
+    ASGI middleware counting in-flight requests and latency of the paths, until the last body byte of streaming responses
+        the correlation id is taken from the 'x-correlation-id' request header or created, and returned in the same header
+    """
+    HEADER = b'x-correlation-id'
+    def __init__(self, app, paths:list[str]) -> None:
+        self.app = app
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope.get('path', '') not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        endpoint = scope['path']
+        cid = ''
+        for key, value in scope.get('headers', []):
+            if key == self.HEADER:
+                cid = value.decode(errors='ignore')
+                break
+        cid = new_correlation_id(cid)
+        start = time.perf_counter()
+        status = [500]
+        done = [False]
+        IN_FLIGHT.inc(endpoint)
+        trace(f"{endpoint} start")
+
+        def finish():
+            if done[0]:
+                return
+            done[0] = True
+            IN_FLIGHT.dec(endpoint)
+            elapsed = time.perf_counter() - start
+            REQUEST_SECONDS.observe(endpoint, value=elapsed)
+            REQUESTS_TOTAL.inc(endpoint, str(status[0]))
+            trace(f"{endpoint} done {status[0]}: {elapsed*1000:.1f} ms")
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                message.setdefault('headers', [])
+                message['headers'] = list(message['headers']) + [(self.HEADER, cid.encode())]
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                finish()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            finish() # client gone or exception
@@ -0,0 +1,77 @@
+"""
+    Token-budgeted prompt assembly
+        the system prompt, the retrieved contexts and the chat history are fitted into a budget of prompt tokens
+        contexts are kept in rank order, the last one that does not fit whole is cut
+        history is kept most recent first, older turns are dropped
+    Author: awtestergit
+"""
+
+MESSAGE_TOKENS = 4 # role and separators of a chat message
+
+def truncate_to_tokens(text:str, max_tokens:int, count_tokens)->str:
+    """
+    the head of text with at most max_tokens
+    """
+    tokens = count_tokens(text)
+    while tokens > max_tokens and len(text) > 0:
+        size = int(len(text) * max_tokens / tokens)
+        size = size if size < len(text) else len(text) - 1 # at least one character shorter
+        text = text[:size]
+        tokens = count_tokens(text)
+    return text
+
+class prompt_assembler():
+    """
+    count_tokens: text->token count, e.g., the llm's count_tokens
+    budget: max tokens of the prompt, all messages, excluding the tokens to generate
+    context_share: share of the budget left after the system prompt and query that contexts may take if there is history,
+        history gets the rest and whatever contexts do not use
+    min_context_tokens: a context cut shorter than this is dropped instead
+    """
+    def __init__(self, count_tokens, budget:int, context_share=0.75, min_context_tokens=64) -> None:
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.context_share = context_share
+        self.min_context_tokens = min_context_tokens
+
+    def fit(self, system_prompt:str, query:str, contexts:list[str]=[], history:list[tuple[str, str]]=[], context_key='context', **format_kwargs)->tuple[str, list[tuple[str, str]], list[str]]:
+        """
+        system_prompt: the template, formatted with format_kwargs and, if contexts, context_key=the kept contexts as a list
+        history: [(query, answer)...], oldest first
+        output: the system prompt, the kept history oldest first, the kept contexts
+        """
+        count = self.count_tokens
+        has_context = len(contexts) > 0
+        empty = system_prompt.format(**{context_key: []}, **format_kwargs) if has_context else system_prompt.format(**format_kwargs)
+        fixed = count(empty) + count(query) + 2 * MESSAGE_TOKENS # system and user messages
+        remaining = self.budget - fixed
+
+        # contexts, by rank
+        kept_contexts = []
+        spent = 0
+        context_budget = int(remaining * self.context_share) if len(history) > 0 else remaining
+        for context in contexts:
+            tokens = count(repr(context)) + 2 # formatted as a list item, with the separator
+            if spent + tokens <= context_budget:
+                kept_contexts.append(context)
+                spent += tokens
+                continue
+            left = context_budget - spent - 4 # quotes and separator
+            if left >= self.min_context_tokens:
+                kept_contexts.append(truncate_to_tokens(context, left, count))
+                spent = context_budget
+            break
+
+        # history, most recent first
+        kept_history = []
+        history_budget = remaining - spent
+        for user, bot in reversed(history):
+            tokens = count(user) + count(bot) + 2 * MESSAGE_TOKENS
+            if tokens > history_budget:
+                break
+            kept_history.append((user, bot))
+            history_budget -= tokens
+        kept_history.reverse()
+
+        prompt = system_prompt.format(**{context_key: kept_contexts}, **format_kwargs) if has_context else empty
+        return prompt, kept_history, kept_contexts
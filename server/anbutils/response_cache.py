@@ -0,0 +1,148 @@
+"""
+    Exact-match cache of LLM responses
+        keyed by the hash of model, messages and options, so only an identical request hits
+        a memory LRU in front of a disk LRU, the disk tier is shared by worker processes and survives restarts
+    Author: awtestergit
+"""
+
+import os
+import json
+import hashlib
+import logging
+from threading import Lock
+from collections import OrderedDict
+
+def cache_key(*parts)->str:
+    """
+    sha256 of the parts serialized as canonical json, non-json values by their repr
+    """
+    data = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=repr)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+class llm_response_cache():
+    """
+    max_entries: responses kept in memory
+    folder: the disk tier folder, None for memory only
+    max_disk_bytes: the disk tier size, least recently used files are removed over it
+    """
+    def __init__(self, max_entries=256, folder:str=None, max_disk_bytes=64*1024*1024) -> None:
+        self.max_entries = max_entries
+        self.folder = folder
+        self.max_disk_bytes = max_disk_bytes
+        self.__memory__ = OrderedDict() # {key: response}
+        self.__lock__ = Lock()
+        self.__disk_bytes__ = None # counted at the first disk write
+        self.hits = 0
+        self.misses = 0
+        if folder is not None and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+    def __path__(self, key:str)->str:
+        return os.path.join(self.folder, f"{key}.json")
+
+    def get(self, key:str):
+        """
+        output: the cached response, or None
+        """
+        with self.__lock__:
+            if key in self.__memory__:
+                self.__memory__.move_to_end(key)
+                self.hits += 1
+                return self.__memory__[key]
+        response = self.__disk_get__(key)
+        with self.__lock__:
+            if response is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.__memory_put__(key, response)
+        return response
+
+    def put(self, key:str, response):
+        with self.__lock__:
+            self.__memory_put__(key, response)
+        self.__disk_put__(key, response)
+
+    def __memory_put__(self, key:str, response):
+        self.__memory__[key] = response
+        self.__memory__.move_to_end(key)
+        while len(self.__memory__) > self.max_entries:
+            self.__memory__.popitem(last=False)
+
+    def __disk_get__(self, key:str):
+        if self.folder is None:
+            return None
+        path = self.__path__(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                response = json.load(f)['response']
+            os.utime(path) # mtime is the last use
+            return response
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def __disk_put__(self, key:str, response):
+        if self.folder is None or self.max_disk_bytes <= 0:
+            return
+        path = self.__path__(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'response': response}, f, ensure_ascii=False)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, path)
+        except (OSError, TypeError, ValueError):
+            logging.warning(f"llm response cache: failed to write {path}.")
+            return
+        with self.__lock__:
+            if self.__disk_bytes__ is None:
+                self.__disk_bytes__ = self.__disk_usage__()
+            else:
+                self.__disk_bytes__ += size
+            if self.__disk_bytes__ > self.max_disk_bytes:
+                self.__disk_bytes__ = self.__evict_disk__()
+
+    def __disk_usage__(self)->int:
+        total = 0
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.json'):
+                try:
+                    total += entry.stat().st_size
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def __evict_disk__(self)->int:
+        # remove least recently used files till the tier is at 90% of max_disk_bytes
+        files = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith('.json'):
+                try:
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+                except FileNotFoundError:
+                    pass
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = int(self.max_disk_bytes * 0.9)
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        return total
+
+    def clear(self):
+        with self.__lock__:
+            self.__memory__.clear()
+            if self.folder is not None:
+                for entry in os.scandir(self.folder):
+                    if entry.name.endswith('.json'):
+                        try:
+                            os.remove(entry.path)
+                        except FileNotFoundError:
+                            pass
+                self.__disk_bytes__ = 0
@@ -0,0 +1,349 @@
+"""
+    Single-flight coalescing of identical in-flight model calls
+        a call with the same key as one in flight waits for it and shares its result
+        a stream with the same key as one in flight is replayed from its buffer, then follows it live
+            each subscriber stops on its own, the backend stream is closed when no subscriber is left
+        async_single_flight and async_stream_flight do the same for coroutines and async streams of one event loop
+    Author: awtestergit
+"""
+
+import asyncio
+import logging
+from threading import Lock, Event, Condition, Thread
+
+class __flight__():
+    def __init__(self) -> None:
+        self.event = Event()
+        self.result = None
+        self.error = None
+
+class single_flight():
+    """
+    identical calls in flight share one execution
+    """
+    def __init__(self) -> None:
+        self.enabled = True
+        self.__flights__ = {} # {key: __flight__}
+        self.__lock__ = Lock()
+
+    def do(self, key:str, fn):
+        """
+        output: fn(), or the result of the identical call in flight
+        """
+        if not self.enabled:
+            return fn()
+        with self.__lock__:
+            flight = self.__flights__.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = __flight__()
+                self.__flights__[key] = flight
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.__lock__:
+                self.__flights__.pop(key, None)
+            flight.event.set()
+
+class shared_stream():
+    """
+    a stream read by a producer thread into a replay buffer, for all its subscribers
+    """
+    WAIT = 0.5 # seconds a subscriber waits for an item before checking its stop
+    def __init__(self, key:str, make_stream, on_done) -> None:
+        self.key = key
+        self.items = [] # replay buffer
+        self.done = False
+        self.stopping = False # all subscribers left, the backend stream is being stopped
+        self.error = None
+        self.subscribers = 0
+        self.__make_stream__ = make_stream
+        self.__on_done__ = on_done
+        self.__cond__ = Condition()
+        self.__producer__ = None
+
+    def join(self)->bool:
+        """
+        output: False if the stream has finished or is stopping, it can not be joined, its items would end early
+        """
+        with self.__cond__:
+            if self.done or self.stopping:
+                return False
+            self.subscribers += 1
+            if self.__producer__ is None:
+                self.__producer__ = Thread(target=self.__produce__, daemon=True)
+                self.__producer__.start()
+            return True
+
+    def leave(self):
+        with self.__cond__:
+            self.subscribers -= 1
+            if self.subscribers <= 0 and not self.done:
+                self.stopping = True # the producer stops at its next item
+
+    def __produce__(self):
+        stream = None
+        try:
+            stream = self.__make_stream__()
+            for item in stream:
+                with self.__cond__:
+                    self.items.append(item)
+                    self.__cond__.notify_all()
+                    if self.subscribers <= 0: # all left, stop the backend
+                        break
+        except Exception as e:
+            self.error = e
+            logging.debug(f"shared stream {self.key[:12]} failed: {e}")
+        finally:
+            if stream is not None and hasattr(stream, 'close'):
+                try:
+                    stream.close()
+                except Exception:
+                    pass
+            with self.__cond__:
+                self.done = True
+                self.__cond__.notify_all()
+            self.__on_done__(self)
+
+    def subscribe(self, check=None):
+        """
+        check: called between items, raises to stop this subscriber, e.g., on its continue flag
+        output: a generator of all items of the stream, from the first
+        """
+        idx = 0
+        try:
+            while True:
+                with self.__cond__:
+                    if idx >= len(self.items) and not self.done:
+                        self.__cond__.wait(self.WAIT)
+                    items = self.items[idx:]
+                    done = self.done # no items are added after done
+                idx += len(items)
+                for item in items:
+                    yield item
+                    if check is not None:
+                        check()
+                if done and idx >= len(self.items):
+                    if self.error is not None:
+                        raise self.error
+                    return
+                if check is not None and len(items) == 0:
+                    check()
+        finally:
+            self.leave()
+
+class stream_flight():
+    """
+    identical streams in flight share one backend stream
+    """
+    def __init__(self) -> None:
+        self.enabled = True
+        self.__streams__ = {} # {key: shared_stream}
+        self.__lock__ = Lock()
+
+    def __done__(self, stream:shared_stream):
+        with self.__lock__:
+            if self.__streams__.get(stream.key, None) is stream:
+                self.__streams__.pop(stream.key, None)
+
+    def subscribe(self, key:str, make_stream, check=None):
+        """
+        make_stream: creates the backend stream, called once by the producer of key
+        check: called between items, raises to stop this subscriber
+        output: a generator of the stream items
+        """
+        if not self.enabled:
+            stream = make_stream()
+            try:
+                for item in stream:
+                    yield item
+                    if check is not None:
+                        check()
+            finally:
+                stream.close()
+            return
+        with self.__lock__:
+            stream = self.__streams__.get(key, None)
+            if stream is None or not stream.join():
+                stream = shared_stream(key, make_stream, self.__done__)
+                stream.join()
+                self.__streams__[key] = stream
+        yield from stream.subscribe(check)
+
+class async_single_flight():
+    """
+    identical coroutine calls in flight share one task, the task runs on if the caller that started it is cancelled
+    """
+    def __init__(self) -> None:
+        self.enabled = True
+        self.__flights__ = {} # {key: asyncio.Task}
+
+    def __done__(self, key:str, task:asyncio.Task):
+        if self.__flights__.get(key, None) is task:
+            self.__flights__.pop(key, None)
+        if not task.cancelled():
+            task.exception() # retrieved, even if no caller is left to await it
+
+    async def do(self, key:str, fn):
+        """
+        fn: a coroutine function
+        output: await fn(), or the result of the identical call in flight
+        """
+        if not self.enabled:
+            return await fn()
+        task = self.__flights__.get(key, None)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.__flights__[key] = task
+            task.add_done_callback(lambda t: self.__done__(key, t))
+        return await asyncio.shield(task)
+
+class async_shared_stream():
+    """
+    an async stream read by a producer task into a replay buffer, for all its subscribers
+    """
+    WAIT = 0.5 # seconds a subscriber waits for an item before checking its stop
+    def __init__(self, key:str, make_stream, on_done) -> None:
+        self.key = key
+        self.items = [] # replay buffer
+        self.done = False
+        self.stopping = False # all subscribers left, the producer is cancelled
+        self.error = None
+        self.subscribers = 0
+        self.__make_stream__ = make_stream
+        self.__on_done__ = on_done
+        self.__changed__ = asyncio.Event() # set and replaced on every item
+        self.__producer__ = None
+
+    def join(self)->bool:
+        """
+        output: False if the stream has finished or is stopping, it can not be joined, its items would end early
+        """
+        if self.done or self.stopping:
+            return False
+        self.subscribers += 1
+        if self.__producer__ is None:
+            self.__producer__ = asyncio.ensure_future(self.__produce__())
+        return True
+
+    def leave(self):
+        self.subscribers -= 1
+        if self.subscribers <= 0 and not self.done: # all left, stop the backend now
+            self.stopping = True
+            self.__producer__.cancel()
+
+    def __notify__(self):
+        self.__changed__.set()
+        self.__changed__ = asyncio.Event()
+
+    async def __produce__(self):
+        stream = None
+        try:
+            stream = self.__make_stream__()
+            async for item in stream:
+                self.items.append(item)
+                self.__notify__()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.error = e
+            logging.debug(f"async shared stream {self.key[:12]} failed: {e}")
+        finally:
+            if stream is not None and hasattr(stream, 'aclose'):
+                try:
+                    await stream.aclose()
+                except Exception:
+                    pass
+            self.done = True
+            self.__notify__()
+            self.__on_done__(self)
+
+    async def subscribe(self, check=None):
+        """
+        check: called between items, raises to stop this subscriber, e.g., on its continue flag
+        output: an async generator of all items of the stream, from the first
+        """
+        idx = 0
+        try:
+            while True:
+                if idx >= len(self.items) and not self.done:
+                    try:
+                        await asyncio.wait_for(self.__changed__.wait(), self.WAIT)
+                    except asyncio.TimeoutError:
+                        pass
+                items = self.items[idx:]
+                done = self.done
+                idx += len(items)
+                for item in items:
+                    yield item
+                    if check is not None:
+                        check()
+                if done and idx >= len(self.items):
+                    if self.error is not None:
+                        raise self.error
+                    return
+                if check is not None and len(items) == 0:
+                    check()
+        finally:
+            self.leave()
+
+class async_stream_flight():
+    """
+    identical async streams in flight share one backend stream
+    """
+    def __init__(self) -> None:
+        self.enabled = True
+        self.__streams__ = {} # {key: async_shared_stream}
+
+    def __done__(self, stream:async_shared_stream):
+        if self.__streams__.get(stream.key, None) is stream:
+            self.__streams__.pop(stream.key, None)
+
+    async def subscribe(self, key:str, make_stream, check=None):
+        """
+        make_stream: creates the backend async stream, called once by the producer of key
+        check: called between items, raises to stop this subscriber
+        output: an async generator of the stream items
+        """
+        if not self.enabled:
+            stream = make_stream()
+            try:
+                async for item in stream:
+                    yield item
+                    if check is not None:
+                        check()
+            finally:
+                await stream.aclose()
+            return
+        stream = self.__streams__.get(key, None)
+        if stream is None or not stream.join():
+            stream = async_shared_stream(key, make_stream, self.__done__)
+            stream.join()
+            self.__streams__[key] = stream
+        items = stream.subscribe(check)
+        try:
+            async for item in items:
+                yield item
+        finally:
+            await items.aclose() # leaves now, not when items is collected
+
+# per process, keys name the model
+calls = single_flight()
+streams = stream_flight()
+acalls = async_single_flight() # of the server's event loop
+astreams = async_stream_flight()
+
+def set_enabled(enabled:bool):
+    calls.enabled = enabled
+    streams.enabled = enabled
+    acalls.enabled = enabled
+    astreams.enabled = enabled
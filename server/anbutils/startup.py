@@ -0,0 +1,107 @@
+"""
+    Concurrent startup of server dependencies
+        each dependency is initialized in its own thread, retried on failure, and installed by its on_ready when it succeeds
+        startup waits for them up to a timeout, those not ready keep initializing in background and are reported by status
+    Author: awtestergit
+"""
+
+import time
+import logging
+from threading import Thread, Event, Lock
+
+class __dependency__():
+    def __init__(self, name:str, init_fn, on_ready, after:list[str]) -> None:
+        self.name = name
+        self.init_fn = init_fn
+        self.on_ready = on_ready
+        self.after = after
+        self.ready = Event()
+        self.result = None
+        self.error = ''
+        self.attempts = 0
+        self.seconds = 0. # to get ready
+
+class dependency_startup():
+    """
+    retry_seconds: wait between the attempts of a failed dependency
+    """
+    def __init__(self, retry_seconds=5) -> None:
+        self.retry_seconds = retry_seconds
+        self.__deps__ = {} # {name: __dependency__}, in the order added
+        self.__lock__ = Lock()
+        self.__stop__ = Event()
+        self.__start__ = 0.
+
+    def add(self, name:str, init_fn, on_ready=None, after:list[str]=None):
+        """
+        init_fn: () -> result, raises if the dependency is not available
+        on_ready: (result) -> None, installs the dependency, called once when init_fn succeeds
+        after: names of the dependencies to be ready before init_fn is called
+        """
+        with self.__lock__:
+            self.__deps__[name] = __dependency__(name, init_fn, on_ready, after if after is not None else [])
+
+    def start(self):
+        self.__start__ = time.perf_counter()
+        for dep in list(self.__deps__.values()):
+            Thread(target=self.__init_proc__, args=(dep,), daemon=True, name=f"startup-{dep.name}").start()
+
+    def __init_proc__(self, dep:__dependency__):
+        for name in dep.after:
+            while not self.__deps__[name].ready.wait(self.retry_seconds):
+                if self.__stop__.is_set():
+                    return
+            if self.__stop__.is_set():
+                return
+        while not self.__stop__.is_set():
+            dep.attempts += 1
+            try:
+                dep.result = dep.init_fn()
+                if dep.on_ready is not None:
+                    dep.on_ready(dep.result)
+                dep.error = ''
+                dep.seconds = time.perf_counter() - self.__start__
+                dep.ready.set()
+                logging.info(f"startup: {dep.name} ready in {dep.seconds:.2f}s.")
+                return
+            except Exception as e:
+                dep.error = f"{type(e).__name__}: {e}"
+                logging.warning(f"startup: {dep.name} attempt {dep.attempts} failed, retry in {self.retry_seconds}s. {dep.error}")
+            self.__stop__.wait(self.retry_seconds)
+
+    def result(self, name:str):
+        return self.__deps__[name].result
+
+    def is_ready(self, name:str=None)->bool:
+        """
+        name: a dependency, None for all
+        """
+        if name is not None:
+            return self.__deps__[name].ready.is_set()
+        return all(dep.ready.is_set() for dep in self.__deps__.values())
+
+    def wait(self, timeout:float)->bool:
+        """
+        output: True if all dependencies are ready within timeout seconds
+        """
+        deadline = time.perf_counter() + timeout
+        for dep in list(self.__deps__.values()):
+            if not dep.ready.wait(max(0., deadline - time.perf_counter())):
+                return False
+        return True
+
+    def status(self)->dict:
+        """
+        output: {name: {'ready': bool, 'seconds': time to get ready, 'attempts': int, 'error': the last error}}
+        """
+        return {
+            dep.name: {
+                'ready': dep.ready.is_set(),
+                'seconds': round(dep.seconds, 3),
+                'attempts': dep.attempts,
+                'error': dep.error,
+            } for dep in self.__deps__.values()
+        }
+
+    def close(self):
+        self.__stop__.set()
@@ -0,0 +1,114 @@
+"""
+    Token-aware text chunker
+        texts (or [text, source]) are consumed lazily, split into sentences, and packed into chunks of at most max_tokens
+        tokens are counted by a cached tiktoken encoding, or estimated if it is not available
+        overlap is kept as whole trailing sentences, so no string is sliced or copied again
+    Author: awtestergit
+"""
+
+import re
+import math
+import logging
+from functools import lru_cache
+from collections import deque
+
+# CJK characters, about one token each
+CJK_PATTERN = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]")
+CHARS_PER_TOKEN = 3.5 # non-CJK characters per token, on the safe side of English (about 4)
+# a sentence ends at . ! ? ; (followed by a space), 。！？； or a newline, the end is kept in the sentence
+SENTENCE_PATTERN = re.compile(r"[^\n]*?(?:[.!?;](?=\s)|[。！？；]|\n|$)\s*")
+
+def estimate_tokens(text:str)->int:
+    """
+    fast estimate of the token count, CJK characters count one each
+    """
+    cjk = len(CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / CHARS_PER_TOKEN)
+
+@lru_cache(maxsize=4)
+def get_token_counter(encoding:str='cl100k_base'):
+    """
+    output: a function text->token count, by the tiktoken encoding if it can be loaded, else estimate_tokens
+    """
+    try:
+        import tiktoken
+        encoder = tiktoken.get_encoding(encoding) # the first call may download the encoding
+        def count_tokens(text:str)->int:
+            return len(encoder.encode(text, disallowed_special=()))
+        return count_tokens
+    except Exception as e:
+        logging.warning(f"text chunker: tiktoken encoding {encoding} not available, token counts are estimated. {e}")
+        return estimate_tokens
+
+def split_sentences(text:str)->list[str]:
+    return [sentence for sentence in SENTENCE_PATTERN.findall(text) if len(sentence) > 0]
+
+def __split_long__(sentence:str, tokens:int, max_tokens:int, count_tokens)->list[tuple[str, int]]:
+    # a sentence over max_tokens is cut by characters, pieces are re-counted and cut again if needed
+    pieces = []
+    size = max(1, int(len(sentence) * max_tokens / tokens))
+    for start in range(0, len(sentence), size):
+        piece = sentence[start:start+size]
+        piece_tokens = count_tokens(piece)
+        if piece_tokens > max_tokens and len(piece) > 1:
+            pieces.extend(__split_long__(piece, piece_tokens, max_tokens, count_tokens))
+        else:
+            pieces.append((piece, piece_tokens))
+    return pieces
+
+def iter_chunks(texts, max_tokens:int, overlap_tokens:int=0, count_tokens=estimate_tokens, doc_path:str='', merge=True):
+    """
+    texts: an iterable of str, or of [text, source] such as the reader stream of read_doc_to_texts_with_source
+    max_tokens: the max tokens of a chunk
+    overlap_tokens: the max tokens of the trailing sentences of a chunk repeated at the start of the next chunk
+    count_tokens: text->token count, e.g., get_token_counter()
+    doc_path: if texts have sources, the chunk source is f"{doc_path}_{first source}_{last source}"
+    merge: if True, texts are packed together up to max_tokens, if False, a chunk never crosses two texts
+    output: a generator of (chunk, source), source is '' if texts have no sources
+    """
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+    window = deque() # [(sentence, tokens, source)]
+    tokens = 0 # tokens in window
+    fresh = False # if window has sentences not emitted yet, not only the overlap
+
+    def emit():
+        nonlocal tokens, fresh
+        text = ''.join(sentence for sentence, _, _ in window).strip()
+        source = f"{doc_path}_{window[0][2]}_{window[-1][2]}" if window[0][2] is not None else ''
+        # keep the trailing sentences as overlap
+        kept, kept_tokens = [], 0
+        for item in reversed(window):
+            if kept_tokens + item[1] > overlap_tokens:
+                break
+            kept.append(item)
+            kept_tokens += item[1]
+        window.clear()
+        window.extend(reversed(kept))
+        tokens = kept_tokens
+        fresh = False
+        return text, source
+
+    for item in texts:
+        text, source = (item, None) if isinstance(item, str) else (item[0], item[1])
+        if text is None or len(text.strip()) == 0:
+            continue
+        for sentence in split_sentences(text):
+            sentence_tokens = count_tokens(sentence)
+            pieces = [(sentence, sentence_tokens)] if sentence_tokens <= max_tokens else __split_long__(sentence, sentence_tokens, max_tokens, count_tokens)
+            for piece, piece_tokens in pieces:
+                if fresh and tokens + piece_tokens > max_tokens:
+                    yield emit()
+                while tokens + piece_tokens > max_tokens and len(window) > 0: # overlap does not fit with this piece
+                    tokens -= window.popleft()[1]
+                window.append((piece, piece_tokens, source))
+                tokens += piece_tokens
+                fresh = True
+        if not text.endswith('\n'): # texts are separated by a new line in a chunk
+            piece, piece_tokens, source = window[-1]
+            window[-1] = (piece + '\n', piece_tokens, source)
+        if not merge and fresh:
+            yield emit()
+            window.clear()
+            tokens = 0
+    if fresh:
+        yield emit()
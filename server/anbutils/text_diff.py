@@ -0,0 +1,437 @@
+"""
+    Text diff engine for document comparison
+        texts are split into tokens, words for latin scripts and single characters for CJK,
+        tokens are matched by histogram diff (falling back to Myers diff), then changed token runs are diffed by characters
+    Author: awtestergit
+"""
+
+import re
+import zlib
+import numpy as np
+from difflib import Differ
+from unicodedata import normalize
+
+# words of non-CJK letters/digits, whitespace runs, or any other single character (CJK, punctuation)
+TOKEN_PATTERN = re.compile(r"[^\W぀-ヿ㐀-䶿一-鿿가-힯豈-﫿]+|[^\S\n]+|.", re.S)
+
+MAX_CHAIN = 64 # tokens occurring more often than this in a region are not used as anchors
+MYERS_MAX_COST = 4_000_000 # max (n+m)*d of Myers fallback, over it the region is a replacement
+CHAR_DIFF_MAX_COST = 1_000_000 # max n*m of characters to diff inside a changed token run
+
+SHINGLE_SIZE = 5 # characters per shingle of block sketches
+MINHASH_SIZE = 64 # hashes per block sketch
+MINHASH_PRIME = (1 << 61) - 1
+__minhash_rng__ = np.random.default_rng(20240601) # fixed, sketches are comparable across calls
+MINHASH_A = __minhash_rng__.integers(1, 1 << 31, size=MINHASH_SIZE, dtype=np.uint64)
+MINHASH_B = __minhash_rng__.integers(0, 1 << 31, size=MINHASH_SIZE, dtype=np.uint64)
+ALIGN_MAX_COST = 250_000 # max n*m blocks of a changed region to pair by similarity
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+IGNORED_CHARS = frozenset([' ',',','，',':','：','(',')','{','}','【','】','.','。',';','；']) # never highlighted
+
+def tokenize(text:str)->list[str]:
+    return TOKEN_PATTERN.findall(text)
+
+def __myers_blocks__(a:list, b:list, alo:int, ahi:int, blo:int, bhi:int, max_cost=MYERS_MAX_COST)->list[tuple[int,int,int]]|None:
+    """
+    Myers O(ND) diff of a[alo:ahi] and b[blo:bhi]
+    output: matching blocks [(i, j, n)...], or None if the edit distance makes it cost more than max_cost
+    """
+    n, m = ahi - alo, bhi - blo
+    if n == 0 or m == 0:
+        return []
+    max_d = n + m
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    found = False
+    for d in range(max_d + 1):
+        if (n + m) * d > max_cost:
+            return None
+        trace.append(v[offset-d-1:offset+d+2]) # only the diagonals of this round are needed to backtrack
+        for k in range(-d, d+1, 2):
+            if k == -d or (k != d and v[offset+k-1] < v[offset+k+1]):
+                x = v[offset+k+1] # down
+            else:
+                x = v[offset+k-1] + 1 # right
+            y = x - k
+            while x < n and y < m and a[alo+x] == b[blo+y]:
+                x += 1
+                y += 1
+            v[offset+k] = x
+            if x >= n and y >= m:
+                found = True
+                break
+        if found:
+            break
+    # backtrack
+    blocks = []
+    x, y = n, m
+    for d in range(len(trace)-1, -1, -1):
+        k = x - y
+        if d == 0: # snake from (0, 0)
+            if x > 0:
+                blocks.append((alo, blo, x))
+            break
+        vd = trace[d] # v before round d, diagonal kk at index kk+d+1
+        is_down = k == -d or (k != d and vd[k-1+d+1] < vd[k+1+d+1])
+        prev_k = k + 1 if is_down else k - 1
+        prev_x = vd[prev_k+d+1]
+        prev_y = prev_x - prev_k
+        mid_x = prev_x if is_down else prev_x + 1 # after the edit, before the snake
+        snake = x - mid_x
+        if snake > 0:
+            blocks.append((alo + mid_x, blo + mid_x - k, snake))
+        x, y = prev_x, prev_y
+    blocks.reverse()
+    return blocks
+
+def matching_blocks(a:list, b:list)->list[tuple[int,int,int]]:
+    """
+    histogram diff of two sequences
+        the least frequent common element of a region anchors the longest match around it, regions on both sides are diffed the same way,
+        regions without such anchors fall back to Myers diff
+    output: matching blocks [(i, j, n)...] in order, as difflib.SequenceMatcher.get_matching_blocks without the sentinel
+    """
+    blocks = []
+    regions = [(0, len(a), 0, len(b))]
+    while len(regions) > 0:
+        alo, ahi, blo, bhi = regions.pop()
+        # common prefix and suffix
+        start = 0
+        while alo + start < ahi and blo + start < bhi and a[alo+start] == b[blo+start]:
+            start += 1
+        if start > 0:
+            blocks.append((alo, blo, start))
+            alo += start
+            blo += start
+        end = 0
+        while ahi - end > alo and bhi - end > blo and a[ahi-end-1] == b[bhi-end-1]:
+            end += 1
+        if end > 0:
+            blocks.append((ahi-end, bhi-end, end))
+            ahi -= end
+            bhi -= end
+        if alo >= ahi or blo >= bhi:
+            continue
+        # histogram of a
+        positions = {}
+        for i in range(alo, ahi):
+            positions.setdefault(a[i], []).append(i)
+        best = None # (count, -length, i, j)
+        j = blo
+        while j < bhi:
+            occurrences = positions.get(b[j], None)
+            if occurrences is None or len(occurrences) > MAX_CHAIN or (best is not None and len(occurrences) > best[0]):
+                j += 1
+                continue
+            next_j = j + 1
+            for i in occurrences:
+                # extend the match both ways
+                s_i, s_j = i, j
+                while s_i > alo and s_j > blo and a[s_i-1] == b[s_j-1]:
+                    s_i -= 1
+                    s_j -= 1
+                e_i, e_j = i + 1, j + 1
+                while e_i < ahi and e_j < bhi and a[e_i] == b[e_j]:
+                    e_i += 1
+                    e_j += 1
+                length = e_i - s_i
+                count = min(len(positions[a[k]]) for k in range(s_i, e_i)) # the least frequent element of the match
+                candidate = (count, -length, s_i, s_j)
+                if best is None or candidate < best:
+                    best = candidate
+                next_j = max(next_j, e_j) if length > 1 else next_j
+            j = next_j
+        if best is not None:
+            _, length, i, j = best
+            length = -length
+            blocks.append((i, j, length))
+            regions.append((alo, i, blo, j))
+            regions.append((i+length, ahi, j+length, bhi))
+            continue
+        # no anchor, e.g. every common element is too frequent
+        myers = __myers_blocks__(a, b, alo, ahi, blo, bhi)
+        if myers:
+            blocks.extend(myers)
+    blocks.sort()
+    # merge adjacent blocks
+    merged = []
+    for block in blocks:
+        if len(merged) > 0 and merged[-1][0] + merged[-1][2] == block[0] and merged[-1][1] + merged[-1][2] == block[1]:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + block[2])
+        else:
+            merged.append(block)
+    return merged
+
+def __opcodes__(a_len:int, b_len:int, blocks:list)->list[tuple[str,int,int,int,int]]:
+    # ('equal'|'replace'|'delete'|'insert', i1, i2, j1, j2)
+    opcodes = []
+    i, j = 0, 0
+    for bi, bj, n in blocks + [(a_len, b_len, 0)]:
+        if i < bi and j < bj:
+            opcodes.append(('replace', i, bi, j, bj))
+        elif i < bi:
+            opcodes.append(('delete', i, bi, j, bj))
+        elif j < bj:
+            opcodes.append(('insert', i, bi, j, bj))
+        if n > 0:
+            opcodes.append(('equal', bi, bi+n, bj, bj+n))
+        i, j = bi + n, bj + n
+    return opcodes
+
+def __char_ops__(a_str:str, b_str:str, ops:list):
+    # character diff inside a changed token run
+    if len(a_str) * len(b_str) > CHAR_DIFF_MAX_COST:
+        ops.append(('-', a_str))
+        ops.append(('+', b_str))
+        return
+    for tag, i1, i2, j1, j2 in __opcodes__(len(a_str), len(b_str), matching_blocks(a_str, b_str)):
+        if tag == 'equal':
+            ops.append((' ', a_str[i1:i2]))
+        else:
+            if i2 > i1:
+                ops.append(('-', a_str[i1:i2]))
+            if j2 > j1:
+                ops.append(('+', b_str[j1:j2]))
+
+def token_diff(a_str:str, b_str:str)->list[tuple[str,str]]:
+    """
+    diff a_str and b_str by tokens, then by characters inside changed token runs
+    output: [(tag, text)...], where tag is ' ' for both, '-' for a only, '+' for b only
+    """
+    a_tokens = tokenize(a_str)
+    b_tokens = tokenize(b_str)
+    ops = []
+    for tag, i1, i2, j1, j2 in __opcodes__(len(a_tokens), len(b_tokens), matching_blocks(a_tokens, b_tokens)):
+        if tag == 'equal':
+            ops.append((' ', ''.join(a_tokens[i1:i2])))
+        elif tag == 'delete':
+            ops.append(('-', ''.join(a_tokens[i1:i2])))
+        elif tag == 'insert':
+            ops.append(('+', ''.join(b_tokens[j1:j2])))
+        else:
+            __char_ops__(''.join(a_tokens[i1:i2]), ''.join(b_tokens[j1:j2]), ops)
+    return ops
+
+def differ_diff(a_str:str, b_str:str)->list[tuple[str,str]]:
+    """
+    the original character diff by difflib.Differ, slow on long texts
+    output: same as token_diff
+    """
+    d = Differ(charjunk=lambda x: x==' ') # char ' ' considered as junk
+    ops = []
+    for r in d.compare(a_str, b_str):
+        tag = r[0]
+        if tag == '?':
+            continue
+        ops.append((tag, r[-1]))
+    return ops
+
+DIFF_ENGINES = {
+    'token': token_diff,
+    'differ': differ_diff,
+}
+
+def render_html(ops:list[tuple[str,str]], a_font:str, b_font:str, font_end:str)->tuple[str, str]:
+    """
+    render diff ops into two htmls, where differences are highlighted by a_font/b_font ... font_end
+        ignored characters are never highlighted, consecutive highlighted characters share one span
+        newline is replaced with <p>
+    output: html of a, html of b
+    """
+    s, ss = [], [] # doc a, doc b
+    a_open, b_open = False, False # if the last item of s/ss is a highlight span end
+    def highlight(side:list, text:str, font:str, is_open:bool)->bool:
+        # add text to side, highlight the not ignored chars, return if side ends with a span
+        start = 0
+        for idx, ch in enumerate(text):
+            if ch in IGNORED_CHARS:
+                if idx > start:
+                    is_open = add_span(side, text[start:idx], font, is_open)
+                side.append(ch)
+                is_open = False
+                start = idx + 1
+        if start < len(text):
+            is_open = add_span(side, text[start:], font, is_open)
+        return is_open
+    def add_span(side:list, text:str, font:str, is_open:bool)->bool:
+        if is_open: # extend the last span
+            side[-1] = text
+            side.append(font_end)
+        else:
+            side.append(font)
+            side.append(text)
+            side.append(font_end)
+        return True
+
+    for tag, text in ops:
+        if len(text) == 0:
+            continue
+        if tag == '-':
+            a_open = highlight(s, text, a_font, a_open)
+        elif tag == '+':
+            b_open = highlight(ss, text, b_font, b_open)
+        else:
+            s.append(text)
+            ss.append(text)
+            a_open, b_open = False, False
+
+    a = ''.join(s)
+    b = ''.join(ss)
+    a = a.replace('\n',"<p>") # replace newline \n with html <p>
+    b = b.replace('\n', "<p>")
+    return a, b
+
+def compare_to_html(a_str:str, b_str:str, a_font:str, b_font:str, font_end:str, engine='token')->tuple[str, str]:
+    """
+    diff a_str and b_str by engine, 'token' or 'differ', and render into htmls
+    """
+    diff = DIFF_ENGINES.get(engine, token_diff)
+    return render_html(diff(a_str, b_str), a_font, b_font, font_end)
+
+class compare_words_table():
+    """
+    look-alike words (different unicode) replaced before comparing, compiled once
+        up to LOOP_MAX_WORDS look-alikes are str.replace-d in file order, each a C scan, skipped if absent
+        more are matched by one regex, longer ones first, then single characters by a character class, a page is scanned once
+    replace_words: [(word, look-alike)...], look-alike is replaced by word
+    """
+    LOOP_MAX_WORDS = 128 # over it, one regex scan is faster than a scan per look-alike
+    def __init__(self, replace_words:list[tuple[str,str]]=[]) -> None:
+        self.replace_words = list(replace_words)
+        words = {}
+        for word, look_alike in replace_words:
+            if len(look_alike) > 0:
+                words.setdefault(look_alike, word) # first entry wins, as replacing in file order
+        self.words = words
+        self.pattern = None
+        if len(words) > self.LOOP_MAX_WORDS:
+            longer = sorted((w for w in words if len(w) > 1), key=len, reverse=True)
+            chars = [w for w in words if len(w) == 1]
+            alternatives = [re.escape(w) for w in longer]
+            if len(chars) > 0:
+                alternatives.append('[' + ''.join(re.escape(c) for c in chars) + ']')
+            self.pattern = re.compile('|'.join(alternatives))
+
+    @classmethod
+    def read(cls, path:str)->'compare_words_table':
+        """
+        read 'word, look-alike' lines, '#' lines are comments
+        """
+        replace_words = []
+        with open(path, 'r') as f:
+            for text in f:
+                if len(text.strip()) == 0 or text[0] == '#':
+                    continue
+                ts = text.split(',')
+                if len(ts) < 2:
+                    continue
+                replace_words.append((ts[0].strip(), ts[1].strip()))
+        return cls(replace_words)
+
+    def apply(self, text:str)->str:
+        # normalize and replace
+        text = normalize('NFKD', text)
+        if self.pattern is not None:
+            return self.pattern.sub(lambda m: self.words[m.group(0)], text)
+        for look_alike, word in self.words.items(): # in file order
+            if look_alike in text:
+                text = text.replace(look_alike, word)
+        return text
+
+def compare_texts(a_str:str, b_str:str, replace_words:compare_words_table, a_font:str, b_font:str, font_end:str, engine='token')->tuple[str, str]:
+    """
+    normalize a_str and b_str, replace look-alike words, then diff and render into htmls
+        a module function, so that it can run in a process pool
+    replace_words: look-alike words table, or None
+    """
+    replace_words = replace_words if replace_words is not None else compare_words_table()
+    string1 = replace_words.apply(a_str)
+    string2 = replace_words.apply(b_str)
+    return compare_to_html(string1, string2, a_font, b_font, font_end, engine=engine)
+
+def normalize_block(text:str)->str:
+    # compare form of a block, whitespace is not a difference
+    return WHITESPACE_PATTERN.sub(' ', normalize('NFKD', text)).strip()
+
+def minhash(text:str)->np.ndarray:
+    """
+    MinHash sketch of the character shingles of text
+    output: uint64 array of MINHASH_SIZE, or None if text is empty
+    """
+    if len(text) == 0:
+        return None
+    size = min(SHINGLE_SIZE, len(text))
+    shingles = np.fromiter({zlib.crc32(text[i:i+size].encode(errors='ignore')) for i in range(len(text) - size + 1)}, dtype=np.uint64)
+    # (a*x + b) mod p, x < 2^32 and a < 2^31 so a*x does not overflow
+    hashes = (MINHASH_A[:, None] * shingles[None, :] + MINHASH_B[:, None]) % np.uint64(MINHASH_PRIME)
+    return hashes.min(axis=1)
+
+def similarity(sketch_a:np.ndarray, sketch_b:np.ndarray)->float:
+    # estimated jaccard similarity
+    if sketch_a is None or sketch_b is None:
+        return 1. if sketch_a is None and sketch_b is None else 0.
+    return float(np.count_nonzero(sketch_a == sketch_b)) / MINHASH_SIZE
+
+def __pair_similar__(a_sketches:list, b_sketches:list, alo:int, ahi:int, blo:int, bhi:int, threshold:float, aligned:list):
+    # pair blocks of a changed region in order, maximizing total similarity of pairs above threshold
+    n, m = ahi - alo, bhi - blo
+    if n * m > ALIGN_MAX_COST: # too large, pair by position
+        for k in range(max(n, m)):
+            aligned.append(('change' if k < n and k < m else ('delete' if k < n else 'insert'), alo + k if k < n else None, blo + k if k < m else None))
+        return
+    sims = [[similarity(a_sketches[alo+i], b_sketches[blo+j]) for j in range(m)] for i in range(n)]
+    score = np.zeros((n+1, m+1))
+    for i in range(n-1, -1, -1):
+        for j in range(m-1, -1, -1):
+            best = max(score[i+1][j], score[i][j+1])
+            if sims[i][j] >= threshold:
+                best = max(best, score[i+1][j+1] + sims[i][j])
+            score[i][j] = best
+    i, j = 0, 0
+    while i < n and j < m:
+        if sims[i][j] >= threshold and score[i][j] == score[i+1][j+1] + sims[i][j]:
+            aligned.append(('change', alo + i, blo + j))
+            i += 1
+            j += 1
+        elif score[i][j] == score[i+1][j]:
+            aligned.append(('delete', alo + i, None))
+            i += 1
+        else:
+            aligned.append(('insert', None, blo + j))
+            j += 1
+    for k in range(i, n):
+        aligned.append(('delete', alo + k, None))
+    for k in range(j, m):
+        aligned.append(('insert', None, blo + k))
+
+def align_blocks(a_blocks:list[str], b_blocks:list[str], threshold=0.3)->list[tuple[str, int, int]]:
+    """
+    align blocks (pages/paragraphs) of two documents, so that an inserted or deleted block does not shift the following pairs
+        blocks equal after normalization are aligned by the longest common subsequence of their hashes,
+        blocks of the changed regions in between are paired by MinHash similarity >= threshold
+    output: [(tag, a index, b index)...] in document order, tag is
+        'equal': same normalized blocks, 'change': similar blocks,
+        'delete': a block only, b index is None, 'insert': b block only, a index is None
+    """
+    a_norm = [normalize_block(block) for block in a_blocks]
+    b_norm = [normalize_block(block) for block in b_blocks]
+    a_hash = [hash(block) for block in a_norm]
+    b_hash = [hash(block) for block in b_norm]
+    a_sketches, b_sketches = {}, {} # sketches of changed blocks only
+    aligned = []
+    for tag, i1, i2, j1, j2 in __opcodes__(len(a_hash), len(b_hash), matching_blocks(a_hash, b_hash)):
+        if tag == 'equal':
+            aligned.extend(('equal', i, j) for i, j in zip(range(i1, i2), range(j1, j2)))
+        elif tag == 'delete':
+            aligned.extend(('delete', i, None) for i in range(i1, i2))
+        elif tag == 'insert':
+            aligned.extend(('insert', None, j) for j in range(j1, j2))
+        else:
+            for i in range(i1, i2):
+                a_sketches[i] = minhash(a_norm[i])
+            for j in range(j1, j2):
+                b_sketches[j] = minhash(b_norm[j])
+            __pair_similar__(a_sketches, b_sketches, i1, i2, j1, j2, threshold, aligned)
+    return aligned
@@ -86,106 +86,6 @@ def break_long_texts_into_chunks(texts:str, chuck_size:int, overlap:int) -> list
     
     return results
 
-def convert_text_list_to_chunks(texts:list, chunk_size:int, overlap:int, merge:False)->list[str]:
-    """
-    process a list of strings, break the list item if it is longer than chunk_size, or merge multiple items into a chuck if merge is true
-    texts: a list of strings
-    chunk_size: the chunk_size that every element of the list must be shorter than
-    overlap: the overlap of the following element to the previous element
-    merge: if true, will merge several elements till all length of the merged texts are about to longer than chunk_size
-    output: the processed list
-    """
-    texts = text_list_strip(texts=texts)
-    outputs = []
-    _string = '' # temp string
-    length = len(texts)
-    for i in range(length):
-        text = texts[i]
-        if merge: # merge elements
-            comb = _string + text + "\n"
-            if len(comb) < chunk_size:
-                _string = comb
-                # check i
-                if i == length-1: #the end
-                    outputs.append(_string)
-                continue
-            else:# comb longer than chunk_size
-                if len(_string) > 0: # if _string is not ''
-                    outputs.append(_string)
-                _string = ''
-        
-        # here, we need to add overlap, merge or no merge
-        if len(outputs) > 0 and overlap > 0:
-            previous = outputs[-1][-overlap:]
-            _string = f"{previous}\n{text}"
-        else:
-            _string = text
-        # if longer than chunk_size, break
-        if len(_string) > chunk_size:
-            chunks = break_long_texts_into_chunks(texts=_string, chuck_size=chunk_size, overlap=overlap)
-            for chunk in chunks:
-                outputs.append(chunk)
-            # pop the last
-            _string = outputs.pop()
-        # now decide what to do
-        # check i
-        if i == length-1: #the end
-            outputs.append(_string)
-        elif not merge:# not merge
-            outputs.append(_string)
-        # continue
-    
-    return outputs
-
-def convert_text_with_source_list_to_chunks(text_source:list[str, str], doc_path:str, chunk_size:int, overlap:int, merge:False)->list[str,str]:
-    """
-    process a list of strings, break the list item if it is longer than chunk_size, or merge multiple items into a chuck if merge is true
-    text_source: a list of [str, str], text and its source
-    doc_path: the document path. combine doc_path+source is the chunk's source_from string
-    chunk_size: the chunk_size that every element of the list must be shorter than
-    overlap: the overlap of the following element to the previous element
-    merge: if true, will merge several elements till all length of the merged texts are about to longer than chunk_size
-    output: the processed list
-    """
-    
-    texts = []
-    #preprocess the list to make sure all texts are less than chunk_size
-    for text, source in text_source:
-        # if not merge, append doc path to source
-        source = source if merge else f"{doc_path}_{source}"
-        if len(text) <= chunk_size:
-            texts.append([text, source])
-        else:#break into chunks
-            _texts = break_long_texts_into_chunks(text, chuck_size=chunk_size, overlap=overlap)
-            for _text in _texts:
-                texts.append([_text, source])
-
-    if merge: # reassamble the short texts to chunk_size 
-        chunks = texts
-        texts = []
-        text = ''
-        source_start = ''
-        for idx, chunk in enumerate(chunks):
-            current_text, current_source = chunk
-            source_start = current_source if source_start == '' else source_start
-            if (len(text+current_text) <= chunk_size):# if less than max
-                text += "\n" + current_text
-                #check if idx is the end of list
-                if idx < len(chunks)-1:
-                    continue
-            #else: #longer than max
-            source = f"{doc_path}_{source_start}_{current_source}"
-            texts.append([text, source])
-            text = current_text #set
-            #check if idx is the end of list
-            if idx == len(chunks)-1: # the end
-                source = f"{doc_path}_{current_source}_{current_source}"
-                texts.append([text, source])
-                break
-            # else, continue
-            source_start = '' #reset
-    return texts
-
 def datetime_to_int(dt:datetime=None):
     """
     2023-11-30 -> 20231130
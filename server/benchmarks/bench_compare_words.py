@@ -0,0 +1,98 @@
+"""
+    Benchmark of the compare words replacement, the compiled compare_words_table against the original per page pair loop
+        the original read compare_words.txt for every page pair, normalized both pages and str.replace-d every entry in file order
+        the outputs of both are checked to be identical
+    run from the server folder:
+        python -m benchmarks.bench_compare_words
+        python -m benchmarks.bench_compare_words --words ./compare_words.txt
+    Author: awtestergit
+"""
+
+import os
+import time
+import random
+import tempfile
+from argparse import ArgumentParser
+from unicodedata import normalize
+from anbutils import text_diff
+
+def legacy_read_compare_words(path:str)->list[tuple[str,str]]:
+    # the original reader, called once per page pair
+    replace_words = []
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            r = f.readlines()
+            for text in r:
+                if text[0] == '#':
+                    continue
+                ts = text.split(',')
+                a = ts[0].strip()
+                b = ts[1].strip()
+                replace_words.append((a,b))
+    return replace_words
+
+def legacy_apply(a_str:str, b_str:str, path:str)->tuple[str, str]:
+    replace_words = legacy_read_compare_words(path)
+    string1 = normalize('NFKD', a_str)
+    string2 = normalize('NFKD', b_str)
+    for rw1, rw2 in replace_words:
+        string1 = string1.replace(rw2, rw1)
+        string2 = string2.replace(rw2, rw1)
+    return string1, string2
+
+def write_words(path:str, extra:int=0):
+    # CJK radical look-alikes of unified characters, and a few multi-character latin look-alikes
+    #   extra: more single character entries, CJK extension A characters, to measure a large table
+    lines = ['# word, look-alike', '民, ⺠', '见, ⻅', '长, ⻓', '门, ⻔', '马, ⻢', '龟, ⻳']
+    lines += [f"{chr(0x4E00 + i * 37)}, {chr(0x2E80 + i)}" for i in range(0x2E9A - 0x2E80)]
+    lines += ['m, rn', 'd, cl', 'w, vv']
+    lines += [f"{chr(0x4E00 + i)}, {chr(0x3400 + i)}" for i in range(extra)]
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def make_pages(pages:int, chars:int, look_alikes:list[str], seed:int)->list[str]:
+    rng = random.Random(seed)
+    common = '甲乙双方应当在合同约定的期限内支付货款交付货物通知违约责任争议解决 contract term notice modern clause '
+    output = []
+    for _ in range(pages):
+        page = [rng.choice(common) if rng.random() > 0.02 else rng.choice(look_alikes) for _ in range(chars)]
+        output.append(''.join(page))
+    return output
+
+def main(words_path:str, pages:int, chars:int, seed:int)->bool:
+    table = text_diff.compare_words_table.read(words_path)
+    look_alikes = [look_alike for _, look_alike in table.replace_words]
+    a_pages = make_pages(pages, chars, look_alikes, seed)
+    b_pages = make_pages(pages, chars, look_alikes, seed + 1)
+
+    start = time.perf_counter()
+    legacy = [legacy_apply(a, b, words_path) for a, b in zip(a_pages, b_pages)]
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    table = text_diff.compare_words_table.read(words_path) # once per handler, reloaded only when the file changes
+    compiled = [(table.apply(a), table.apply(b)) for a, b in zip(a_pages, b_pages)]
+    compiled_seconds = time.perf_counter() - start
+
+    identical = sum(int(x == y) for x, y in zip(legacy, compiled))
+    print(f"{pages} page pairs of {chars} characters, {len(table.replace_words)} compare words")
+    print(f"per pair loop: {legacy_seconds:.3f}s, compiled table: {compiled_seconds:.3f}s, speedup {legacy_seconds / max(compiled_seconds, 1e-9):.1f}x")
+    print(f"identical outputs: {identical}/{pages}")
+    return identical == pages
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--words", dest="words", type=str, default='', help="compare words file, else a generated one.")
+    parser.add_argument("-n", "--pages", dest="pages", type=int, default=500, help="page pairs to compare.")
+    parser.add_argument("-c", "--chars", dest="chars", type=int, default=3000, help="characters per page.")
+    parser.add_argument("-w", "--extra-words", dest="extra", type=int, default=0, help="extra generated compare words, for a large table.")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=20240601, help="seed of the generated pages.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        words_path = args.words
+        if len(words_path) == 0:
+            words_path = os.path.join(folder, 'compare_words.txt')
+            write_words(words_path, args.extra)
+        ok = main(words_path, args.pages, args.chars, args.seed)
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,122 @@
+"""
+    Benchmark of the reader text helpers, the one-pass __clean_text__ and list-joined construct_paragraph against the original ones
+        a document of pages of text containers, as the pdf reader gets them, is cleaned page by page, joined per page,
+        and reconstructed into paragraphs, the outputs of both are checked to be identical
+    run from the server folder:
+        python -m benchmarks.bench_text_clean
+        python -m benchmarks.bench_text_clean -n 1000 -e 60 -m 8
+    Author: awtestergit
+"""
+
+import time
+import random
+from argparse import ArgumentParser
+from interface.interface_readwrite import TextReaderWriter
+
+def legacy_remove_newline_from_text(text:str)->str:
+    texts = text.split('\n')
+    text = ''
+    for t in texts:
+        text += t
+    return text
+
+def legacy_page_texts(page:list[str], remove_mark=[], strip=True)->list[str]:
+    # the original loop of the pdf reader over the text containers of a page
+    output = []
+    for text in page:
+        text = text.strip(' ') if strip else text
+        mark_removed = False
+        if len(remove_mark)>0:
+            for mark in remove_mark:
+                if text.find(mark)>-1:
+                    mark_removed = True
+                    break
+        if mark_removed: # do not include mark string line
+            continue
+        text = legacy_remove_newline_from_text(text)
+        text = text.strip() if strip else text
+        output.append(text)
+    return output
+
+def legacy_construct_paragraph(texts:list)->list:
+    result = []
+    current = ''
+    def is_end_of_paragraph(text):
+        end = ['.', '。', ':', '：']
+        return text[-1] in end
+    for text in texts:
+        text = text.strip()
+        if len(text)>0:
+            is_end = is_end_of_paragraph(text[-1])
+            if not is_end:
+                current += text
+            else:
+                current += text
+                result.append(current)
+                current = ''
+    return result
+
+def make_document(pages:int, elements:int, marks:list[str], seed:int)->list[list[str]]:
+    rng = random.Random(seed)
+    words = ['agreement', 'party', 'shall', 'the', 'of', 'payment', 'term', 'notice', 'days', 'within', '甲方', '乙方', '合同']
+    document = []
+    for _ in range(pages):
+        page = []
+        for _ in range(elements):
+            lines = [' '.join(rng.choice(words) for _ in range(rng.randint(4, 12))) for _ in range(rng.randint(1, 4))]
+            text = ' ' + '\n'.join(lines) + rng.choice(['.', '。', ':', '', '', '']) + ' \n'
+            if rng.random() < 0.05: # headers and footers to remove
+                text = f"{rng.choice(marks)} {text}"
+            page.append(text)
+        document.append(page)
+    return document
+
+def legacy_read(document:list[list[str]], marks:list[str])->tuple[list[str], list[str]]:
+    pages = ['\n'.join(t for t in legacy_page_texts(page, remove_mark=marks)) for page in document]
+    texts = [text for page in document for text in legacy_page_texts(page, remove_mark=marks)]
+    return pages, legacy_construct_paragraph(texts)
+
+def read(reader:TextReaderWriter, document:list[list[str]], marks:list[str])->tuple[list[str], list[str]]:
+    def page_texts(page:list[str])->list[str]:
+        mark_pattern = reader.__mark_pattern__(marks)
+        output = []
+        for text in page:
+            text = reader.__clean_text__(text, mark_pattern)
+            if text is None:
+                continue
+            output.append(text)
+        return output
+    pages = ['\n'.join(page_texts(page)) for page in document]
+    texts = [text for page in document for text in page_texts(page)]
+    return pages, reader.construct_paragraph(texts)
+
+def main(pages:int, elements:int, mark_count:int, seed:int)->bool:
+    marks = [f"CONFIDENTIAL-{i}" for i in range(mark_count)] + ['Page ', '第 '][:max(0, min(2, mark_count))]
+    document = make_document(pages, elements, marks, seed)
+    reader = TextReaderWriter()
+
+    start = time.perf_counter()
+    legacy = legacy_read(document, marks)
+    legacy_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    output = read(reader, document, marks)
+    seconds = time.perf_counter() - start
+
+    characters = sum(len(text) for page in document for text in page)
+    print(f"{pages} pages, {pages * elements} text containers, {characters} characters, {len(marks)} marks")
+    print(f"original helpers: {legacy_seconds:.3f}s, one-pass helpers: {seconds:.3f}s, speedup {legacy_seconds / max(seconds, 1e-9):.1f}x")
+    identical = legacy == output
+    print(f"identical pages and paragraphs: {identical}, {len(output[0])} pages, {len(output[1])} paragraphs")
+    return identical
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-n", "--pages", dest="pages", type=int, default=1000, help="pages of the document.")
+    parser.add_argument("-e", "--elements", dest="elements", type=int, default=40, help="text containers per page.")
+    parser.add_argument("-m", "--marks", dest="marks", type=int, default=4, help="remove marks, e.g., headers and footers.")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=20240601, help="seed of the generated document.")
+    args = parser.parse_args()
+
+    ok = main(args.pages, args.elements, args.marks, args.seed)
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,122 @@
+"""
+    Benchmark of the compare_files diff engines, token diff against the original character Differ
+        each page pair is diffed and rendered by both engines, their outputs are checked and timed
+        equivalence: both htmls of both engines render the original texts once the spans are removed,
+            and the highlighted characters of the two engines are counted, identical htmls are reported
+    run from the server folder:
+        python -m benchmarks.bench_text_diff
+        python -m benchmarks.bench_text_diff --pairs ./pairs # a_<name>.txt and b_<name>.txt files, one page pair each
+    Author: awtestergit
+"""
+
+import os
+import re
+import time
+import random
+from argparse import ArgumentParser
+from anbutils import text_diff
+
+A_FONT = """<span style='background-color:#ffa500'>"""
+B_FONT = """<span style='background-color:#87cefa'>"""
+FONT_END = "</span>"
+SPAN_PATTERN = re.compile(r"<span[^>]*>|</span>")
+
+LATIN_WORDS = ['agreement', 'party', 'shall', 'the', 'of', 'payment', 'term', 'notice', 'days', 'within', 'contract', 'seller', 'buyer', 'goods', 'price', 'delivery']
+CJK_CHARS = '甲乙双方应当在合同约定的期限内支付货款交付货物通知违约责任争议解决'
+
+def make_page(rng:random.Random, chars:int, cjk:bool)->str:
+    parts, size = [], 0
+    while size < chars:
+        if cjk:
+            sentence = ''.join(rng.choice(CJK_CHARS) for _ in range(rng.randint(10, 40))) + '。'
+        else:
+            sentence = ' '.join(rng.choice(LATIN_WORDS) for _ in range(rng.randint(6, 20))).capitalize() + '.'
+        parts.append(sentence)
+        size += len(sentence) + 1
+        if rng.random() < 0.1:
+            parts.append('\n')
+    return ' '.join(parts)
+
+def edit_page(rng:random.Random, page:str, edits:int)->str:
+    # replace, insert and delete short runs, as revisions of a contract
+    page = list(page)
+    for _ in range(edits):
+        pos = rng.randrange(len(page))
+        size = rng.randint(1, 12)
+        op = rng.random()
+        if op < 0.4:
+            page[pos:pos+size] = list(''.join(rng.choice(LATIN_WORDS) for _ in range(1 + size // 6)))
+        elif op < 0.7:
+            page[pos:pos] = list(' ' + rng.choice(LATIN_WORDS))
+        else:
+            del page[pos:pos+size]
+    return ''.join(page)
+
+def make_corpus(pairs:int, chars:int, seed:int)->list[tuple[str, str, str]]:
+    rng = random.Random(seed)
+    corpus = []
+    for idx in range(pairs):
+        cjk = idx % 3 == 2 # a third of the pages are CJK
+        a = make_page(rng, chars, cjk)
+        b = edit_page(rng, a, edits=max(1, chars // 250))
+        corpus.append((f"{'cjk' if cjk else 'latin'}_{idx}", a, b))
+    return corpus
+
+def read_corpus(folder:str)->list[tuple[str, str, str]]:
+    corpus = []
+    for name in sorted(os.listdir(folder)):
+        if not name.startswith('a_') or not name.endswith('.txt'):
+            continue
+        b_path = os.path.join(folder, 'b_' + name[2:])
+        if not os.path.exists(b_path):
+            continue
+        with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+            a = f.read()
+        with open(b_path, 'r', encoding='utf-8') as f:
+            b = f.read()
+        corpus.append((name[2:-4], a, b))
+    return corpus
+
+def highlighted_chars(html:str, font:str)->int:
+    # characters inside highlight spans
+    return sum(len(SPAN_PATTERN.sub('', part.split(FONT_END)[0])) for part in html.split(font)[1:])
+
+def run_engine(engine:str, a:str, b:str)->tuple[float, str, str]:
+    start = time.perf_counter()
+    a_html, b_html = text_diff.compare_to_html(a, b, A_FONT, B_FONT, FONT_END, engine=engine)
+    return time.perf_counter() - start, a_html, b_html
+
+def main(corpus:list[tuple[str, str, str]]):
+    totals = {'token': 0., 'differ': 0.}
+    identical, failures = 0, []
+    print(f"{'pair':<14}{'chars':>8}{'differ s':>11}{'token s':>11}{'speedup':>9}{'differ hl':>11}{'token hl':>10}")
+    for name, a, b in corpus:
+        outputs = {}
+        for engine in ('differ', 'token'):
+            seconds, a_html, b_html = run_engine(engine, a, b)
+            totals[engine] += seconds
+            outputs[engine] = (seconds, a_html, b_html)
+            # both sides render the original texts
+            if SPAN_PATTERN.sub('', a_html) != a.replace('\n', '<p>') or SPAN_PATTERN.sub('', b_html) != b.replace('\n', '<p>'):
+                failures.append((name, engine))
+        d_seconds, d_a, d_b = outputs['differ']
+        t_seconds, t_a, t_b = outputs['token']
+        identical += int(d_a == t_a and d_b == t_b)
+        d_hl = highlighted_chars(d_a, A_FONT) + highlighted_chars(d_b, B_FONT)
+        t_hl = highlighted_chars(t_a, A_FONT) + highlighted_chars(t_b, B_FONT)
+        print(f"{name:<14}{len(a):>8}{d_seconds:>11.3f}{t_seconds:>11.4f}{d_seconds / max(t_seconds, 1e-9):>8.0f}x{d_hl:>11}{t_hl:>10}")
+    print(f"total: differ {totals['differ']:.3f}s, token {totals['token']:.3f}s, speedup {totals['differ'] / max(totals['token'], 1e-9):.0f}x")
+    print(f"identical htmls: {identical}/{len(corpus)}, texts not rendered back: {failures if len(failures) > 0 else 'none'}")
+    return len(failures) == 0
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("--pairs", dest="pairs", type=str, default='', help="folder of a_<name>.txt and b_<name>.txt page pairs, else a generated corpus.")
+    parser.add_argument("-n", "--count", dest="count", type=int, default=6, help="generated page pairs.")
+    parser.add_argument("-c", "--chars", dest="chars", type=int, default=3000, help="characters per generated page.")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=20240601, help="seed of the generated corpus.")
+    args = parser.parse_args()
+
+    corpus = read_corpus(args.pairs) if len(args.pairs) > 0 else make_corpus(args.count, args.chars, args.seed)
+    ok = main(corpus)
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,171 @@
+"""
+    Benchmark of the time-to-first-token of OllamaModel.stream_chat, against a stub ollama that models its prompt cache
+        the stub takes load seconds when the model is unloaded, i.e., idle longer than the keep_alive of the last request,
+        or when num_ctx changes, plus char seconds for every prompt character past the prefix cached from the last request
+        conversations of follow-up questions on a background are asked with the original prompt, the time with seconds first,
+        and with the stable prefix prompt, static instructions first and the date last, each with and without keep_alive
+        conversations are idle apart longer than ollama's default keep_alive, which is scaled down to default-keep-alive seconds
+    run from the server folder:
+        python -m benchmarks.bench_ttft
+        python -m benchmarks.bench_ttft -c 4 -t 6 --load-ms 500
+    Author: awtestergit
+"""
+
+import os
+import time
+import random
+import datetime
+import threading
+from argparse import ArgumentParser
+from models.llm import OllamaModel
+from tests.stub_ollama import stub_ollama
+
+# the doc_know system prompt before and after stable prefixes
+LEGACY_SYSTEM_PROMPT = """You are AI, name is {name}. It is now {current}. You need to answer user's question based on the provided background information.
+
+Background Information:
+[
+{context}
+]
+
+Remember: It is essential to identify key information in the background information that pertains to user's question to provide more accurate responses.
+Remember: Your responses must not contradict the facts presented in the background information.
+Answer in English.
+"""
+SYSTEM_PROMPT = """You are AI, name is {name}. You need to answer user's question based on the provided background information.
+Remember: It is essential to identify key information in the background information that pertains to user's question to provide more accurate responses.
+Remember: Your responses must not contradict the facts presented in the background information.
+Answer in English.
+
+Background Information:
+[
+{context}
+]
+
+Today is {current}.
+"""
+
+class ollama_prompt_cache():
+    """
+    the seconds ollama takes to the first token of a chat request, the delay of the stub
+        load_seconds: to load the model
+        char_seconds: to evaluate one prompt character not in the cached prefix
+        default_keep_alive: seconds the model stays loaded after a request without keep_alive
+    """
+    def __init__(self, load_seconds:float, char_seconds:float, default_keep_alive:float) -> None:
+        self.load_seconds = load_seconds
+        self.char_seconds = char_seconds
+        self.default_keep_alive = default_keep_alive
+        self.loaded_until = 0.
+        self.num_ctx = None
+        self.cached = '' # the prompt of the last request
+        self.loads = 0
+        self.__lock__ = threading.Lock()
+
+    def keep_alive_seconds(self, keep_alive)->float:
+        if keep_alive is None:
+            return self.default_keep_alive
+        if isinstance(keep_alive, str) and keep_alive[-1:] in ('s', 'm', 'h'):
+            return float(keep_alive[:-1]) * {'s': 1, 'm': 60, 'h': 3600}[keep_alive[-1]]
+        seconds = float(keep_alive)
+        return seconds if seconds >= 0 else float('inf')
+
+    def __call__(self, path:str, request:dict)->float:
+        if path != '/api/chat':
+            return 0.
+        prompt = ''.join(f"<{message['role']}>{message['content']}" for message in request.get('messages', []))
+        num_ctx = request.get('options', {}).get('num_ctx', None)
+        with self.__lock__:
+            now = time.monotonic()
+            seconds = 0.
+            if now > self.loaded_until or num_ctx != self.num_ctx: # unloaded, or reloaded for another num_ctx
+                seconds += self.load_seconds
+                self.loads += 1
+                self.num_ctx = num_ctx
+                self.cached = ''
+            cached = len(os.path.commonprefix([self.cached, prompt]))
+            seconds += (len(prompt) - cached) * self.char_seconds
+            self.cached = prompt
+            self.loaded_until = now + seconds + self.keep_alive_seconds(request.get('keep_alive', None))
+        return seconds
+
+def make_context(rng:random.Random, chars:int)->str:
+    words = ['agreement', 'party', 'shall', 'the', 'of', 'payment', 'term', 'notice', 'days', 'within', 'contract', 'seller', 'buyer', 'goods']
+    texts, size = [], 0
+    while size < chars:
+        text = ' '.join(rng.choice(words) for _ in range(rng.randint(6, 20))).capitalize() + '.'
+        texts.append(text)
+        size += len(text) + 1
+    return '\n'.join(texts)
+
+def run(stable:bool, keep_alive, contexts:list[str], turns:int, idle:float, turn_seconds:float, args)->dict:
+    cache = ollama_prompt_cache(args.load_ms / 1000, args.char_us / 1e6, args.default_keep_alive)
+    stub = stub_ollama(delay=cache)
+    try:
+        llm = OllamaModel(host=stub.url, model='m', keep_alive=keep_alive)
+        clock = datetime.datetime(2024, 6, 1, 9, 0, 0) # the time of the turn, as a user waits between turns
+        ttfts = []
+        for idx, context in enumerate(contexts):
+            if idx > 0:
+                time.sleep(idle) # idle between conversations
+            history = []
+            for turn in range(turns):
+                clock += datetime.timedelta(seconds=turn_seconds)
+                if stable:
+                    system_prompt = SYSTEM_PROMPT.format(name='UBOX', context=context, current=clock.strftime('%Y-%m-%d, %A'))
+                else:
+                    system_prompt = LEGACY_SYSTEM_PROMPT.format(name='UBOX', context=context, current=clock.strftime('%Y-%m-%d %H:%M:%S, %A'))
+                query = f"question {turn} of conversation {idx}?"
+                start = time.perf_counter()
+                stream = llm.stream_chat(query, system_prompt=system_prompt, history=history)
+                answer = next(stream)
+                ttfts.append(time.perf_counter() - start)
+                for answer in stream:
+                    pass
+                history.append((query, answer))
+        return {'ttfts': ttfts, 'loads': cache.loads}
+    finally:
+        stub.close()
+
+def main(args)->bool:
+    rng = random.Random(args.seed)
+    contexts = [make_context(rng, args.chars) for _ in range(args.conversations)]
+    scenarios = [
+        ('time first, no keep_alive', False, None),
+        ('time first, keep_alive', False, args.keep_alive),
+        ('stable prefix, no keep_alive', True, None),
+        ('stable prefix, keep_alive', True, args.keep_alive),
+    ]
+    print(f"{args.conversations} conversations of {args.turns} turns, {args.chars} characters of background, "
+          f"load {args.load_ms}ms, {args.char_us}us per uncached character, idle {args.idle}s > default keep_alive {args.default_keep_alive}s")
+    print(f"{'prompt':<32}{'mean ttft':>11}{'first turns':>13}{'follow-ups':>12}{'loads':>7}")
+    results = {}
+    for name, stable, keep_alive in scenarios:
+        result = run(stable, keep_alive, contexts, args.turns, args.idle, args.turn_seconds, args)
+        ttfts = result['ttfts']
+        firsts = ttfts[::args.turns]
+        follow_ups = [ttft for idx, ttft in enumerate(ttfts) if idx % args.turns > 0]
+        mean = sum(ttfts) / len(ttfts)
+        results[name] = mean
+        print(f"{name:<32}{mean * 1000:>9.1f}ms{sum(firsts) / len(firsts) * 1000:>11.1f}ms"
+              f"{sum(follow_ups) / max(1, len(follow_ups)) * 1000:>10.1f}ms{result['loads']:>7}")
+    speedup = results['time first, no keep_alive'] / max(results['stable prefix, keep_alive'], 1e-9)
+    print(f"stable prefix and keep_alive against the original: {speedup:.1f}x lower mean time-to-first-token")
+    return results['stable prefix, keep_alive'] < results['time first, no keep_alive']
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-c", "--conversations", dest="conversations", type=int, default=3, help="conversations, each on its own background.")
+    parser.add_argument("-t", "--turns", dest="turns", type=int, default=5, help="questions per conversation.")
+    parser.add_argument("--chars", dest="chars", type=int, default=6000, help="characters of background per conversation.")
+    parser.add_argument("--load-ms", dest="load_ms", type=float, default=300, help="ms to load the model.")
+    parser.add_argument("--char-us", dest="char_us", type=float, default=20, help="us to evaluate one prompt character.")
+    parser.add_argument("--keep-alive", dest="keep_alive", type=str, default='30m', help="keep_alive of the keep_alive runs.")
+    parser.add_argument("--default-keep-alive", dest="default_keep_alive", type=float, default=0.2, help="seconds, ollama's default keep_alive scaled down.")
+    parser.add_argument("--idle", dest="idle", type=float, default=0.3, help="seconds idle between conversations.")
+    parser.add_argument("--turn-seconds", dest="turn_seconds", type=float, default=40, help="seconds of the prompt clock between turns.")
+    parser.add_argument("-s", "--seed", dest="seed", type=int, default=20240601, help="seed of the generated backgrounds.")
+    args = parser.parse_args()
+
+    ok = main(args)
+    raise SystemExit(0 if ok else 1)
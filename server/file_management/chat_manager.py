@@ -8,57 +8,105 @@ import logging
 import os
 import shutil
 import sqlite3
-from threading import Lock
+import time
+import queue
+import itertools
+import threading
+import traceback
+from threading import Lock, Condition
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
 
 class chat_history_mgr():
     """
+    chat history in sqlite, in WAL mode so reads do not wait for writes
+        writes go through one connection under a lock, sqlite has a single writer anyway
+        reads go through a connection per thread
     """
+    BUSY_TIMEOUT = 5000 # ms to wait for a lock held by another connection, e.g., another worker process
     def __init__(self, db_path:str, db_name:str) -> None:
         """
         db_path: sqlite db path
         """
         self.db_path = db_path
         self.db_name = os.path.join(db_path, db_name) # join to get the full path
-        self.db = None
+        self.db = None # write connection
         self.table_name = 'uid_chat_history'
+        self.index_name = 'uid_chat_history_uuid_time'
         self.uuid_column = 'uuid'
         self.query_column = 'query'
         self.answer_column = 'answer'
         self.time_column = 'timestamp'
         self.sqlite_lock = Lock() # the  event for multi-threading
+        self.__local__ = threading.local() # read connection of each thread
+        self.__readers__ = [] # all read connections, to close
+        self.__readers_lock__ = Lock()
         self.__initialize__()
 
+    def __connect__(self):
+        db = sqlite3.connect(self.db_name, check_same_thread=False, timeout=self.BUSY_TIMEOUT/1000)
+        db.execute(f"PRAGMA busy_timeout={self.BUSY_TIMEOUT}")
+        db.execute("PRAGMA synchronous=NORMAL") # durable enough in WAL mode, a commit does not fsync
+        return db
+
     def __initialize__(self):
         # table structure
         if not os.path.exists(self.db_path): # check db path
             os.makedirs(self.db_path)
-        self.db = self.db if self.db else sqlite3.connect(self.db_name, check_same_thread=False)
+        self.db = self.db if self.db else self.__connect__()
         cur = self.db.cursor()
-        # check table exists
-        select_table = f"SELECT name from sqlite_master WHERE type='table' AND name='{self.table_name}'"
-        cur.execute(select_table)
-        result = cur.fetchone()
-        if not result:
-            create_table = f"CREATE TABLE {self.table_name} ({self.uuid_column}, {self.query_column} text, {self.answer_column} text, {self.time_column} TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
-            cur.execute(create_table)
-            self.db.commit()
+        cur.execute("PRAGMA journal_mode=WAL") # persistent in the db file
+        create_table = f"CREATE TABLE IF NOT EXISTS {self.table_name} ({self.uuid_column}, {self.query_column} text, {self.answer_column} text, {self.time_column} TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        cur.execute(create_table)
+        # history of a uuid is read and trimmed in time order, rowid breaks ties of the same second
+        create_index = f"CREATE INDEX IF NOT EXISTS {self.index_name} ON {self.table_name} ({self.uuid_column}, {self.time_column})"
+        cur.execute(create_index)
+        self.db.commit()
+        # statements
+        self.insert_sql = f"INSERT INTO {self.table_name} ({self.uuid_column}, {self.query_column}, {self.answer_column}) VALUES (?, ?, ?)"
+        self.insert_time_sql = f"INSERT INTO {self.table_name} ({self.uuid_column}, {self.query_column}, {self.answer_column}, {self.time_column}) VALUES (?, ?, ?, ?)"
+        order = f"ORDER BY {self.time_column} DESC, ROWID DESC"
+        self.select_sql = f"SELECT * FROM {self.table_name} WHERE {self.uuid_column}=? {order}"
+        self.select_recent_sql = f"SELECT * FROM {self.table_name} WHERE {self.uuid_column}=? {order} LIMIT ?"
+        self.delete_sql = f"DELETE FROM {self.table_name} WHERE {self.uuid_column}=?"
+        self.delete_keep_sql = f"DELETE FROM {self.table_name} WHERE {self.uuid_column}=? AND ROWID NOT IN (SELECT ROWID FROM {self.table_name} WHERE {self.uuid_column}=? {order} LIMIT ?)"
 
     def get_db(self):
-        self.db = self.db if self.db else sqlite3.connect(self.db_name, check_same_thread=False)
+        self.db = self.db if self.db else self.__connect__()
         return self.db
+
+    def __read_db__(self):
+        # connection of this thread, statements are cached per connection
+        db = getattr(self.__local__, 'db', None)
+        if db is None:
+            db = self.__connect__()
+            self.__local__.db = db
+            with self.__readers_lock__:
+                self.__readers__.append(db)
+        return db
     
     def close_db(self):
+        with self.__readers_lock__:
+            readers, self.__readers__ = self.__readers__, []
+        for db in readers:
+            try:
+                db.close()
+            except sqlite3.Error:
+                pass
+        self.__local__ = threading.local()
         if self.db:
             self.db.close()
+            self.db = None
     
     def purge_all(self, close_db=True):
         # cleanse db
         drop_table = f"DROP TABLE IF EXISTS {self.table_name}"
-        cur = self.db.cursor()
-        cur.execute(drop_table)
-        self.db.commit()
+        with self.sqlite_lock:
+            cur = self.db.cursor()
+            cur.execute(drop_table)
+            self.db.commit()
         if close_db:
-            self.db.close()
+            self.close_db()
 
     def add_chat(self, uuid:str='', query:str='', answer:str=''):
         """
@@ -70,18 +118,24 @@ class chat_history_mgr():
         if not self.db:
             raise ValueError("chat history manager: chat history db is not connected.")
 
-        try:
-            self.sqlite_lock.acquire()
-            cur = self.db.cursor()
-            insert_table = f"""INSERT INTO {self.table_name} ({self.uuid_column}, {self.query_column}, {self.answer_column}) VALUES ('{uuid}', "{query}", "{answer}")"""
+        logging.debug(f"chat history add: {uuid}")
+        with self.sqlite_lock:
+            self.db.execute(self.insert_sql, (uuid, query, answer)) # save to db
+            self.db.commit()
 
-            #print(insert_table)
-            logging.debug(insert_table)
+    def add_chats(self, chats:list[tuple[str, str, str, str]]):
+        """
+        add chats in one transaction
+        chats: [(uuid, query, answer, time)...], time as CURRENT_TIMESTAMP, 'YYYY-MM-DD HH:MM:SS' in UTC
+        """
+        if len(chats) == 0:
+            return
+        if not self.db:
+            raise ValueError("chat history manager: chat history db is not connected.")
 
-            cur.execute(insert_table) # save to db
-            self.db.commit()
-        finally:
-            self.sqlite_lock.release()
+        with self.sqlite_lock:
+            with self.db: # commit, or rollback on exception
+                self.db.executemany(self.insert_time_sql, chats)
 
     def get_chat_history(self, uuid:str, recent=-1)->list:
         """
@@ -91,12 +145,11 @@ class chat_history_mgr():
         output: [(query, answer)...]
         """
         # query table
-        select_table = f"SELECT * FROM {self.table_name} WHERE {self.uuid_column}='{uuid}' ORDER BY {self.time_column} DESC"
+        db = self.__read_db__()
         if recent > 0:
-            select_table = f"SELECT * FROM {self.table_name} WHERE {self.uuid_column}='{uuid}' ORDER BY {self.time_column} DESC LIMIT {recent}"
-        cur = self.db.cursor()
-        cur.execute(select_table)
-        rows = cur.fetchall()
+            rows = db.execute(self.select_recent_sql, (uuid, recent)).fetchall()
+        else:
+            rows = db.execute(self.select_sql, (uuid,)).fetchall()
         # rows is a list [(uid, query, answer, time),...]
         outputs = []
         for row in rows:
@@ -111,27 +164,20 @@ class chat_history_mgr():
         delete chat history, keep 'keep_recent' chat histories, e.g, keep recent 100
         keep_recent: if -1, delete all
         """
-        delete_table = f"DELETE FROM {self.table_name} WHERE {self.uuid_column}='{uuid}'"        
-        if keep_recent > 0:
-            delete_table = f"DELETE FROM {self.table_name} WHERE {self.uuid_column}='{uuid}' AND ROWID NOT IN (SELECT ROWID FROM {self.table_name} WHERE {self.uuid_column}='{uuid}' ORDER BY {self.time_column} DESC LIMIT {keep_recent})"
-
-        #print(delete_table)
-        logging.debug(delete_table)
-
-        try:
-            self.sqlite_lock.acquire()
-            cur = self.db.cursor()
+        logging.debug(f"chat history delete: {uuid}, keep {keep_recent}")
+        with self.sqlite_lock:
             # delete from table
-            cur.execute(delete_table)
+            if keep_recent > 0:
+                self.db.execute(self.delete_keep_sql, (uuid, uuid, keep_recent))
+            else:
+                self.db.execute(self.delete_sql, (uuid,))
             self.db.commit()
-        finally:
-            self.sqlite_lock.release()
 
     def __get_all_from_db__(self):
         """"""
         # query table
         select_table = f"SELECT * FROM {self.table_name}"
-        cur = self.db.cursor()
+        cur = self.__read_db__().cursor()
         cur.execute(select_table)
         rows = cur.fetchall()
         output = ''
@@ -139,3 +185,228 @@ class chat_history_mgr():
             for item in row:
                 output += item
         return output
+
+class chat_history_cache():
+    """
+    recent chat history of each uid held in memory, persisted to chat_history_mgr by a background writer
+        history reads are served from a bounded ring per uid, loaded from the db on the first read
+        appends are queued and written in batches, one transaction every flush_ms
+        a read that needs the db waits only for the pending chats of its uid, and has them written at once
+        chats added while the ring of a uid is loaded from or deleted in the db are held back, and queued after
+    cache_reads: if False, e.g., several worker processes serve the same uid, reads go to the db after pending writes of this process
+    """
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S' # as sqlite CURRENT_TIMESTAMP
+    def __init__(self, chat_mgr:chat_history_mgr, capacity=100, flush_ms=200, batch_size=256, max_uids=10000, cache_reads=True) -> None:
+        self.chat_mgr = chat_mgr
+        self.capacity = capacity # chats kept per uid
+        self.flush_ms = flush_ms
+        self.batch_size = batch_size
+        self.max_uids = max_uids # least recently used uids are dropped over this
+        self.cache_reads = cache_reads and capacity > 0
+        self.__rings__ = OrderedDict() # {uid: deque([(query, answer, time)...])}, oldest first
+        self.__lock__ = Lock()
+        self.__loading__ = {} # {uid: chats added while the ring of uid is loaded from or deleted in the db, queued after}
+        self.__loaded__ = Condition(self.__lock__) # notified when a load or delete ends
+        self.__queue__ = queue.Queue()
+        self.__pending__ = {} # {uid: queued chats not yet written}
+        self.__written__ = Condition() # guards __pending__, notified after each batch
+        self.__writer__ = None
+        self.__writer_lock__ = Lock()
+
+    def __start_writer__(self):
+        with self.__writer_lock__:
+            if self.__writer__ is None or not self.__writer__.is_alive():
+                self.__writer__ = threading.Thread(target=self.__writer_proc__, daemon=True)
+                self.__writer__.start()
+
+    FLUSH = object() # queued by flush, the writer writes its batch at once
+
+    def __writer_proc__(self):
+        stop = False
+        while not stop:
+            item = self.__queue__.get()
+            batch = []
+            count = 1 # items got from the queue, for task_done
+            deadline = time.monotonic() + self.flush_ms / 1000
+            while True:
+                if item is None: # stop, after writing what is batched
+                    stop = True
+                    break
+                if item is self.FLUSH:
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.__queue__.get(timeout=timeout)
+                    count += 1
+                except queue.Empty:
+                    break
+            try:
+                self.chat_mgr.add_chats(batch)
+            except:
+                logging.error(f"chat history cache: failed to write {len(batch)} chats. {traceback.format_exc()}")
+            finally:
+                with self.__written__:
+                    for uuid, *_ in batch:
+                        left = self.__pending__.get(uuid, 0) - 1
+                        if left > 0:
+                            self.__pending__[uuid] = left
+                        else:
+                            self.__pending__.pop(uuid, None)
+                    self.__written__.notify_all()
+                for _ in range(count):
+                    self.__queue__.task_done()
+
+    def add_chat(self, uuid:str='', query:str='', answer:str=''):
+        """
+        add chat to uuid, returns at once, the chat is written by the background writer
+        """
+        if len(uuid)==0 or len(query)==0: # allows answer is empty
+            return
+        with self.__lock__: # the ring, the queue and the time order of the db see chats in the same order
+            chat = (uuid, query, answer, datetime.now(timezone.utc).strftime(self.TIME_FORMAT))
+            loading = self.__loading__.get(uuid, None)
+            if loading is not None: # the db read or delete of uuid must not see it, queued when it ends
+                loading.append(chat)
+                return
+            ring = self.__rings__.get(uuid, None) if self.cache_reads else None
+            if ring is not None: # else, loaded from the db at the next read
+                ring.append(chat[1:])
+            self.__queue_chat__(chat)
+        self.__start_writer__()
+
+    def __queue_chat__(self, chat:tuple):
+        # under __lock__, so that a load of the uid either waits for the chat in flush, or holds it back
+        with self.__written__:
+            self.__pending__[chat[0]] = self.__pending__.get(chat[0], 0) + 1
+        self.__queue__.put(chat)
+
+    def __wait_load__(self, uuid:str):
+        # under __lock__, till a load or delete of uuid by another thread ends
+        while uuid in self.__loading__:
+            self.__loaded__.wait()
+
+    def __begin_load__(self, uuid:str):
+        # under __lock__, chats of uuid added from now on are held back till __end_load__
+        self.__wait_load__(uuid)
+        self.__loading__[uuid] = []
+
+    def __end_load__(self, uuid:str, ring:deque=None):
+        # under __lock__, the held back chats go to the ring, if any, and to the writer
+        for chat in self.__loading__.pop(uuid, []):
+            if ring is not None:
+                ring.append(chat[1:])
+            self.__queue_chat__(chat)
+        self.__loaded__.notify_all()
+
+    def __has_pending__(self, uuid:str=None)->bool:
+        return len(self.__pending__) > 0 if uuid is None else uuid in self.__pending__
+
+    def flush(self, uuid:str=None):
+        """
+        wait till queued chats of uuid are written, all uids if None
+            the writer is woken to write its batch now, not at the end of flush_ms
+        """
+        with self.__written__:
+            if not self.__has_pending__(uuid):
+                return
+        self.__queue__.put(self.FLUSH)
+        with self.__written__:
+            while self.__has_pending__(uuid):
+                if self.__writer__ is None or not self.__writer__.is_alive():
+                    return # closed, nothing left to wait for
+                self.__written__.wait(self.flush_ms / 1000)
+
+    def get_recent_history(self, uuid:str, recent=-1)->list[tuple[str, str]]:
+        """
+        recent chat histories, oldest first
+        recent: if -1, get all
+        output: [(query, answer)...]
+        """
+        if not self.cache_reads or recent <= 0 or recent > self.capacity: # not all in the ring
+            with self.__lock__:
+                self.__wait_load__(uuid)
+            self.flush(uuid)
+            rows = self.chat_mgr.get_chat_history(uuid=uuid, recent=recent)
+            return [(row[0], row[1]) for row in reversed(rows)]
+
+        with self.__lock__:
+            self.__wait_load__(uuid)
+            ring = self.__rings__.get(uuid, None)
+            if ring is not None:
+                self.__rings__.move_to_end(uuid)
+                return [(chat[0], chat[1]) for chat in itertools.islice(ring, max(0, len(ring)-recent), None)]
+            # first read of uuid, chats added from now on are held back, those before must be in the db
+            self.__begin_load__(uuid)
+        ring = None
+        try:
+            self.flush(uuid)
+            rows = self.chat_mgr.get_chat_history(uuid=uuid, recent=self.capacity)
+            ring = deque(reversed(rows), maxlen=self.capacity)
+        finally:
+            with self.__lock__:
+                if ring is not None:
+                    self.__rings__[uuid] = ring
+                    while len(self.__rings__) > self.max_uids:
+                        self.__rings__.popitem(last=False)
+                self.__end_load__(uuid, ring)
+                history = [] if ring is None else [(chat[0], chat[1]) for chat in itertools.islice(ring, max(0, len(ring)-recent), None)]
+            self.__start_writer__()
+        return history
+
+    def get_chat_history(self, uuid:str, recent=-1)->list:
+        """
+        as chat_history_mgr.get_chat_history, newest first
+        output: [(query, answer, time)...]
+        """
+        with self.__lock__:
+            self.__wait_load__(uuid)
+        self.flush(uuid)
+        return self.chat_mgr.get_chat_history(uuid=uuid, recent=recent)
+
+    def delete_chat_history(self, uuid:str, keep_recent=-1):
+        """
+        delete chat history, keep 'keep_recent' chat histories
+        keep_recent: if -1, delete all
+            chats added before are deleted too, chats added meanwhile are kept
+        """
+        with self.__lock__:
+            self.__begin_load__(uuid)
+        deleted = False
+        try:
+            self.flush(uuid) # pending chats of uuid are deleted too
+            self.chat_mgr.delete_chat_history(uuid=uuid, keep_recent=keep_recent)
+            deleted = True
+        finally:
+            with self.__lock__:
+                ring = self.__rings__.get(uuid, None)
+                if deleted and ring is not None:
+                    if keep_recent > 0:
+                        while len(ring) > keep_recent:
+                            ring.popleft()
+                    else:
+                        self.__rings__.pop(uuid, None)
+                        ring = None
+                self.__end_load__(uuid, ring)
+            self.__start_writer__()
+
+    def evict(self, uuid:str):
+        """
+        drop the ring of uuid, e.g., at disconnect, after writing its pending chats
+        """
+        self.flush(uuid)
+        with self.__lock__:
+            self.__rings__.pop(uuid, None)
+
+    def close(self, timeout=None):
+        """
+        write queued chats and stop the writer
+        """
+        if self.__writer__ is not None and self.__writer__.is_alive():
+            self.__queue__.put(None)
+            self.__writer__.join(timeout)
+        self.__writer__ = None
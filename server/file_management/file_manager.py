@@ -21,10 +21,11 @@ class server_file_item():
 class server_file_mgr():
     """
     """
-    def __init__(self, db_path:str, db_name:str, file_path:str) -> None:
+    def __init__(self, db_path:str, db_name:str, file_path:str, purge=True) -> None:
         """
         db_path: sqlite db path
         file_path: local file path to save all files
+        purge: remove all files and entries at start, set False when other worker processes share the files
         """
         self.db_path = db_path
         self.db_name = os.path.join(db_path, db_name) # join to get the full path
@@ -35,9 +36,9 @@ class server_file_mgr():
         self.path_column = 'path'
         self.type_column = 'type'
         self.sqlite_lock = Lock() # the sqlite event for multithreading
-        self.__initialize__()
+        self.__initialize__(purge=purge)
 
-    def __initialize__(self):
+    def __initialize__(self, purge=True):
         # table structure
         # uuid | path | type, where type is 'auto' or 'manual'; if manual, need to delete these files manually
         if not os.path.exists(self.db_path): # check db path
@@ -45,13 +46,14 @@ class server_file_mgr():
         self.db = self.db if self.db else sqlite3.connect(self.db_name, check_same_thread=False)
         cur = self.db.cursor()
         # close all first, leave db open
-        self.close_all(close_db=False)
+        if purge:
+            self.close_all(close_db=False)
         # check table exists
         select_table = f"SELECT name from sqlite_master WHERE type='table' AND name='{self.table_name}'"
         cur.execute(select_table)
         result = cur.fetchone()
         if not result:
-            create_table = f"CREATE TABLE {self.table_name} ({self.uuid_column} text, {self.path_column} text, {self.type_column} text)"
+            create_table = f"CREATE TABLE IF NOT EXISTS {self.table_name} ({self.uuid_column} text, {self.path_column} text, {self.type_column} text)"
             cur.execute(create_table)
             self.db.commit()
 
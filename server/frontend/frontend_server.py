@@ -6,7 +6,12 @@
 """
 import logging
 import os
-from typing import Iterator
+import asyncio
+import multiprocessing
+from collections import deque
+from threading import Lock, Thread
+from concurrent.futures import ProcessPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import Iterator, AsyncIterator
 from interface.interface_readwrite import IDocReaderWriter, TextReaderWriter
 from readwrite.pdf_readwrite import PDFReaderWriter
 from readwrite.word_readwrite import WordReaderWriter
@@ -15,7 +20,8 @@ import datetime
 import traceback
 import math
 import numpy as np
-from anbutils import utilities
+from anbutils import utilities, metrics, text_diff, text_chunker
+from anbutils.prompt_budget import prompt_assembler
 from interface.interface_model import ILanguageModel, IEmbeddingModel, llm_continue, ContinueExit
 from qdrantclient_vdb.qdrant_manager import qcVdbManager
 
@@ -26,6 +32,107 @@ class webui_handlers():
         self.emb_model=emb_model
         self.reranker = reranker_model
         self.vdb_mgr=vdb_mgr
+        self.diff_engine = kwargs.get('diff_engine', 'token') # compare_files diff engine, 'token' or 'differ'
+        self.diff_workers = kwargs.get('diff_workers', 0) # compare_files diffs page pairs in a process pool if more than 1
+        self.align_blocks = kwargs.get('align_blocks', True) # compare_files aligns pages/paragraphs by content before diffing
+        self.align_window = kwargs.get('align_window', 32) # blocks of each document read ahead to align, pairs stream out as they are aligned
+        self.compare_words_file = kwargs.get('compare_words_file', './compare_words.txt') # look-alike words replaced before comparing
+        self.prompt_token_budget = kwargs.get('prompt_token_budget', 0) # max prompt tokens of doc_know, 0 is the llm's limit
+        self.__compare_words__ = text_diff.compare_words_table() # loaded from compare_words_file
+        self.__compare_words_mtime__ = None
+        self.__compare_words_lock__ = Lock()
+        self.__get_compare_words__()
+        self.__diff_pool__ = None # created at first use
+        self.__diff_pool_lock__ = Lock()
+        if self.diff_workers > 1: # start the workers in background, the first compare does not wait for them
+            Thread(target=self.__warm_diff_pool__, daemon=True).start()
+
+    def close(self):
+        with self.__diff_pool_lock__:
+            if self.__diff_pool__ is not None:
+                self.__diff_pool__.shutdown(wait=False, cancel_futures=True)
+                self.__diff_pool__ = None
+
+    async def aclose(self):
+        # the connection pools of the async model clients, in the event loop that used them
+        await self.llm.aclose()
+        await self.emb_model.aclose()
+
+    def __get_diff_pool__(self)->ProcessPoolExecutor:
+        with self.__diff_pool_lock__:
+            if self.__diff_pool__ is None:
+                # forkserver, the server process has threads (uvicorn, faiss) which fork does not copy safely,
+                #   and the main module is imported once by the fork server instead of by every spawned worker
+                self.__diff_pool__ = ProcessPoolExecutor(max_workers=self.diff_workers, mp_context=multiprocessing.get_context('forkserver'))
+            return self.__diff_pool__
+
+    def __warm_diff_pool__(self):
+        try:
+            pool = self.__get_diff_pool__()
+            futures = [pool.submit(text_diff.tokenize, '') for _ in range(self.diff_workers)]
+            for future in futures:
+                future.result()
+        except:
+            logging.warning(f"diff pool warm up failed. {traceback.format_exc()}")
+
+    def __get_compare_words__(self)->text_diff.compare_words_table:
+        # compare words, reloaded if the file is changed
+        # replace look-alike but different words (different unicode)
+        wf = self.compare_words_file
+        try:
+            mtime = os.stat(wf).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self.__compare_words_lock__:
+            if mtime != self.__compare_words_mtime__:
+                if mtime is None:
+                    #print(f"compare word file '{wf}' does not exists.")
+                    logging.debug(f"compare word file '{wf}' does not exists.")
+                    self.__compare_words__ = text_diff.compare_words_table()
+                else:
+                    try:
+                        self.__compare_words__ = text_diff.compare_words_table.read(wf)
+                    except:
+                        logging.error(f"compare word file '{wf}' failed to load. {traceback.format_exc()}")
+                self.__compare_words_mtime__ = mtime
+            return self.__compare_words__
+
+    def __wait_diff__(self, future, continue_flag:llm_continue=None)->tuple[str, str]:
+        # wait for a diff in the pool, checking stop
+        while True:
+            if continue_flag:
+                cf = continue_flag.check_continue_flag()
+                if not cf:
+                    raise ContinueExit()
+            try:
+                return future.result(timeout=0.5)
+            except FutureTimeoutError:
+                continue
+
+    def __parallel_compare__(self, pairs:Iterator, replace_words:text_diff.compare_words_table, a_font:str, b_font:str, font_end:str, continue_flag:llm_continue=None)->Iterator:
+        """
+        diff page pairs in the process pool, at most 2 pairs per worker in flight
+        pairs: (is_diff, a, b), if not is_diff, a and b are htmls already
+        output: a generator of (a, b) htmls, in the order of pairs
+        """
+        pool = self.__get_diff_pool__()
+        window = deque() # futures in page order
+        max_window = self.diff_workers * 2
+        try:
+            for is_diff, a_str, b_str in pairs:
+                if is_diff:
+                    future = pool.submit(text_diff.compare_texts, a_str, b_str, replace_words, a_font, b_font, font_end, self.diff_engine)
+                else: # keep the order
+                    future = Future()
+                    future.set_result((a_str, b_str))
+                window.append(future)
+                while len(window) >= max_window or (len(window) > 0 and window[0].done()):
+                    yield self.__wait_diff__(window.popleft(), continue_flag)
+            while len(window) > 0:
+                yield self.__wait_diff__(window.popleft(), continue_flag)
+        finally:
+            for future in window: # stopped or client gone
+                future.cancel()
 
     def __get_reader_by_filename__(self, filename:str, is_ocr=False)->IDocReaderWriter:
         if len(filename) == 0:
@@ -146,106 +253,83 @@ class webui_handlers():
             #return a_list, b_list, a_end, b_end
             return a_str, b_str, a_end, b_end
 
-        def compare_two(a_str:str, b_str:str, replace_words_file='./compare_words.txt')->tuple[str, str]:
+        replace_words = self.__get_compare_words__() # once per comparison
+        def compare_two(a_str:str, b_str:str)->tuple[str, str]:
             # output: two list containing compared words highlighted difference using <span>...
-
-            # read compare words
-            # replace look-alike but different words (different unicode)
-            wf = replace_words_file
-            replace_words = []
-            if os.path.exists(wf):
-                with open(wf, 'r') as f:
-                    r = f.readlines()
-                    for text in r:
-                        if text[0] == '#':
-                            continue
-                        ts = text.split(',')
-                        a = ts[0].strip()
-                        b = ts[1].strip()
-                        replace_words.append((a,b))
-            else:
-                # log
-                #print(f"compare word file '{wf}' does not exists.")
-                logging.debug(f"compare word file '{wf}' does not exists.")
-
-            #a_str = ''.join(a_list) if len(a_list)>0 else None
-            #b_str = ''.join(b_list) if len(b_list)>0 else None
-
-            # normalize
-            from unicodedata import normalize
-            string1 = normalize('NFKD', a_str)
-            string2 = normalize('NFKD', b_str)
-            
             #replace_words = [('民', '⺠'),('见','⻅'),] # replace look-alike but different words (different unicode)
-            for rw1, rw2 in replace_words:
-                string1 = string1.replace(rw2, rw1)
-                string2 = string2.replace(rw2, rw1)
-
-            from difflib import Differ
-            d = Differ(charjunk=lambda x: x==' ') # char ' ' considered as junk
-            diff = d.compare(string1, string2)
-            result = list(diff)
-
-            def is_ignored_word(wb:str): # if ignored, do not show at all
-                ignore_list = [' ',',','，',':','：','(',')','{','}','【','】','.','。',';','；']
-                #wb = w.encode()
-                if wb in ignore_list:
-                    return True
-                return False
-
-            s = [] # doc a
-            ss = [] # doc b
-            for r in result:
-                to_ignore = is_ignored_word(r[-1])
-                if r[:2] == '- ':
-                    if not to_ignore: # doc a
-                        if len(s) > 0 and  s[-1] == font_end: # remove </font> and add it after r[-1]
-                            s[-1] = r[-1] #remove the </font>
-                            s.append(font_end) #add the </font>
-                        else: # add <font>...</font>
-                            s.append(a_font)
-                            s.append(r[-1])
-                            s.append(font_end)
-                    else: # ignored word, add back
-                        s.append(r[-1])
-                elif r[:2] == '+ ':
-                    if  not to_ignore: #doc b
-                        if len(ss) > 0 and ss[-1] == font_end:
-                            ss[-1] = r[-1]
-                            ss.append(font_end)
-                        else:
-                            ss.append(b_font)
-                            ss.append(r[-1])
-                            ss.append(font_end)
-                    else: #add word as is
-                        ss.append(r[-1])
-                else: #not to_ignore: # if ignore, do not add at all
-                    s.append(r[-1])
-                    ss.append(r[-1])
-
-            a = ''.join(s)
-            b = ''.join(ss)
-            a = a.replace('\n',"<p>") # replace newline \n with html <p>
-            b = b.replace('\n', "<p>")
+
+            # diff and highlight the differences
+            with metrics.stage('diff'):
+                a, b = text_diff.compare_texts(a_str, b_str, replace_words, a_font=a_font, b_font=b_font, font_end=font_end, engine=self.diff_engine)
 
             return a, b
 
-        try:
-            # back to function
-            a_str, b_str = '','' # output a, b strings
+        a_end, b_end = False, False
+        a_left, b_left = '', '' # texts read when either document ends
+        def get_pairs():
+            # page pairs until either document ends, as (is_diff, a, b)
+            nonlocal a_total, b_total, a_end, b_end, a_left, b_left
             a_str, b_str, a_end, b_end = get_ab_texts(genA, genB)
             while((not a_end) and (not b_end)):
-                #
-                #a_list = list(filter(lambda x: x.strip() != '', a_list)) # strip items
-                #b_list = list(filter(lambda x: x.strip() != '', b_list))
-                #a_total += len(a_list) # add to totals
-                #b_total += len(b_list)
                 a_total += 1
                 b_total += 1
+                yield True, a_str, b_str
+                a_str, b_str, a_end, b_end = get_ab_texts(genA, genB)
+            a_left, b_left = a_str, b_str
+
+        def get_aligned_pairs():
+            # pairs of aligned pages, only changed pairs need a diff, as (is_diff, a, b)
+            #   up to align_window blocks of each document are aligned at a time, pairs up to the last equal pair are yielded,
+            #   the blocks after it may align with blocks not read yet, so they are aligned again with the next blocks
+            nonlocal a_total, b_total, a_end, b_end
+            window = max(1, self.align_window)
+            a_blocks, b_blocks = [], []
+            a_more, b_more = True, True
+            while True:
+                while a_more and len(a_blocks) < window:
+                    block = next(genA, None)
+                    a_more = block is not None
+                    if a_more:
+                        a_blocks.append(block)
+                        a_total += 1
+                while b_more and len(b_blocks) < window:
+                    block = next(genB, None)
+                    b_more = block is not None
+                    if b_more:
+                        b_blocks.append(block)
+                        b_total += 1
+                if len(a_blocks) == 0 and len(b_blocks) == 0:
+                    break
+                with metrics.stage('align'):
+                    aligned = text_diff.align_blocks(a_blocks, b_blocks)
+                if a_more or b_more:
+                    anchors = [k for k, (tag, _, _) in enumerate(aligned) if tag == 'equal']
+                    if len(anchors) > 0:
+                        aligned = aligned[:anchors[-1]+1]
+                    # else, no equal pair in the windows, all are yielded as aligned so far, memory is bounded
+                for tag, i, j in aligned:
+                    if tag == 'delete': # a only
+                        yield False, f"{a_font}{a_blocks[i]}{font_end}".replace('\n', '<p>'), ''
+                    elif tag == 'insert': # b only
+                        yield False, '', f"{b_font}{b_blocks[j]}{font_end}".replace('\n', '<p>')
+                    elif a_blocks[i] == b_blocks[j]: # nothing to highlight
+                        yield False, a_blocks[i].replace('\n', '<p>'), b_blocks[j].replace('\n', '<p>')
+                    else:
+                        yield True, a_blocks[i], b_blocks[j]
+                # aligned is in document order, the blocks used are a prefix of each window
+                a_blocks = a_blocks[sum(1 for _, i, _ in aligned if i is not None):]
+                b_blocks = b_blocks[sum(1 for _, _, j in aligned if j is not None):]
+            a_end, b_end = True, True # no leftovers
 
-                # compare
-                a_str, b_str = compare_two(a_str, b_str)
-                
+        try:
+            # back to function
+            a_str, b_str = '','' # output a, b strings
+            pairs = get_aligned_pairs() if self.align_blocks else get_pairs()
+            if self.diff_workers > 1 and streaming: # diff pairs in parallel, yield in page order
+                compared = self.__parallel_compare__(pairs, replace_words, a_font, b_font, font_end, continue_flag=continue_flag)
+            else:
+                compared = (compare_two(a_str, b_str) if is_diff else (a_str, b_str) for is_diff, a_str, b_str in pairs)
+            for a_str, b_str in compared:
                 # yield
                 output['status'] = 0
                 output['error'] = ''
@@ -254,10 +338,8 @@ class webui_handlers():
                 output['B'] = b_str
                 output['B_NAME'] = filenameB
                 yield output
+            a_str, b_str = a_left, b_left # leftovers if any are added below
 
-                # continue
-                a_str, b_str, a_end, b_end = get_ab_texts(genA, genB)
-            
             # check leftovers
             if not a_end: # a has more
                 s = []
@@ -329,23 +411,25 @@ class webui_handlers():
 
         try:
             if file is not None:
-                MAX = self.emb_model.MAX_LENGTH
-                overlap = 20 # overlap
-                overlap = 0
+                MAX = self.emb_model.CHUNK_TOKENS
+                overlap = 0 # overlap tokens
                 reader:IDocReaderWriter = self.__get_reader_by_filename__(file.name, is_ocr=is_ocr)
-                t1 = reader.read_doc_to_texts(doc_path=file.name, read_by=read_by, continue_flag=continue_flag)
-                # t1 is an iterator
-                for t in t1:
-                    texts.append(t)
-                # break into chunks
-                texts = utilities.convert_text_list_to_chunks(texts=texts, chunk_size=MAX, overlap=overlap, merge=False)#no merge
-                # texts holds all document chunks
+                # texts are chunked as the reader streams them, and each chunk is embedded as it is made
+                t1 = metrics.timed_iterator('parse', reader.read_doc_to_texts(doc_path=file.name, read_by=read_by, streaming=True, continue_flag=continue_flag))
+                chunks = text_chunker.iter_chunks(t1, max_tokens=MAX, overlap_tokens=overlap, count_tokens=self.emb_model.count_tokens)
                 # build faiss index
                 DIM = self.emb_model.EMBED_SIZE
                 FAISSINDEX = faiss.IndexFlatL2(DIM) # indexflat
-                for t in texts:
-                    v = self.emb_model.encode(t) # make shape [1, DIM], move to cpu
-                    FAISSINDEX.add(v)
+                while True:
+                    with metrics.stage('chunk', exclude=t1): # the reader is timed as 'parse'
+                        chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    t = chunk[0]
+                    texts.append(t) # texts holds all document chunks
+                    with metrics.stage('embed'):
+                        v = self.emb_model.encode(t) # make shape [1, DIM], move to cpu
+                        FAISSINDEX.add(v)
             return FAISSINDEX, texts
         except ContinueExit:
             # log
@@ -359,6 +443,44 @@ class webui_handlers():
             logging.error(f".........doc_upload exception: {error}...")
  
         return FAISSINDEX, texts
+
+    async def adoc_upload(self, file, is_ocr=False, read_by=0, continue_flag:llm_continue=None, batch_size=16):
+        """
+        doc_upload by the async embedding client, the reader and the chunker run in a thread a batch of chunks at a time
+        batch_size: chunks embedded concurrently
+        """
+        FAISSINDEX = None
+        texts = []
+
+        try:
+            if file is not None:
+                MAX = self.emb_model.CHUNK_TOKENS
+                overlap = 0 # overlap tokens
+                reader:IDocReaderWriter = self.__get_reader_by_filename__(file.name, is_ocr=is_ocr)
+                t1 = metrics.timed_iterator('parse', reader.read_doc_to_texts(doc_path=file.name, read_by=read_by, streaming=True, continue_flag=continue_flag))
+                chunks = text_chunker.iter_chunks(t1, max_tokens=MAX, overlap_tokens=overlap, count_tokens=self.emb_model.count_tokens)
+                def next_batch()->list[str]:
+                    with metrics.stage('chunk', exclude=t1): # the reader is timed as 'parse'
+                        return [chunk[0] for _, chunk in zip(range(batch_size), chunks)]
+                DIM = self.emb_model.EMBED_SIZE
+                FAISSINDEX = faiss.IndexFlatL2(DIM) # indexflat
+                while True:
+                    batch = await asyncio.to_thread(next_batch)
+                    if len(batch) == 0:
+                        break
+                    texts.extend(batch)
+                    with metrics.stage('embed'):
+                        v = await self.emb_model.aencode_batch(batch) # shape [len(batch), DIM]
+                        FAISSINDEX.add(v)
+            return FAISSINDEX, texts
+        except ContinueExit:
+            logging.debug(".........adoc_upload received stop signal and exits...")
+            raise # reraise
+        except:
+            error = traceback.format_exc()
+            logging.error(f".........adoc_upload exception: {error}...")
+ 
+        return FAISSINDEX, texts
     
     def doc_question(self, query, words=100, faiss_index=None, texts=[], rerank_threshold=0.9, rerank_min_score=0.1, continue_flag:llm_continue=None)->Iterator:
         """
@@ -379,11 +501,6 @@ class webui_handlers():
         exception: this will raise ContinueExit from llm generate/chats, caller needs to handle ContinueExit
         """
         def __answer_question__():
-            status = 0
-            error = ''
-            sources = []
-            context = []
-
             output = {
                 'status': 0,
                 'error': '',
@@ -397,113 +514,20 @@ class webui_handlers():
                 return
             # else
 
-            max_score = 0.
-            # get k neighbors from index
-            # max length of each text in texts is self.emb.MAX
-            maxK = math.floor(self.llm.MAX_LENGTH/self.emb_model.MAX_LENGTH)
-            maxK = 10 if maxK > 10 else maxK
-            k = len(texts)
-            k = k if k < maxK else maxK
-            k = 2 if k < 2 else k
-            #print(f"........k is: {k}")
-            logging.debug(f"........k is: {k}")
-
-            xq = self.emb_model.encode(query)
-            _, INDEX = faiss_index.search(xq, k) # INDEX array shape [1, k]
-            # a list of 3 to choose
-            score_context = []
-            score_texts = []
-            for idx in INDEX[0]: # loop each index in array
-                if idx == -1:
-                    
-                    #print(f"webui_handler::doc_question faiss index is -1")
-                    logging.warning(f"webui_handler::doc_question faiss index is -1")
-                    
-                    break
-                score_texts.append(texts[idx])
-            if len(score_texts) > 0:
-                success, index_score = self.reranker.rerank_score(query, score_texts) # rerank element against text indexed at INDEX[0] array
-                if success:
-                    for idx, score in index_score:
-                        score_context.append([score, score_texts[idx]]) # save to list
-                else: # reranker failed, possibly cohere no credit or exceed quota
-                    score = 0.5
-                    # fake a score, using the score_text descending order
-                    score_context = [[(score - 0.01*i), text] for i, text in enumerate(score_texts)]
-
-            #print(f".......score_context: {score_context}")
-            logging.debug(f".......score_context: {score_context}")
-
-            if len(score_context)>0:
-                score_context.sort(key=lambda x: x[0], reverse=True) # sort by score, descending
-                max_score = score_context[0][0]
-                if max_score > rerank_min_score: # if rank score too low, discard
-                    threshold = rerank_threshold #
-                    if max_score > threshold: # use the top score
-                        context = [score_context[0][1]] # make it iterable
-                    else: # use the top 3
-                        top = 3
-                        context = [text[1] for text in score_context[:top]] #iterable
-                    #source
-                    max_score = "{:.2%}".format(max_score)
-                    #sources += f"审核问题：\n{query}\n来源：\n得分{max_score}\n{context}\n\n"
-            if len(context)==0: # did not find any relevant info, most likely an error
-                #sources += "Can not find relevant contexts, possible an error. Check server log for details."
-                #status = 1 # warning
-                sources = ["Can not find relevent contexts from the document. The following is a generic answer."] # iterable
-            else:
-                sources = context
-
-            # current time
-            current_time = datetime.datetime.now()
-            current_time = current_time.strftime('%Y-%m-%d, %H:%M:%S')
-            current_day = datetime.datetime.today().strftime('%A')
-            current_time = f"{current_time}, {current_day}"
-
-            sys_prompt = """"You are an AI, your name is {name}. The current time is {current}.
-You are to answer user's question based on the provided background information.
-
-Background Information:
-{context}
-
-Use the above background information to respond to user's inquery, do not make up your answer.
-You must answer in English.
-"""
-            user_prompt = """{query}"""
-            assistant_prompt = ''
-            name = 'Bot'
-            # query
-            sys_prompt = sys_prompt.format(name=name, current=current_time, context=context)
-            user_prompt = user_prompt.format(query=query)
-            assistant_prompt = assistant_prompt.format(name=name)
-            #inputs = prompt.format(name=name, context=context, query=query)
-
-            #print(f"system: {sys_prompt}\nuser: {user_prompt}\nassistant: {assistant_prompt}")
-            
-            # tight
-            kwargs = {
-                'temperature': 0.3,
-                'max_new_tokens': words,
-                'top_k': 3,
-                'top_p': 0.95,
-                'repetition_penalty': 1.1,
-            }
-            stop = ['[['] # extend self.stop with this
-            response = self.llm.stream_chat(inputs=user_prompt, system_prompt=sys_prompt, assistant_prompt=assistant_prompt, stop=stop, replace_stop=False, **kwargs)
+            with metrics.stage('embed'):
+                xq = self.emb_model.encode(query)
+            sources, prompts, kwargs = self.__question_prompts__(query, xq, words, faiss_index, texts, rerank_threshold, rerank_min_score)
+            response = self.llm.stream_chat(**prompts, continue_flag=continue_flag, **kwargs)
             for text in response:
                 text = text.strip()
                 
                 #print(f".........{text}")
 
-                output['status'] = status
-                output['error'] = error
                 output['text'] = text
                 output['sources'] = []
                 yield output
             # send sources
             for source in sources:
-                output['status'] = status
-                output['error'] = error
                 output['text'] = ''
                 output['sources'] = source
                 yield output
@@ -511,6 +535,144 @@ You must answer in English.
         out_streamer = __answer_question__() # assign the generator to out_streamer
         yield from out_streamer
 
+    async def adoc_question(self, query, words=100, faiss_index=None, texts=[], rerank_threshold=0.9, rerank_min_score=0.1, continue_flag:llm_continue=None)->AsyncIterator:
+        """
+        doc_question by the async model clients, the outputs are the same
+        exception: this will raise ContinueExit from llm generate/chats, caller needs to handle ContinueExit
+        """
+        output = {
+            'status': 0,
+            'error': '',
+            'text': '',
+            'sources': [],
+        }
+        if faiss_index is None:
+            output['status'] = -1
+            output['error'] = "Error! Index for file is empty."
+            yield output
+            return
+
+        with metrics.stage('embed'):
+            xq = await self.emb_model.aencode(query)
+        sources, prompts, kwargs = self.__question_prompts__(query, xq, words, faiss_index, texts, rerank_threshold, rerank_min_score)
+        async for text in self.llm.astream_chat(**prompts, continue_flag=continue_flag, **kwargs):
+            output['text'] = text.strip()
+            output['sources'] = []
+            yield output
+        # send sources
+        for source in sources:
+            output['text'] = ''
+            output['sources'] = source
+            yield output
+
+    def __question_prompts__(self, query, xq, words, faiss_index, texts, rerank_threshold, rerank_min_score)->tuple[list, dict, dict]:
+        """
+        the contexts of the query embedding xq from faiss_index, reranked, and the chat prompts with them
+        output: sources, prompts {inputs, system_prompt, assistant_prompt, stop, replace_stop}, generation kwargs
+        """
+        sources = []
+        context = []
+        max_score = 0.
+        # get k neighbors from index
+        # max length of each text in texts is self.emb.MAX
+        maxK = math.floor(self.llm.MAX_LENGTH/self.emb_model.MAX_LENGTH)
+        maxK = 10 if maxK > 10 else maxK
+        k = len(texts)
+        k = k if k < maxK else maxK
+        k = 2 if k < 2 else k
+        #print(f"........k is: {k}")
+        logging.debug(f"........k is: {k}")
+
+        with metrics.stage('faiss_search'):
+            _, INDEX = faiss_index.search(xq, k) # INDEX array shape [1, k]
+        # a list of 3 to choose
+        score_context = []
+        score_texts = []
+        for idx in INDEX[0]: # loop each index in array
+            if idx == -1:
+                
+                #print(f"webui_handler::doc_question faiss index is -1")
+                logging.warning(f"webui_handler::doc_question faiss index is -1")
+                
+                break
+            score_texts.append(texts[idx])
+        if len(score_texts) > 0:
+            with metrics.stage('rerank'):
+                success, index_score = self.reranker.rerank_score(query, score_texts) # rerank element against text indexed at INDEX[0] array
+            if success:
+                for idx, score in index_score:
+                    score_context.append([score, score_texts[idx]]) # save to list
+            else: # reranker failed, possibly cohere no credit or exceed quota
+                score = 0.5
+                # fake a score, using the score_text descending order
+                score_context = [[(score - 0.01*i), text] for i, text in enumerate(score_texts)]
+
+        #print(f".......score_context: {score_context}")
+        logging.debug(f".......score_context: {score_context}")
+
+        if len(score_context)>0:
+            score_context.sort(key=lambda x: x[0], reverse=True) # sort by score, descending
+            max_score = score_context[0][0]
+            if max_score > rerank_min_score: # if rank score too low, discard
+                threshold = rerank_threshold #
+                if max_score > threshold: # use the top score
+                    context = [score_context[0][1]] # make it iterable
+                else: # use the top 3
+                    top = 3
+                    context = [text[1] for text in score_context[:top]] #iterable
+                #source
+                max_score = "{:.2%}".format(max_score)
+                #sources += f"审核问题：\n{query}\n来源：\n得分{max_score}\n{context}\n\n"
+        if len(context)==0: # did not find any relevant info, most likely an error
+            #sources += "Can not find relevant contexts, possible an error. Check server log for details."
+            #status = 1 # warning
+            sources = ["Can not find relevent contexts from the document. The following is a generic answer."] # iterable
+        else:
+            sources = context
+
+        # current date, a stable prompt prefix for the day
+        current_time = self.__current_date__()
+
+        # static instructions first, the prefix is cached by the llm backend across requests
+        sys_prompt = """You are an AI, your name is {name}.
+You are to answer user's question based on the provided background information.
+Use the background information to respond to user's inquery, do not make up your answer.
+You must answer in English.
+
+Background Information:
+{context}
+
+Today is {current}.
+"""
+        user_prompt = """{query}"""
+        assistant_prompt = ''
+        name = 'Bot'
+        # query
+        sys_prompt = sys_prompt.format(name=name, current=current_time, context=context)
+        user_prompt = user_prompt.format(query=query)
+        assistant_prompt = assistant_prompt.format(name=name)
+        #inputs = prompt.format(name=name, context=context, query=query)
+
+        #print(f"system: {sys_prompt}\nuser: {user_prompt}\nassistant: {assistant_prompt}")
+        
+        # tight
+        kwargs = {
+            'temperature': 0.3,
+            'max_new_tokens': words,
+            'top_k': 3,
+            'top_p': 0.95,
+            'repetition_penalty': 1.1,
+        }
+        stop = ['[['] # extend self.stop with this
+        prompts = {
+            'inputs': user_prompt,
+            'system_prompt': sys_prompt,
+            'assistant_prompt': assistant_prompt,
+            'stop': stop,
+            'replace_stop': False,
+        }
+        return sources, prompts, kwargs
+
     # file element extraction button click
     def doc_extract(self, elements:list=[], faiss_index=None, texts=[], rerank_threshold=0.9, rerank_min_score=0.1, continue_flag:llm_continue=None):
         """
@@ -686,8 +848,10 @@ Output should start immediately with
                 k = len(texts)
                 k = k if k < maxK else maxK
                 #print(f"........k is: {k}")
-                xq = self.emb_model.encode(element)
-                _, INDEX = faiss_index.search(xq, k) # INDEX array shape [1, k]
+                with metrics.stage('embed'):
+                    xq = self.emb_model.encode(element)
+                with metrics.stage('faiss_search'):
+                    _, INDEX = faiss_index.search(xq, k) # INDEX array shape [1, k]
                 # a list of 3 to choose
                 score_context = []
                 score_texts = []
@@ -700,7 +864,8 @@ Output should start immediately with
                         break
                     score_texts.append(texts[idx])
                 if len(score_texts) > 0:
-                    success, index_score = self.reranker.rerank_score(element, score_texts) # rerank element against text indexed at INDEX[0] array
+                    with metrics.stage('rerank'):
+                        success, index_score = self.reranker.rerank_score(element, score_texts) # rerank element against text indexed at INDEX[0] array
                     if success:
                         for idx, score in index_score:
                             score_context.append([score, score_texts[idx]]) # save to list
@@ -778,7 +943,7 @@ You must answer in English.
             #print(f"extract summary length {len(_summary)}: {_summary}")
             return _summary
 
-    def doc_know(self, query: str, tools, history=None, splitter='', stop=[], replace_stop=False, streaming=True, streaming_delta=True, top=3, faq_conf=0.95, vdb_conf=0.6, rerank_threshold=0.9, rerank_min_score=0.1, bot_name='ubox', continue_flag:llm_continue=None,  **kwargs) -> tuple[bool, str|Iterator]:
+    def doc_know(self, query: str, tools, history=None, splitter='', stop=[], replace_stop=False, streaming=True, streaming_delta=True, top=3, faq_conf=0.95, vdb_conf=0.6, rerank_threshold=0.9, rerank_min_score=0.1, bot_name='ubox', continue_flag:llm_continue=None, async_stream=False, **kwargs) -> tuple[bool, str|Iterator]:
         """
         inputs: 
             query: the ask
@@ -789,6 +954,7 @@ You must answer in English.
             replace_stop, if True, will replace LLM's own stop words, else, will append to the internal stop words
             streaming: if answer is streaming
             streaming_delta: if true, only delta sent to client
+            async_stream: if True, a streaming answer is an async generator by the llm's async client, to be iterated in the event loop
             faq_conf: when match query with FAQ questions, if >= conf, indicating a match
             top: the top number of answers with match conf >= conf, default top 1
             rerank_threshold: if reranker score > this threshold, meaning a top hit
@@ -823,39 +989,41 @@ You must answer in English.
             return answers, sources # FAQ has not source but itself
 
         # if not found in faq, continue
-        system_prompt_context = """You are AI, name is {name}. It is now {current}. You need to answer user's question based on the provided background information.
+        # static instructions first, the prefix is cached by the llm backend across requests; volatile fields last
+        system_prompt_context = """You are AI, name is {name}. You need to answer user's question based on the provided background information.
+Remember: It is essential to identify key information in the background information that pertains to user's question to provide more accurate responses.
+Remember: Your responses must not contradict the facts presented in the background information.
+Answer in English.
 
 Background Information:
 [
 {context}
 ]
 
-Remember: It is essential to identify key information in the background information that pertains to user's question to provide more accurate responses.
-Remember: Your responses must not contradict the facts presented in the background information.
-Answer in English.
+Today is {current}.
 """
-        system_prompt_no_context = """You are AI, name is {name}. It is now {current}. Please answer user's question friendly.
+        system_prompt_no_context = """You are AI, name is {name}. Please answer user's question friendly.
 Answer in English.
+
+Today is {current}.
 """
         #
         # check if LLM can self answer without quarying knowledge, e.g, 'what time is it?'
         #
         #result = self.__llm_check_tools__(query=query, external_tools=tools, name=bot_name, continue_flag=continue_flag)
-        # current time
-        current_time = datetime.datetime.now()
-        current_time = current_time.strftime('%Y-%m-%d %H:%M:%S')
-        current_day = datetime.datetime.today().strftime('%A')
-        current_time = f"{current_time}, {current_day}"
+        # current date, a stable prompt prefix for the day
+        current_time = self.__current_date__()
 
         result = 'tool' # bypass self check for now
         if result == 'self': #LLM can self-answer
-            prompt = system_prompt_no_context.format(name=bot_name, current=current_time)
+            prompt, history, _ = self.__fit_prompt__(system_prompt_no_context, query, history=history, name=bot_name, current=current_time, **kwargs)
 
             #print(prompt)
             #print()
 
             if streaming:
-                answers = self.llm.stream_chat(inputs=query,system_prompt=prompt, history=history, splitter=splitter, stop=stop, replace_stop=replace_stop, output_delta=streaming_delta, **kwargs)
+                stream_chat = self.llm.astream_chat if async_stream else self.llm.stream_chat
+                answers = stream_chat(inputs=query,system_prompt=prompt, history=history, splitter=splitter, stop=stop, replace_stop=replace_stop, output_delta=streaming_delta, continue_flag=continue_flag, **kwargs)
             else:
                 answers = self.llm.chat(inputs=query,system_prompt=prompt, history=history, splitter=splitter, stop=stop, replace_stop=replace_stop, **kwargs)
                 answers = [answers] # make it a list for caller to loop
@@ -872,7 +1040,8 @@ Answer in English.
             score_texts.append(meta)
 
         if len(score_texts) > 0:
-            success, index_score = self.reranker.rerank_score(query, score_texts) # rerank element against text indexed at INDEX[0] array
+            with metrics.stage('rerank'):
+                success, index_score = self.reranker.rerank_score(query, score_texts) # rerank element against text indexed at INDEX[0] array
             if success:
                 for idx, score in index_score:
                     context = contexts[idx] # 
@@ -895,31 +1064,49 @@ Answer in English.
         if len(contexts)==0:# cannot find an answer with confidence from vdb
             #self.prefix = "我未能在公司知识体系找到相关答案，以下是我的理解："
             sources = ["I can not find relevent contexts from knowledge base. The following is a generic answer."]
-            prompt = system_prompt_no_context.format(name=bot_name, current=current_time)
+            prompt, history, _ = self.__fit_prompt__(system_prompt_no_context, query, history=history, name=bot_name, current=current_time, **kwargs)
         else: #with context
-            # context is a list, [{meta:xx, source_from:yy ,..}, {}...]
-            sources = [f"""{ctx['meta']} [Source: {ctx['source_from']}""" for ctx in contexts]
-            # context only meta
-            contexts = [f"{ctx['meta']}" for ctx in contexts]
-            prompt = system_prompt_context.format(name=bot_name, current=current_time, context=contexts)
+            # context only meta, fitted with the history into the prompt budget
+            prompt, history, kept = self.__fit_prompt__(system_prompt_context, query, contexts=[f"{ctx['meta']}" for ctx in contexts], history=history, name=bot_name, current=current_time, **kwargs)
+            # context is a list, [{meta:xx, source_from:yy ,..}, {}...], sources of the contexts in the prompt
+            sources = [f"""{ctx['meta']} [Source: {ctx['source_from']}""" for ctx in contexts[:len(kept)]]
 
         #print(prompt)
         #print()
 
         if streaming:
-            answers = self.llm.stream_chat(inputs=query,system_prompt=prompt, history=history, splitter=splitter, stop=stop, replace_stop=replace_stop, output_delta=streaming_delta, **kwargs)
+            stream_chat = self.llm.astream_chat if async_stream else self.llm.stream_chat
+            answers = stream_chat(inputs=query,system_prompt=prompt, history=history, splitter=splitter, stop=stop, replace_stop=replace_stop, output_delta=streaming_delta, continue_flag=continue_flag, **kwargs)
         else:
             answers = self.llm.chat(inputs=query,system_prompt=prompt, history=history, splitter=splitter, stop=stop, replace_stop=replace_stop, **kwargs)
             answers = [answers]
 
         return answers, sources
 
+    def __current_date__(self)->str:
+        # the date, not the time, so prompts with it are the same all day
+        return datetime.datetime.now().strftime('%Y-%m-%d, %A')
+
+    def __fit_prompt__(self, system_prompt:str, query:str, contexts:list[str]=[], history:list=[], name='', current='', **kwargs)->tuple[str, list, list[str]]:
+        """
+        fit the system prompt with contexts and the recent history into the prompt token budget
+        output: the system prompt, the kept history, the kept contexts
+        """
+        max_new_tokens = kwargs.get('max_new_tokens', self.llm.MAX_NEW_TOKENS if hasattr(self.llm, 'MAX_NEW_TOKENS') else 0)
+        budget = self.llm.prompt_budget(max_new_tokens)
+        budget = budget if self.prompt_token_budget <= 0 else min(budget, self.prompt_token_budget)
+        assembler = prompt_assembler(self.llm.count_tokens, budget=budget)
+        prompt, kept_history, kept_contexts = assembler.fit(system_prompt, query, contexts=contexts, history=history, name=name, current=current)
+        metrics.trace(f"prompt budget {budget}: {len(kept_contexts)}/{len(contexts)} contexts, {len(kept_history)}/{len(history)} history turns")
+        return prompt, kept_history, kept_contexts
+
     def __query_faq__(self, query:str, level_0:str='', level_1:str='', conf=0.95, top=1)->dict:
         """
         query FAQ in vdb, if the query matches FAQ's questions with confidence >= conf, then return the top answer
         output: a list of dict: [{'question': xxx, 'answer':xxx, 'score': 0.x}]
         """
-        answer = self.vdb_mgr.faq_query(query=query, level_0=level_0, level_1=level_1, top=top, threshold=conf)
+        with metrics.stage('qdrant_search'):
+            answer = self.vdb_mgr.faq_query(query=query, level_0=level_0, level_1=level_1, top=top, threshold=conf)
         return answer
 
     def __query_vdb__(self, query:str, db_type='', conf=0.95, top=1, only_recent_timestamp=True)->dict:
@@ -927,7 +1114,8 @@ Answer in English.
         query vdb, return the top answer with confidence >= conf
         output: a list of dict, [{meta:'xxx', type:'xxx', source_from:'xxx', score:0.0}...]
         """
-        answer = self.vdb_mgr.query_vdb(query=query,type=db_type, top_k=top, threshold=conf, only_recent_timestamp=only_recent_timestamp)
+        with metrics.stage('qdrant_search'):
+            answer = self.vdb_mgr.query_vdb(query=query,type=db_type, top_k=top, threshold=conf, only_recent_timestamp=only_recent_timestamp)
         return answer
 
     def __llm_check_tools__(self, query:str, external_tools, name, continue_flag:llm_continue=None)->str:
@@ -940,11 +1128,8 @@ Answer in English.
         or
             None if failed to get the answer
         """
-        # current time
-        current_time = datetime.datetime.now()
-        current_time = current_time.strftime('%Y/%m/%d, %H:%M:%S')
-        current_day = datetime.datetime.today().strftime('%A')
-        current_time = f"{current_time}, {current_day}"
+        # current date, a stable prompt prefix for the day
+        current_time = self.__current_date__()
         external_tools = external_tools if external_tools is not None else [] # taking care of list as input param
         # tools, [doc_search: 用于搜索银行理财产品相关信息]
         # tool_names, ['doc_search']
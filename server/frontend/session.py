@@ -4,14 +4,89 @@
     session manager for fastapi/flask - to make the session used by both socket & http work
     Author: awtestergit
 """
-from datetime import timedelta, datetime
+import os
+import sys
+import mmap
+import time
+import heapq
+import logging
+import traceback
+from queue import Queue
+from collections import OrderedDict
+from threading import Lock, Thread
+import numpy as np
+import faiss
 from file_management.file_manager import server_file_mgr
-from file_management.chat_manager import chat_history_mgr
+from file_management.chat_manager import chat_history_cache
+from interface.interface_session import ISessionBackend
+from interface.interface_model import llm_continue
+from frontend.session_backend import MemorySessionBackend
+
+class spilled_texts():
+    """
+    read-only list of texts spilled to disk, backed by mmap
+        blob file holds all utf-8 texts concatenated, offsets file holds the (n+1) start offsets
+    supports len(), [idx] and iteration, which is all the handlers need from FAISS texts
+    """
+    def __init__(self, blob_path:str, offsets_path:str) -> None:
+        self.blob_path = blob_path
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+        self.__file__ = open(blob_path, 'rb')
+        size = os.path.getsize(blob_path)
+        self.__blob__ = mmap.mmap(self.__file__.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b''
+
+    @classmethod
+    def write(cls, texts:list, blob_path:str, offsets_path:str):
+        offsets = np.zeros(len(texts)+1, dtype=np.int64)
+        with open(blob_path, 'wb') as f:
+            for idx, text in enumerate(texts):
+                data = text.encode(errors='surrogatepass')
+                f.write(data)
+                offsets[idx+1] = offsets[idx] + len(data)
+        with open(offsets_path, 'wb') as f: # file object, so np.save does not append '.npy'
+            np.save(f, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        idx = int(idx)
+        idx = idx + len(self) if idx < 0 else idx
+        if idx < 0 or idx >= len(self):
+            raise IndexError("spilled texts index out of range")
+        start, end = int(self.offsets[idx]), int(self.offsets[idx+1])
+        return self.__blob__[start:end].decode(errors='surrogatepass')
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def close(self):
+        if isinstance(self.__blob__, mmap.mmap):
+            self.__blob__.close()
+        self.__file__.close()
+
+class spilled_item():
+    """
+    placeholder left in the session dict when the value has been spilled to disk
+    """
+    def __init__(self, paths:list[str]) -> None:
+        self.paths = paths
+        self.stamp = time.time_ns() # tells a re-spilled value from the one loaded before
 
 class session_manager():
-    def __init__(self, file_mgr:server_file_mgr, chat_mgr:chat_history_mgr, expiration=30) -> None:
+    def __init__(self, file_mgr:server_file_mgr, chat_mgr:chat_history_cache, expiration=30, memory_budget=0, backend:ISessionBackend=None) -> None:
+        """
+        memory_budget: the global budget in bytes for FAISS indexes and texts held in sessions, 0 means no budget
+            when exceeded, the least-recently-used sessions' indexes and texts are spilled to the upload folder, and mmap-ed back on next access
+        backend: where session key/values are stored, default in memory of this process
+            with a shared backend, FAISS indexes and texts are always spilled, so any worker can mmap them
+        """
         self.expiration = expiration # default session expires in 30 minutes
-        self.expire_key = "SESSION_EXPIRATION"
+        self.expiration_seconds = expiration * 60
+        self.expire_key = "SESSION_EXPIRATION" # the value is a time.time() timestamp
         # session keys
         self.SID_KEY = "SID"
         self.UID_KEY = "UID"
@@ -24,87 +99,287 @@ class session_manager():
         self.LOGGEDIN = "LOGGEDIN" # whether user is logged in, default user uid's loggedin is false
         self.USERID = "USERID" # user id
         self.USERNAME = "USERNAME" #user name
-        self.session = {} # {'sid1: {'uid':uid1, EXPIRE:xx}, 'uid1': {sid:sid1, EXPIRE:xx}, 'uid2':{}...}
+        self.backend = backend if backend is not None else MemorySessionBackend(expire_key=self.expire_key)
+        self.session = self.backend.session if isinstance(self.backend, MemorySessionBackend) else None # the dict, for debugging
         self.file_mgr = file_mgr
         self.chat_mgr = chat_mgr
+        # memory accounting
+        self.memory_budget = memory_budget
+        self.SPILL_KEYS = (self.FAISS_KEY, self.FAISS_TEXTS) # the keys can be spilled to disk
+        self.SPILL_INDEX_FILE = '__session_faiss__.index'
+        self.SPILL_TEXTS_FILE = '__session_faiss__.texts'
+        self.SPILL_OFFSETS_FILE = '__session_faiss__.offsets'
+        self.memory_usage = 0 # bytes held in memory by all sessions
+        self.__memory_lru__ = OrderedDict() # {uid: bytes}, least-recently-used first
+        self.__mapped__ = {} # {uid: faiss index}, indexes mmap-ed back from disk, not counted in memory
+        self.__loaded__ = {} # {(uid, key): (stamp, value)}, mmap-ed values of a shared backend, local to this process
+        self.__memory_lock__ = Lock()
+        # expiry min-heap with lazy deletion
+        #   renewal only updates the session's own expiry, the heap entry is checked (and re-pushed if renewed) when it pops
+        self.__expiry_heap__ = [] # [(expiry, id)...]
+        self.__in_heap__ = set() # ids having an entry in the heap
+        self.__expiry_lock__ = Lock() # guards the heap and the set, renewed from request threads, popped by the cleanup task
+        # background worker removing files and chat history of expired sessions, off the event loop
+        self.__cleanup_queue__ = Queue()
+        self.__cleanup_worker__ = None
+
+    def __set_expiration__(self, uid, expiry):
+        self.backend.set_expiry(uid, expiry)
+        with self.__expiry_lock__:
+            if uid not in self.__in_heap__:
+                heapq.heappush(self.__expiry_heap__, (expiry, uid))
+                self.__in_heap__.add(uid)
 
     def __renew_expiration__(self, uid):
         # Set session expiry
-        expiry = timedelta(minutes=self.expiration)  # Sessions expire after 30 minutes
-        expiry = datetime.now() + expiry
+        expiry = time.time() + self.expiration_seconds # Sessions expire after 30 minutes
 
-        if uid in self.session:
-            session = self.session[uid]
-            session[self.expire_key] = expiry # set self expiration
+        session = self.backend.get(uid)
+        if session is not None:
+            self.__set_expiration__(uid, expiry) # set self expiration
             # if this uid is sid
-            if self.UID_KEY in session: # set the uid expiration
-                uid = session[self.UID_KEY]
-                if uid in self.session:
-                    self.session[uid][self.expire_key] = expiry
-            elif self.SID_KEY in session: # this uid is a uid, set sid expiration
+            if self.UID_KEY in session and session[self.UID_KEY] != uid: # set the uid expiration
+                _uid = session[self.UID_KEY]
+                if self.backend.has(_uid):
+                    self.__set_expiration__(_uid, expiry)
+            if self.SID_KEY in session: # this uid is a uid (which also holds a copy of itself as UID_KEY), set sid expiration
                 sid = session[self.SID_KEY]
-                if sid in self.session:
-                    self.session[sid][self.expire_key] = expiry
+                if self.backend.has(sid):
+                    self.__set_expiration__(sid, expiry)
+
+    def __estimate_size__(self, uid, key, value)->int:
+        # bytes held in memory by a spillable value
+        if value is None or isinstance(value, (spilled_item, spilled_texts)) or value is self.__mapped__.get(uid, None):
+            return 0 # on disk, or mmap-ed from disk
+        if key == self.FAISS_KEY:
+            code_size = getattr(value, 'code_size', value.d * 4) # flat index, d float32 per vector
+            return int(value.ntotal * code_size)
+        if key == self.FAISS_TEXTS:
+            return sum(sys.getsizeof(text) for text in value)
+        return 0
+
+    def __spill_paths__(self, uid:str)->tuple[str, str, str]:
+        folder = self.file_mgr.construct_file_folder(uuid=uid) # under the uid upload folder, so that file cleanup removes it too
+        return os.path.join(folder, self.SPILL_INDEX_FILE), os.path.join(folder, self.SPILL_TEXTS_FILE), os.path.join(folder, self.SPILL_OFFSETS_FILE)
+
+    def __account__(self, uid:str):
+        # recompute the memory held by uid, and mark it as the most recently used
+        session = self.backend.get(uid)
+        size = 0
+        if session:
+            for key in self.SPILL_KEYS:
+                size += self.__estimate_size__(uid, key, session.get(key, None))
+        self.memory_usage -= self.__memory_lru__.pop(uid, 0)
+        if size > 0:
+            self.__memory_lru__[uid] = size
+            self.memory_usage += size
+
+    def __spill_value__(self, uid:str, key:str, value)->spilled_item:
+        # write a FAISS index or texts to disk, output the placeholder
+        #   write to a temp file then replace, so that a running request still mapping the old file is not affected
+        index_path, texts_path, offsets_path = self.__spill_paths__(uid)
+        if key == self.FAISS_KEY:
+            faiss.write_index(value, index_path + '.tmp')
+            os.replace(index_path + '.tmp', index_path)
+            return spilled_item([index_path])
+        spilled_texts.write(value, texts_path + '.tmp', offsets_path + '.tmp')
+        os.replace(texts_path + '.tmp', texts_path)
+        os.replace(offsets_path + '.tmp', offsets_path)
+        return spilled_item([texts_path, offsets_path])
+
+    def __spill__(self, uid:str):
+        # write uid's FAISS index and texts to disk, and replace them with placeholders
+        session = self.backend.get(uid)
+        if not session:
+            return
+        index = session.get(self.FAISS_KEY, None)
+        if index is not None and not isinstance(index, spilled_item) and index is not self.__mapped__.get(uid, None):
+            self.backend.set_key(uid, self.FAISS_KEY, self.__spill_value__(uid, self.FAISS_KEY, index))
+        texts = session.get(self.FAISS_TEXTS, None)
+        if texts is not None and not isinstance(texts, (spilled_item, spilled_texts)):
+            self.backend.set_key(uid, self.FAISS_TEXTS, self.__spill_value__(uid, self.FAISS_TEXTS, texts))
+        logging.debug(f"session manager: spilled {self.__memory_lru__.get(uid, 0)} bytes of session {uid} to disk.")
+        self.__account__(uid)
+
+    def __enforce_memory_budget__(self, keep_uid:str=None):
+        # spill least-recently-used sessions till the budget is met, never the one being used now
+        if self.memory_budget <= 0:
+            return
+        for uid in list(self.__memory_lru__.keys()):
+            if self.memory_usage <= self.memory_budget:
+                break
+            if uid == keep_uid:
+                continue
+            try:
+                self.__spill__(uid)
+            except Exception as e:
+                logging.error(f"session manager: failed to spill session {uid}. {e}")
+
+    def __load_spilled__(self, uid:str, key:str, item:spilled_item):
+        # reload a spilled value via mmap
+        if self.backend.SHARED: # the placeholder stays in the shared store, keep the loaded value in this process
+            loaded = self.__loaded__.get((uid, key), None)
+            if loaded is not None and loaded[0] == item.stamp:
+                return loaded[1]
+        if key == self.FAISS_KEY:
+            mmap_flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) # zero-copy for flat indexes if supported
+            value = faiss.read_index(item.paths[0], mmap_flag)
+            self.__mapped__[uid] = value
+        else:
+            value = spilled_texts(item.paths[0], item.paths[1])
+        if self.backend.SHARED:
+            self.__loaded__[(uid, key)] = (item.stamp, value)
+        else:
+            self.backend.set_key(uid, key, value)
+        return value
+
+    def __release_memory__(self, uid:str):
+        # drop accounting of uid. mmap-ed texts close when no running request holds them, spilled files are removed along with the uid upload folder
+        self.__mapped__.pop(uid, None)
+        for key in self.SPILL_KEYS:
+            self.__loaded__.pop((uid, key), None)
+        self.memory_usage -= self.__memory_lru__.pop(uid, 0)
 
-    def cleanup_expired_sessions(self):
-        current_time = datetime.now()
-        for k, v in list(self.session.items()): # k is id, v is {}, copy to a list to loop
-            if self.expire_key in v and v[self.expire_key] < current_time:
-                self.remove_session_sid(k) # use remove sid to remove, this can remove both sid and uid
-                self.file_mgr.delete_file_remove_path_from_db(k)
-                self.chat_mgr.delete_chat_history(k)
+    def cleanup_expired_sessions(self)->list[str]:
+        """
+        pop expired ids from the heap, O(expired) instead of scanning all sessions
+        files and chat history of the expired sessions are removed by the background worker
+        output: the expired uids
+        """
+        current_time = time.time()
+        expired = []
+        heap = self.__expiry_heap__
+        while True:
+            with self.__expiry_lock__: # not held while the session is checked and removed
+                if len(heap) == 0 or heap[0][0] >= current_time:
+                    break
+                _, k = heapq.heappop(heap)
+                self.__in_heap__.discard(k)
+            v = self.backend.get(k)
+            if v is None: # removed already, or by another worker, stale entry
+                continue
+            expiry = self.backend.get_expiry(k)
+            if expiry is None:
+                continue
+            if expiry >= current_time: # renewed after it was pushed, push back
+                with self.__expiry_lock__:
+                    if k not in self.__in_heap__: # else, pushed by a renewal since it popped
+                        heapq.heappush(heap, (expiry, k))
+                        self.__in_heap__.add(k)
+                continue
+            uid = v.get(self.UID_KEY, k) # the uid owns the files and chat history
+            self.remove_session_sid(k) # use remove sid to remove, this can remove both sid and uid
+            expired.append(uid)
+            self.schedule_cleanup(uid)
+        return expired
+
+    def schedule_cleanup(self, uid:str):
+        """
+        remove files and chat history of uid in the background worker
+        """
+        if not uid:
+            return
+        if self.__cleanup_worker__ is None or not self.__cleanup_worker__.is_alive():
+            self.__cleanup_worker__ = Thread(target=self.__cleanup_worker_proc__, daemon=True)
+            self.__cleanup_worker__.start()
+        self.__cleanup_queue__.put(uid)
+
+    def __cleanup_worker_proc__(self):
+        while True:
+            uid = self.__cleanup_queue__.get()
+            try:
+                if uid is None: # stop
+                    return
+                self.file_mgr.delete_file_remove_path_from_db(uid)
+                self.chat_mgr.delete_chat_history(uid)
+            except:
+                logging.error(f"session manager: cleanup of {uid} failed. {traceback.format_exc()}")
+            finally:
+                self.__cleanup_queue__.task_done()
+
+    def close(self, timeout=None):
+        """
+        finish pending cleanups and stop the background worker
+        """
+        if self.__cleanup_worker__ is not None and self.__cleanup_worker__.is_alive():
+            self.__cleanup_queue__.put(None)
+            self.__cleanup_worker__.join(timeout)
+        self.__cleanup_worker__ = None
 
     def set_session_sid(self, sid:str, uid:str):
         # set sid, along with uid, so that these two can cross reference
-        if not sid in self.session:
-            self.session[sid] = {
-                self.UID_KEY: uid,
-            }
-        if not uid in self.session:
-            self.session[uid] = {
-                self.SID_KEY: sid, # a copy of sid
-                self.UID_KEY: uid, # a copy of self uid
-            }
+        self.backend.create(sid, {
+            self.UID_KEY: uid,
+        })
+        self.backend.create(uid, {
+            self.SID_KEY: sid, # a copy of sid
+            self.UID_KEY: uid, # a copy of self uid
+        })
         self.__renew_expiration__(sid) # set exipration
 
     def remove_session_sid(self, sid:str):
-        session = self.session[sid] if sid in self.session else None
+        session = self.backend.get(sid)
         if session:
-            if self.UID_KEY in session: # remove uid associated with this sid
-                uid = session[self.UID_KEY]
-                self.session.pop(uid, None)
-            self.session.pop(sid, None) # remove this sid
+            with self.__memory_lock__:
+                if self.UID_KEY in session: # remove uid associated with this sid
+                    uid = session[self.UID_KEY]
+                    self.__release_memory__(uid)
+                    self.backend.remove(uid)
+                self.__release_memory__(sid)
+                self.backend.remove(sid) # remove this sid
 
     def remove_session(self, uid:str):
-        self.session.pop(uid, None)
+        with self.__memory_lock__:
+            self.__release_memory__(uid)
+            self.backend.remove(uid)
 
     def get_session_all(self, uid:str):
-        session = None
-        if uid in self.session:
-            session = self.session[uid]
+        session = self.backend.get(uid)
+        if session is not None:
             self.__renew_expiration__(uid) # renew expiration
         return session
     def get_session_key(self, uid:str, key:str):
-        session = None
-        if uid in self.session and key in self.session[uid]:
-            session = self.session[uid][key]
+        session = self.backend.get_key(uid, key)
+        if session is not None:
+            if key in self.SPILL_KEYS:
+                with self.__memory_lock__:
+                    if isinstance(session, spilled_item): # spilled to disk, load it back
+                        session = self.__load_spilled__(uid, key, session)
+                    if uid in self.__memory_lru__:
+                        self.__memory_lru__.move_to_end(uid) # most recently used
             self.__renew_expiration__(uid)
         return session
 
     def set_session(self, uid, key, value):
-        if uid not in self.session:
-            self.session[uid] = {
-                self.UID_KEY: uid, # a copy of self always uid:{UID: uid...}
-            }
-        session = self.session[uid]
-        session[key] = value
+        self.backend.create(uid, {
+            self.UID_KEY: uid, # a copy of self always uid:{UID: uid...}
+        })
+        if key in self.SPILL_KEYS and self.backend.SHARED and value is not None:
+            # shared, spill right away so that any worker can load it
+            with self.__memory_lock__:
+                value = self.__spill_value__(uid, key, value)
+                self.backend.set_key(uid, key, value)
+            self.__renew_expiration__(uid)
+            return
+        self.backend.set_key(uid, key, value)
+        if key in self.SPILL_KEYS:
+            with self.__memory_lock__:
+                if key == self.FAISS_KEY and value is not self.__mapped__.get(uid, None):
+                    self.__mapped__.pop(uid, None) # a new index in memory
+                self.__account__(uid)
+                self.__enforce_memory_budget__(keep_uid=uid)
         self.__renew_expiration__(uid)
 
     def cross_check_uid_in_session(self, uid:str)->bool:
         is_same = False
-        if uid in self.session:
-            session = self.session[uid]                    
-            if self.UID_KEY in session:
-                if (uid == session[self.UID_KEY]): # uid match, now continue to check user login
-                    is_same = True
-        return is_same
\ No newline at end of file
+        session_uid = self.backend.get_key(uid, self.UID_KEY)
+        if session_uid is not None:
+            if (uid == session_uid): # uid match, now continue to check user login
+                is_same = True
+        return is_same
+
+    def new_continue_flag(self, uid:str)->llm_continue:
+        """
+        a continue flag for uid, set it to the session by CONTINUE_KEY
+        """
+        return self.backend.new_continue_flag(uid)
\ No newline at end of file
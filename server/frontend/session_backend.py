@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+"""
+    session backends - in-memory for a single process, shared file store for multiple uvicorn workers
+    Author: awtestergit
+"""
+import os
+import fcntl
+import pickle
+import hashlib
+from threading import Lock
+from interface.interface_session import ISessionBackend
+from interface.interface_model import llm_continue
+
+class MemorySessionBackend(ISessionBackend):
+    """
+    sessions held in a dict of this process, the default
+    """
+    SHARED = False
+    def __init__(self, expire_key="SESSION_EXPIRATION") -> None:
+        self.expire_key = expire_key
+        self.session = {} # {'sid1: {'uid':uid1, EXPIRE:xx}, 'uid1': {sid:sid1, EXPIRE:xx}, 'uid2':{}...}
+
+    def has(self, id:str)->bool:
+        return id in self.session
+
+    def get(self, id:str)->dict:
+        return self.session.get(id, None)
+
+    def get_key(self, id:str, key:str, default=None):
+        session = self.session.get(id, None)
+        return session.get(key, default) if session is not None else default
+
+    def create(self, id:str, values:dict)->bool:
+        if id in self.session:
+            return False
+        self.session[id] = values
+        return True
+
+    def set_key(self, id:str, key:str, value):
+        self.session[id][key] = value
+
+    def remove(self, id:str):
+        self.session.pop(id, None)
+
+    def set_expiry(self, id:str, expiry:float):
+        self.session[id][self.expire_key] = expiry
+
+    def get_expiry(self, id:str)->float:
+        return self.get_key(id, self.expire_key)
+
+class shared_llm_continue(llm_continue):
+    """
+    continue flag shared by worker processes through a stop file
+        the stop file exists while the flag is stopped, so /stop handled by any worker reaches the one generating
+    """
+    def __init__(self, stop_path:str) -> None:
+        super().__init__()
+        self.stop_path = stop_path
+
+    def check_continue_flag(self, timeout=0.5):
+        # sync the local event to the stop file, then check as usual
+        if os.path.exists(self.stop_path):
+            self.__exit_event__.clear()
+        else:
+            self.__exit_event__.set()
+        return super().check_continue_flag(timeout)
+
+    def set_stop_flag(self):
+        with open(self.stop_path, 'w'):
+            pass
+        super().set_stop_flag()
+
+    def reset_stop_flag(self):
+        try:
+            os.remove(self.stop_path)
+        except FileNotFoundError:
+            pass
+        super().reset_stop_flag()
+
+class SharedFileSessionBackend(ISessionBackend):
+    """
+    sessions stored in a folder shared by all worker processes on the host
+        <folder>/<hash>.session: pickled key/values, replaced atomically under a per-id file lock
+        <folder>/<hash>.expiry: empty file, its mtime is the expiry, so renewal does not rewrite the session
+        <folder>/<hash>.stop: exists while the continue flag is stopped
+    reads are cached per process and validated by the session file's mtime/size
+    """
+    SHARED = True
+    CONTINUE_MARK = '__shared_llm_continue__' # stored in place of llm_continue objects
+
+    def __init__(self, folder:str) -> None:
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.__cache__ = {} # {id: (mtime_ns, size, values)}
+        self.__flags__ = {} # {id: shared_llm_continue}, local flag objects bound to the stop file
+        self.__cache_lock__ = Lock()
+
+    def __path__(self, id:str, suffix:str)->str:
+        name = hashlib.sha1(id.encode(errors='ignore')).hexdigest()
+        return os.path.join(self.folder, f"{name}.{suffix}")
+
+    def __read__(self, id:str)->dict:
+        path = self.__path__(id, 'session')
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            with self.__cache_lock__:
+                self.__cache__.pop(id, None)
+            return None
+        with self.__cache_lock__:
+            cached = self.__cache__.get(id, None)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        try:
+            with open(path, 'rb') as f:
+                values = pickle.load(f)
+        except (FileNotFoundError, EOFError):
+            return None
+        with self.__cache_lock__:
+            self.__cache__[id] = (stat.st_mtime_ns, stat.st_size, values)
+        return values
+
+    def __write__(self, id:str, values:dict):
+        path = self.__path__(id, 'session')
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def __update__(self, id:str, update, create_only=False)->bool:
+        # read-modify-write under the per-id file lock
+        with open(self.__path__(id, 'lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                values = self.__read__(id)
+                if create_only and values is not None:
+                    return False
+                values = dict(values) if values is not None else {}
+                update(values)
+                self.__write__(id, values)
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def has(self, id:str)->bool:
+        return os.path.exists(self.__path__(id, 'session'))
+
+    def get(self, id:str)->dict:
+        values = self.__read__(id)
+        if values is None:
+            return None
+        return {key: self.__restore__(id, value) for key, value in values.items()}
+
+    def get_key(self, id:str, key:str, default=None):
+        values = self.__read__(id)
+        if values is None or key not in values:
+            return default
+        return self.__restore__(id, values[key])
+
+    def __restore__(self, id:str, value):
+        if isinstance(value, str) and value == self.CONTINUE_MARK:
+            flag = self.__flags__.get(id, None)
+            if flag is None:
+                flag = self.new_continue_flag(id)
+            return flag
+        return value
+
+    def __store__(self, id:str, value):
+        if isinstance(value, llm_continue): # flags are bound to the stop file, keep the object local
+            if not isinstance(value, shared_llm_continue):
+                value = self.new_continue_flag(id)
+            self.__flags__[id] = value
+            return self.CONTINUE_MARK
+        return value
+
+    def create(self, id:str, values:dict)->bool:
+        values = {key: self.__store__(id, value) for key, value in values.items()}
+        return self.__update__(id, lambda v: v.update(values), create_only=True)
+
+    def set_key(self, id:str, key:str, value):
+        value = self.__store__(id, value)
+        def update(values):
+            values[key] = value
+        self.__update__(id, update)
+
+    def remove(self, id:str):
+        for suffix in ('session', 'expiry', 'stop', 'lock'):
+            try:
+                os.remove(self.__path__(id, suffix))
+            except FileNotFoundError:
+                pass
+        with self.__cache_lock__:
+            self.__cache__.pop(id, None)
+        self.__flags__.pop(id, None)
+
+    def set_expiry(self, id:str, expiry:float):
+        path = self.__path__(id, 'expiry')
+        try:
+            os.utime(path, (expiry, expiry))
+        except FileNotFoundError:
+            with open(path, 'w'):
+                pass
+            os.utime(path, (expiry, expiry))
+
+    def get_expiry(self, id:str)->float:
+        try:
+            return os.stat(self.__path__(id, 'expiry')).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def new_continue_flag(self, id:str)->llm_continue:
+        flag = shared_llm_continue(self.__path__(id, 'stop'))
+        self.__flags__[id] = flag
+        return flag
@@ -7,7 +7,11 @@
 
 import json
 import numpy
-from typing import Iterator
+import asyncio
+from typing import Iterator, AsyncIterator
+from anbutils import text_chunker
+from anbutils.response_cache import llm_response_cache, cache_key
+from anbutils import single_flight
 
 """
 IBaseModel, interface to wrap model
@@ -35,9 +39,44 @@ class IEmbeddingModel(IBaseModel):
     ### embedding model
     EMBED_SIZE = 1024 # embedding size of the model
     MAX_LENGTH = 8000 # max seq length, openai 8192
+    MAX_TOKENS = 8192 # max input tokens
+    CHUNK_TOKENS = 512 # tokens of a retrieval chunk, chunks are sized to it, so the top chunks fit the llm prompt
+    def count_tokens(self, text:str)->int:
+        # estimated by default, models with a known tokenizer override
+        return text_chunker.estimate_tokens(text)
+
+    def __coalesced_encode__(self, inputs, to_list:bool, compute):
+        # identical encodes in flight share one call
+        key = cache_key(type(self).__name__, getattr(self, 'model', ''), self.EMBED_SIZE, inputs, to_list)
+        return single_flight.calls.do(key, compute)
+
+    async def __acoalesced_encode__(self, inputs, to_list:bool, compute):
+        # identical async encodes in flight share one call, compute is a coroutine function
+        key = cache_key(type(self).__name__, getattr(self, 'model', ''), self.EMBED_SIZE, inputs, to_list)
+        return await single_flight.acalls.do(key, compute)
+
     def encode(self, inputs, to_list:bool=False, *args):
         raise NotImplementedError("ILanguageModel base class encode")
 
+    async def aencode(self, inputs, to_list:bool=False):
+        # models without an async client encode in a thread
+        return await asyncio.to_thread(self.encode, inputs, to_list)
+
+    async def aencode_batch(self, inputs:list, to_list:bool=False):
+        """
+        inputs: a list of strings, encoded concurrently
+        output: 2d shape (len(inputs), embed_size), or a list of embeddings if to_list
+        """
+        outputs = await asyncio.gather(*[self.aencode(text, to_list) for text in inputs])
+        return list(outputs) if to_list else numpy.vstack(outputs)
+
+    def warmup(self):
+        # loads the model at startup, models served remotely on demand need none
+        pass
+
+    async def aclose(self):
+        pass
+
 """
 ILanguageModel, interface to wrap model
 """
@@ -46,6 +85,77 @@ class ILanguageModel(IBaseModel):
         self.MAX_LENGTH = max_context_length # max token lengths
         self.TOKEN_EX = token_ex # 
         self.seed = seed
+        self.response_cache = None # cache of non-streaming chat/generate answers, if set
+
+    def set_response_cache(self, cache:llm_response_cache):
+        self.response_cache = cache
+
+    def __cached_answer__(self, messages:list, options:dict, compute, use_cache=True)->str:
+        """
+        the answer to messages with options from the response cache, else compute() and cache it
+        use_cache: if False, bypass the cache
+        """
+        key = cache_key(type(self).__name__, getattr(self, 'model', ''), messages, options)
+        use_cache = use_cache and self.response_cache is not None
+        if use_cache:
+            answer = self.response_cache.get(key)
+            if answer is not None:
+                return answer
+        answer = single_flight.calls.do(key, compute) # identical calls in flight share one answer
+        if use_cache and len(answer) > 0: # not an empty answer, e.g., stopped
+            self.response_cache.put(key, answer)
+        return answer
+
+    def __shared_stream__(self, messages:list, options:dict, make_stream, continue_flag=None, **key_parts)->Iterator:
+        """
+        the stream of make_stream(), shared with identical streams in flight
+        continue_flag: stops this stream only, the backend stream stops when no stream is reading it
+        key_parts: what else makes the stream output differ, e.g., splitter
+        """
+        key = cache_key(type(self).__name__, getattr(self, 'model', ''), messages, options, key_parts)
+        check = None
+        if continue_flag is not None:
+            def check():
+                if not continue_flag.check_continue_flag():
+                    raise ContinueExit()
+        return single_flight.streams.subscribe(key, make_stream, check)
+
+    async def __acached_answer__(self, messages:list, options:dict, compute, use_cache=True)->str:
+        """
+        __cached_answer__ of a coroutine function compute
+        """
+        key = cache_key(type(self).__name__, getattr(self, 'model', ''), messages, options)
+        use_cache = use_cache and self.response_cache is not None
+        if use_cache:
+            answer = self.response_cache.get(key)
+            if answer is not None:
+                return answer
+        answer = await single_flight.acalls.do(key, compute)
+        if use_cache and len(answer) > 0:
+            self.response_cache.put(key, answer)
+        return answer
+
+    def __ashared_stream__(self, messages:list, options:dict, make_stream, continue_flag=None, **key_parts)->AsyncIterator:
+        """
+        __shared_stream__ of an async stream, make_stream() returns an async generator
+        """
+        key = cache_key(type(self).__name__, getattr(self, 'model', ''), messages, options, key_parts)
+        check = None
+        if continue_flag is not None:
+            def check():
+                if not continue_flag.check_continue_flag(timeout=0): # never block the event loop
+                    raise ContinueExit()
+        return single_flight.astreams.subscribe(key, make_stream, check)
+
+    def count_tokens(self, text:str)->int:
+        # estimated by default, models with a known tokenizer override
+        return text_chunker.estimate_tokens(text)
+
+    def prompt_budget(self, max_new_tokens:int)->int:
+        """
+        max tokens of the prompt messages when max_new_tokens are to be generated
+        """
+        return self.MAX_LENGTH - max_new_tokens
 
     def generate(self, inputs, splitter='', stop=[], replace_stop=True, **kwargs):
         raise NotImplementedError("ILanguageModel base class generate")
@@ -59,6 +169,23 @@ class ILanguageModel(IBaseModel):
     def stream_chat(self, inputs, history=[], splitter='', stop=[], replace_stop=True, output_delta=False, **kwargs):
         raise NotImplementedError("ILanguageModel base class stream chat")
 
+    async def achat(self, inputs, history=[], splitter='', stop=[], replace_stop=True, **kwargs):
+        # models without an async client chat in a thread
+        return await asyncio.to_thread(self.chat, inputs, history=history, splitter=splitter, stop=stop, replace_stop=replace_stop, **kwargs)
+
+    async def astream_chat(self, inputs, history=[], splitter='', stop=[], replace_stop=True, output_delta=False, **kwargs):
+        # models without an async client stream in a thread, one step at a time
+        stream = self.stream_chat(inputs, history=history, splitter=splitter, stop=stop, replace_stop=replace_stop, output_delta=output_delta, **kwargs)
+        async for text in iterate_in_thread(stream):
+            yield text
+
+    def warmup(self):
+        # loads the model at startup, models served remotely on demand need none
+        pass
+
+    async def aclose(self):
+        pass
+
     def __construct_chat_message__(self, inputs:str, system_prompt:str, assistant_prompt:str, history:list)->list:
         # 1. construct system prompt
         # 2. construct history
@@ -185,3 +312,79 @@ class llm_continue():
 
 class ContinueExit(Exception):
     pass
+
+async def iterate_in_thread(iterator:Iterator)->AsyncIterator:
+    """
+    the items of a blocking iterator, each next() runs in a thread
+        if cancelled while a next() is running, the thread closes the iterator once the next() returns
+    """
+    done = object()
+    lock = Lock()
+    state = {'pending': False, 'closed': False} # a next() is running in a thread, the iterator is left
+    def step():
+        try:
+            return next(iterator, done)
+        finally:
+            with lock:
+                state['pending'] = False
+                closed = state['closed']
+            if closed and hasattr(iterator, 'close'):
+                iterator.close()
+    try:
+        while True:
+            state['pending'] = True
+            item = await asyncio.to_thread(step)
+            if item is done:
+                return
+            yield item
+    finally:
+        with lock:
+            state['closed'] = True
+            pending = state['pending']
+        if not pending and hasattr(iterator, 'close'): # else the thread is still in the iterator, and closes it
+            await asyncio.to_thread(iterator.close)
+
+async def aiterate_ticks(items, timeout)->AsyncIterator:
+    """
+    the items of aiterate(items), and None whenever timeout() seconds pass without an item
+    timeout: ()->seconds, None waits for the next item without a tick
+    """
+    iterator = aiterate(items)
+    pending = None # the next item, awaited across ticks
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=timeout())
+            if len(done) == 0:
+                yield None
+                continue
+            task, pending = pending, None
+            try:
+                item = task.result()
+            except StopAsyncIteration:
+                return
+            yield item
+    finally:
+        if pending is not None: # stopped between items
+            pending.cancel()
+            try:
+                await pending
+            except BaseException:
+                pass
+        await iterator.aclose()
+
+async def aiterate(items)->AsyncIterator:
+    """
+    the items of an async iterator, or of a plain iterable, e.g., a list of one answer
+    """
+    if not hasattr(items, '__aiter__'):
+        for item in items:
+            yield item
+        return
+    try:
+        async for item in items:
+            yield item
+    finally:
+        if hasattr(items, 'aclose'):
+            await items.aclose()
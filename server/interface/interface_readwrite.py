@@ -7,10 +7,20 @@
 
 
 import os, io
+import re
+import mmap
+import codecs
 from typing import Iterator
-from interface.interface_model import llm_continue
+from functools import lru_cache
+from interface.interface_model import llm_continue, ContinueExit
 from anbutils import utilities
 
+@lru_cache(maxsize=32)
+def compile_marks(remove_mark:tuple):
+    # longest first, so a mark is not shadowed by its prefix
+    marks = sorted(set(mark for mark in remove_mark if len(mark) > 0), key=len, reverse=True)
+    return re.compile('|'.join(re.escape(mark) for mark in marks)) if len(marks) > 0 else None
+
 
 """
 IDocReaderWriter
@@ -46,11 +56,24 @@ class IDocReaderWriter():
     
     def __remove_newline_from_text__(self, text:str)->str:
         # remove the \n in the text
-        texts = text.split('\n')
-        text = ''
-        for t in texts:
-            text += t
-        return text
+        return text.replace('\n', '')
+
+    def __mark_pattern__(self, remove_mark=[]):
+        """
+        remove_mark compiled into one regex, None if no marks
+        """
+        return compile_marks(tuple(remove_mark)) if len(remove_mark) > 0 else None
+
+    def __clean_text__(self, text:str, mark_pattern=None, strip=True)->str:
+        """
+        strip + remove marks + remove newline in one pass over text
+        mark_pattern: from __mark_pattern__
+        output: None if text has a mark, as the whole line is removed at mark
+        """
+        if mark_pattern is not None and mark_pattern.search(text) is not None:
+            return None
+        text = text.replace('\n', '')
+        return text.strip() if strip else text
 
     def construct_paragraph(self, texts:list, lang='en')->list:
         """
@@ -63,36 +86,20 @@ class IDocReaderWriter():
 
         # every paragraph is assumed to end with '.' or '。' (en or zh)
         result = []
-        current = '' # buffer
+        current = [] # buffer, joined at the end of paragraph
         
+        end = {'.', '。', ':', '：'} # must be multi-lingual
         def is_end_of_paragraph(text):
-            end = ['.', '。', ':', '：'] # must be multi-lingual
             return text[-1] in end
         
         for text in texts:
             # remove leading/trailing spaces
             text = text.strip()
             if len(text)>0:
-                is_end = is_end_of_paragraph(text[-1])
-                if not is_end:
-                    current += text
-                else:
-                    current += text
-                    result.append(current)
-                    current = ''
-                """
-                if len(text) < min_length and not is_end: # if shorter than min but not end with '.', treat as a paragraph
-                    if len(current) > 0: # who knows if some doc is weird
-                        result.append(current)
-                        current = ''
-                    result.append(text)
-                elif is_end:
-                    current += text
-                    result.append(current)
-                    current = '' # reset
-                else:
-                    current += text
-                """
+                current.append(text)
+                if is_end_of_paragraph(text):
+                    result.append(''.join(current))
+                    current = []
 
         return result
     
@@ -136,26 +143,26 @@ class IDocReaderWriter():
 
         return output_stream(outputs, streaming=streaming)
 
-    def read_doc_to_texts_with_source(self, doc_path:str|bytes, start_page:int=0, end_page:int=-1, remove_mark=[], reconstruct_paragraph_at_pagebreak=True, strip=True, read_by=0, continue_flag:llm_continue=None, lang='en')-> list[str, str]:
+    def read_doc_to_texts_with_source(self, doc_path:str|bytes, start_page:int=0, end_page:int=-1, remove_mark=[], reconstruct_paragraph_at_pagebreak=True, strip=True, read_by=0, continue_flag:llm_continue=None, lang='en')-> Iterator:
         """
         doc_path: full path of the document to read
         remove_mark: the marks (texts) to be removed, note: the whole line will be removed at mark
         reconstruct_paragraph_at_pagebreak: to construct each paragraph at page break, if True
         strip: strip texts
         read_by: 0: page, 1: document, 2: paragraph
-        output: [(text, page_xx), ()...]
+        output: a generator of [text, page_xx], as the document is read, e.g., into text_chunker.iter_chunks
+            read by paragraph reads the whole document first to reconstruct paragraphs
         """
         if read_by == 0: # by page
-            outputs = self.read_doc_to_texts_by_page(doc_path=doc_path, start_page=start_page, end_page=end_page, remove_mark=remove_mark, streaming=False, continue_flag=continue_flag)
+            outputs = self.read_doc_to_texts_by_page(doc_path=doc_path, start_page=start_page, end_page=end_page, remove_mark=remove_mark, streaming=True, continue_flag=continue_flag)
         else:
-            outputs = self.read_doc_to_texts_by_block(doc_path=doc_path, start_page=start_page, end_page=end_page, remove_mark=remove_mark, reconstruct_paragraph_at_pagebreak=reconstruct_paragraph_at_pagebreak, strip=strip, read_by=read_by, streaming=False, continue_flag=continue_flag)
+            outputs = self.read_doc_to_texts_by_block(doc_path=doc_path, start_page=start_page, end_page=end_page, remove_mark=remove_mark, reconstruct_paragraph_at_pagebreak=reconstruct_paragraph_at_pagebreak, strip=strip, read_by=read_by, streaming=True, continue_flag=continue_flag)
 
         # outputs is a generator, regardless of 'streaming'
-        # reconstruct paragraph
         #outputs: [['xxxx', 'page_'], ['yyyy', 'page_']...]
-        outputs = [output for output in outputs] # read from the generator
-        if read_by==2: # if read by paragraph
-            outputs = self.construct_paragraph(outputs, lang)
+        if read_by==2: # if read by paragraph, reconstruct paragraph
+            outputs = self.construct_paragraph([output for output in outputs], lang)
+            return iter(outputs)
 
         return outputs
         
@@ -198,48 +205,193 @@ class IDocReaderWriter():
         return utilities.break_long_texts_into_chunks(texts=texts, chuck_size=chuck_size, overlap=overlap)
 
 class TextReaderWriter(IDocReaderWriter):
-    def __init__(self) -> None:
+    """
+    plain text, read as a stream from a mmap of the file, so large files are not held in memory
+        page: blocks of about page_size characters, cut at line ends
+        paragraph: lines delimited by blank lines
+    encoding: if None, detected from the BOM, else the first of encodings that decodes the head of the file
+    """
+    TYPE = 'txt'
+    ENCODINGS = ['utf-8', 'gb18030', 'big5', 'latin-1'] # candidates to detect, latin-1 decodes anything
+    BOMS = [(codecs.BOM_UTF32_LE, 'utf-32'), (codecs.BOM_UTF32_BE, 'utf-32'), (codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16')]
+    def __init__(self, encoding:str=None, encodings:list[str]=None, page_size=4096, read_size=1024*1024, detect_size=64*1024) -> None:
         super().__init__()
+        self.type = self.TYPE
+        self.encoding = encoding
+        self.encodings = encodings if encodings is not None else self.ENCODINGS
+        self.page_size = page_size # characters per page
+        self.read_size = read_size # bytes decoded at a time
+        self.detect_size = detect_size # bytes to detect the encoding
 
-    def read_doc_to_texts(self, doc_path: str|bytes, start_page:int=0, end_page:int=-1, remove_mark=[]) -> list[str]:
+    def __detect_encoding__(self, data)->str:
+        if self.encoding is not None:
+            return self.encoding
+        head = bytes(data[:self.detect_size])
+        for bom, encoding in self.BOMS: # utf-32 before utf-16, same BOM prefix
+            if head.startswith(bom):
+                return encoding
+        for encoding in self.encodings:
+            try:
+                # final=False, the head may end in the middle of a character
+                codecs.getincrementaldecoder(encoding)().decode(head, final=False)
+                return encoding
+            except (UnicodeDecodeError, LookupError):
+                continue
+        return 'latin-1'
+
+    def __iter_lines__(self, doc_path:str|bytes, continue_flag:llm_continue=None):
         """
-        read full texts from document
-        ignoring start and end page as there are no pages per se
+        output: a generator of (1-based line number, line) decoded incrementally, without line ends
+            a line longer than page_size is yielded in pieces of page_size characters, with the same line number
         """
-        output = []
+        file, data = None, None
+        try:
+            if type(doc_path) is bytes:
+                data = memoryview(doc_path)
+            else:
+                file = open(doc_path, 'rb')
+                size = os.fstat(file.fileno()).st_size
+                if size == 0:
+                    return
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            encoding = self.__detect_encoding__(data)
+            decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+            carry = '' # partial line of the previous read
+            partial = False # carry continues a line already partly yielded
+            line_no = 0
+            size = len(data)
+            for offset in range(0, size, self.read_size):
+                # check continue
+                if continue_flag:
+                    cf = continue_flag.check_continue_flag()
+                    if not cf:
+                        raise ContinueExit('text read exit.')
+                final = offset+self.read_size >= size
+                text = decoder.decode(data[offset:offset+self.read_size], final=final)
+                if len(text) == 0:
+                    continue
+                text = carry + text
+                lines = text.splitlines()
+                if not final and text.endswith('\r'): # may be the first half of a '\r\n' split across reads, keep it
+                    carry = lines.pop() + '\r'
+                elif not text.endswith(('\n', '\r')) and len(lines) > 0:
+                    carry = lines.pop()
+                else:
+                    carry = ''
+                for line in lines:
+                    line_no += 0 if partial else 1
+                    partial = False
+                    yield line_no, line
+                while len(carry.rstrip('\r')) > self.page_size: # a long line, or no line ends, is not rescanned at every read
+                    line_no += 0 if partial else 1
+                    partial = True
+                    yield line_no, carry[:self.page_size]
+                    carry = carry[self.page_size:]
+            carry = carry.rstrip('\r') # the last read is final, no '\r' is kept, but for safety
+            if len(carry) > 0:
+                line_no += 0 if partial else 1
+                yield line_no, carry
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+            elif isinstance(data, memoryview):
+                data.release()
+            if file is not None:
+                file.close()
 
+    def read_doc_to_texts_by_page(self, doc_path:str|bytes, start_page:int=0, end_page:int=-1, remove_mark=[], streaming=False, continue_flag:llm_continue=None):
+        """
+        read texts by pages of about page_size characters, empty lines are skipped
+        output: a generator regardless of streaming, of [text, 'page_n'], n from 0
+        """
         valid = self.__validate_doc_type__(doc_path=doc_path)
         if not valid:
-            raise ValueError(f"DocReaderWriter read document failed. It does not exist! File: {doc_path}")
-        else:
-            # read file. if bytes, use stringIO with decode
-            with io.StringIO(doc_path.decode()) if type(doc_path) is bytes else open(doc_path, 'r') as file:
-                for line in file:
-                    line = line.strip()
-                    if len(line) > 0:
-                        output.append(line)
-
-        return output
+            raise ValueError(f"TextReaderWriter read document failed. It does not exist! File: {doc_path}")
+        start = start_page - 1 if start_page > 0 else 0
+        result = []
+        lines, length, page = [], 0, 0
+        mark_pattern = self.__mark_pattern__(remove_mark)
+        def page_content():
+            return ['\n'.join(lines), f"page_{page}"]
+        for _, line in self.__iter_lines__(doc_path, continue_flag=continue_flag):
+            line = self.__clean_text__(line, mark_pattern)
+            if line is None or len(line) == 0:
+                continue
+            lines.append(line)
+            length += len(line) + 1
+            if length >= self.page_size:
+                if page >= start:
+                    if streaming:
+                        yield page_content()
+                    else:
+                        result.append(page_content())
+                page += 1
+                lines, length = [], 0
+                if end_page >= 0 and page >= end_page:
+                    break
+        if len(lines) > 0 and page >= start and (end_page < 0 or page < end_page):
+            if streaming:
+                yield page_content()
+            else:
+                result.append(page_content())
+        if not streaming:
+            yield from result
 
-    def read_doc_to_texts_with_source(self, doc_path: str | bytes, start_page: int = 0, end_page: int = -1, remove_mark=[]) -> list[str]:
+    def read_doc_to_texts_with_source(self, doc_path:str|bytes, start_page:int=0, end_page:int=-1, remove_mark=[], reconstruct_paragraph_at_pagebreak=True, strip=True, read_by=0, continue_flag:llm_continue=None, lang='en')-> Iterator:
         """
-        read full texts from document
-        ignoring start and end page as there are no pages per se
+        read by page, the default, yields each non-empty line with its own source, [text, 'line_n'], n from 1
+            so that a chunk of the knowledge base cites the lines it is made of, start and end page are ignored
+        else, as IDocReaderWriter
         """
-        output = []
+        if read_by != 0:
+            return super().read_doc_to_texts_with_source(doc_path=doc_path, start_page=start_page, end_page=end_page, remove_mark=remove_mark, reconstruct_paragraph_at_pagebreak=reconstruct_paragraph_at_pagebreak, strip=strip, read_by=read_by, continue_flag=continue_flag, lang=lang)
+        valid = self.__validate_doc_type__(doc_path=doc_path)
+        if not valid:
+            raise ValueError(f"TextReaderWriter read document failed. It does not exist! File: {doc_path}")
+        def read_lines():
+            mark_pattern = self.__mark_pattern__(remove_mark)
+            for line_no, line in self.__iter_lines__(doc_path, continue_flag=continue_flag):
+                line = self.__clean_text__(line, mark_pattern, strip=strip)
+                if line is None or len(line) == 0:
+                    continue
+                yield [line, f"line_{line_no}"]
+        return read_lines()
 
+    def read_doc_to_texts_by_block(self, doc_path:str|bytes, start_page:int=0, end_page:int=-1, remove_mark=[], reconstruct_paragraph_at_pagebreak=True, strip=True, streaming=False, read_by=2, continue_flag:llm_continue=None):
+        """
+        read texts by paragraphs delimited by blank lines, there are no pages, start and end page are ignored
+        output: a generator regardless of streaming, of [text, 'line_n'], n is the first line of the paragraph
+        """
         valid = self.__validate_doc_type__(doc_path=doc_path)
         if not valid:
             raise ValueError(f"TextReaderWriter read document failed. It does not exist! File: {doc_path}")
-        else:
-            # read file. if bytes, use stringIO with decode
-            with io.StringIO(doc_path.decode()) if type(doc_path) is bytes else open(doc_path, 'r') as file:
-                for idx, line in enumerate(file):
-                    line = line.strip()
-                    if len(line) > 0:
-                        output.append([line, f"line_{idx+1}"])
-
-        return output
+        result = []
+        lines, first = [], 0
+        mark_pattern = self.__mark_pattern__(remove_mark)
+        for line_no, line in self.__iter_lines__(doc_path, continue_flag=continue_flag):
+            if len(line.strip()) == 0: # blank line, end of paragraph
+                if len(lines) > 0:
+                    paragraph = ['\n'.join(lines), f"line_{first}"]
+                    if streaming and read_by == 2:
+                        yield paragraph
+                    else:
+                        result.append(paragraph)
+                    lines = []
+                continue
+            line = self.__clean_text__(line, mark_pattern, strip=strip)
+            if line is None:
+                continue
+            if len(lines) == 0:
+                first = line_no
+            lines.append(line)
+        if len(lines) > 0:
+            paragraph = ['\n'.join(lines), f"line_{first}"]
+            if streaming and read_by == 2:
+                yield paragraph
+            else:
+                result.append(paragraph)
+        if not streaming or read_by == 1:
+            yield from result
 
     def write_text_to_doc(self, texts: str|list[str], output_path: str, template_path: str = None, **kwargs) -> bool:
         with open(output_path, 'w') as file:
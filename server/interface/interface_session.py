@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+    session backend interface, where session key/values are stored
+    Author: awtestergit
+"""
+
+from interface.interface_model import llm_continue
+
+"""
+ISessionBackend
+store of session key/values by id (uid or sid)
+    values must be plain (picklable) for a shared backend, except llm_continue flags which the backend handles
+"""
+class ISessionBackend():
+    SHARED = False # if True, sessions are visible to all worker processes
+    def has(self, id:str)->bool:
+        raise NotImplementedError("ISessionBackend base class has")
+
+    def get(self, id:str)->dict:
+        """
+        output: all key/values of id, or None if id does not exist
+        """
+        raise NotImplementedError("ISessionBackend base class get")
+
+    def get_key(self, id:str, key:str, default=None):
+        raise NotImplementedError("ISessionBackend base class get_key")
+
+    def create(self, id:str, values:dict)->bool:
+        """
+        create id with values if id does not exist
+        output: True if created
+        """
+        raise NotImplementedError("ISessionBackend base class create")
+
+    def set_key(self, id:str, key:str, value):
+        raise NotImplementedError("ISessionBackend base class set_key")
+
+    def remove(self, id:str):
+        raise NotImplementedError("ISessionBackend base class remove")
+
+    def set_expiry(self, id:str, expiry:float):
+        """
+        expiry: time.time() timestamp
+        """
+        raise NotImplementedError("ISessionBackend base class set_expiry")
+
+    def get_expiry(self, id:str)->float:
+        """
+        output: time.time() timestamp, or None if not set
+        """
+        raise NotImplementedError("ISessionBackend base class get_expiry")
+
+    def new_continue_flag(self, id:str)->llm_continue:
+        """
+        a continue flag for id, which a stop from any worker can reach
+        """
+        return llm_continue()
+
+    def close(self):
+        pass
@@ -5,7 +5,21 @@
 #
 
 import json
+import time
+import zlib
 import base64
+try:
+    import orjson # faster json backend, if available
+    def json_dumps_bytes(obj)->bytes:
+        try:
+            return orjson.dumps(obj)
+        except TypeError: # e.g., a lone surrogate from llm or pdf text, orjson rejects it
+            return json.dumps(obj).encode(errors='ignore')
+    json_loads = orjson.loads
+except ImportError:
+    def json_dumps_bytes(obj)->bytes:
+        return json.dumps(obj).encode(errors='ignore')
+    json_loads = json.loads
 #
 #   format as:
 #   TOTAL_LENGTH|HEADER_LENGTH|HEADER_BYTES|OBJECT_BYTES
@@ -33,24 +47,18 @@ class AnbJsonStreamCoder(anb_stream_coder):
         the rest is the dict bytes
         output: the byte sequence in 'total_length|header_length|header|wav'
         """
-        dict_header_data = json.dumps(dict_header).encode(errors='ignore') # dump to json bytes
-        dict_header_data_size = len(dict_header_data) # len
-        dict_header_data_size_bytes = dict_header_data_size.to_bytes(byte_length, byteorder=byte_order)
-        dict_obj_data = json.dumps(dict_obj).encode(errors='ignore') # dump to json bytes
-        dict_obj_data_size = len(dict_obj_data) # len
-        #dict_obj_data_size_bytes = dict_obj_data_size.to_bytes(byte_length, byteorder=byte_order)
+        dict_header_data = json_dumps_bytes(dict_header) # dump to json bytes
+        dict_obj_data = json_dumps_bytes(dict_obj) # dump to json bytes
+        return cls.encode_bytes(dict_header_data, dict_obj_data, byte_length=byte_length, byte_order=byte_order)
 
-        # header
-        header = dict_header_data_size_bytes + dict_header_data
-        header_length = byte_length + dict_header_data_size # len(header)
-        # total length
-        total_length = byte_length + header_length + dict_obj_data_size # including the 4 byets, now the length is total of 'total_length|header_length|header|obj'
-        total_length_bytes = total_length.to_bytes(byte_length, byteorder=byte_order)
-        # output
-        output = total_length_bytes + header + dict_obj_data #concat
-        # base64
-        #output64 = base64.b64encode(output)
-        return output
+    @classmethod
+    def encode_bytes(cls, header_data:bytes, obj_data:bytes, byte_length=4, byte_order='little')->bytes:
+        """
+        encode already serialized header and object json bytes, same format as encode
+        """
+        header_length = byte_length + len(header_data) # len(header_length|header)
+        total_length = byte_length + header_length + len(obj_data) # including the 4 byets, now the length is total of 'total_length|header_length|header|obj'
+        return b''.join((total_length.to_bytes(byte_length, byteorder=byte_order), len(header_data).to_bytes(byte_length, byteorder=byte_order), header_data, obj_data))
 
     @classmethod
     def decode(cls, obj:bytes, byte_length=4, byte_order='little')->tuple[dict, bytes]:
@@ -73,4 +81,155 @@ class AnbJsonStreamCoder(anb_stream_coder):
         dict_obj = json.loads(dict_obj)
         obj_size = len(obj)
         rest_bytes = obj[total_size:] if obj_size > total_size else None
-        return header, dict_obj, rest_bytes
\ No newline at end of file
+        return header, dict_obj, rest_bytes
+
+class AnbJsonStreamEncoder():
+    """
+    per-stream encoder of the AnbJsonStreamCoder format
+        header: the static header of this stream, serialized once; encode() with a header dict serializes that header instead
+        compress: if True, output is a zlib (http 'deflate') stream, sync-flushed at every output so the client can decode as it arrives
+        coalesce_key: if set, consecutive push() objects are merged into one frame by concatenating this string key,
+            until coalesce_ms passed since the first pending delta, or coalesce_bytes pending
+            the first delta of the stream is sent at once, and the caller flush()es when pending_seconds() passed without a push
+    """
+    def __init__(self, header:dict=None, compress=False, coalesce_key:str=None, coalesce_ms=0, coalesce_bytes=0, byte_length=4, byte_order='little') -> None:
+        self.byte_length = byte_length
+        self.byte_order = byte_order
+        self.header_data = json_dumps_bytes(header) if header is not None else json_dumps_bytes({})
+        self.compressor = zlib.compressobj() if compress else None
+        self.coalesce_key = coalesce_key
+        self.coalesce_seconds = coalesce_ms / 1000
+        self.coalesce_bytes = coalesce_bytes
+        self.__pending__ = None # pending object to coalesce
+        self.__pending_deltas__ = [] # pending deltas of coalesce_key
+        self.__pending_size__ = 0
+        self.__pending_since__ = 0
+        self.__first_sent__ = False # the first delta is not held
+
+    def __output__(self, frame:bytes)->bytes:
+        if self.compressor is None:
+            return frame
+        return self.compressor.compress(frame) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def __frame__(self, dict_obj:dict, header_data:bytes=None)->bytes:
+        header_data = header_data if header_data is not None else self.header_data
+        return AnbJsonStreamCoder.encode_bytes(header_data, json_dumps_bytes(dict_obj), byte_length=self.byte_length, byte_order=self.byte_order)
+
+    def encode(self, dict_obj:dict, dict_header:dict=None)->bytes:
+        """
+        encode one frame, pending coalesced deltas are sent first to keep the order
+        dict_header: if None, use the static header
+        """
+        header_data = json_dumps_bytes(dict_header) if dict_header is not None else None
+        frames = self.__flush_pending__()
+        frames.append(self.__frame__(dict_obj, header_data))
+        return self.__output__(b''.join(frames))
+
+    def push(self, dict_obj:dict)->bytes:
+        """
+        push one delta object with the static header, coalesced if coalesce_key is set
+        output: bytes to send, which can be empty if the delta is pending
+        """
+        if self.coalesce_key is None:
+            return self.__output__(self.__frame__(dict_obj))
+        delta = dict_obj.get(self.coalesce_key, '')
+        if self.__pending__ is not None and not self.__can_merge__(self.__pending__, dict_obj):
+            # other keys differ, can not merge
+            frames = self.__flush_pending__()
+            self.__pending__ = dict_obj
+        elif self.__pending__ is None:
+            frames = []
+            self.__pending__ = dict_obj
+            self.__pending_since__ = time.monotonic()
+        else:
+            frames = []
+        self.__pending_deltas__.append(delta)
+        self.__pending_size__ += len(delta)
+        if not self.__first_sent__ or self.__pending_size__ >= self.coalesce_bytes or time.monotonic() - self.__pending_since__ >= self.coalesce_seconds:
+            self.__first_sent__ = True
+            frames.extend(self.__flush_pending__())
+        return self.__output__(b''.join(frames)) if len(frames) > 0 else b''
+
+    def __can_merge__(self, pending:dict, dict_obj:dict)->bool:
+        if len(pending) != len(dict_obj):
+            return False
+        for key, value in dict_obj.items():
+            if key != self.coalesce_key and pending.get(key, None) != value:
+                return False
+        return True
+
+    def __flush_pending__(self)->list:
+        if self.__pending__ is None:
+            return []
+        dict_obj = dict(self.__pending__)
+        dict_obj[self.coalesce_key] = ''.join(self.__pending_deltas__)
+        self.__pending__ = None
+        self.__pending_deltas__ = []
+        self.__pending_size__ = 0
+        self.__pending_since__ = time.monotonic()
+        return [self.__frame__(dict_obj)]
+
+    def pending_seconds(self)->float:
+        """
+        output: seconds till the pending deltas are due, 0 if overdue, None if nothing is pending
+        """
+        if self.__pending__ is None:
+            return None
+        return max(0., self.__pending_since__ + self.coalesce_seconds - time.monotonic())
+
+    def flush(self)->bytes:
+        """
+        output: pending coalesced frame if any
+        """
+        frames = self.__flush_pending__()
+        return self.__output__(b''.join(frames)) if len(frames) > 0 else b''
+
+    def close(self)->bytes:
+        """
+        output: pending frame and the end of the compressed stream if any, the encoder is not usable afterwards
+        """
+        output = self.flush()
+        if self.compressor is not None:
+            output += self.compressor.flush()
+            self.compressor = None
+        return output
+
+class AnbJsonStreamDecoder():
+    """
+    incremental decoder of the AnbJsonStreamCoder format, accepts partial buffers
+        compress: if True, input is the zlib stream from AnbJsonStreamEncoder
+    """
+    def __init__(self, compress=False, byte_length=4, byte_order='little') -> None:
+        self.byte_length = byte_length
+        self.byte_order = byte_order
+        self.decompressor = zlib.decompressobj() if compress else None
+        self.__buffer__ = bytearray() # bytes not yet decoded
+
+    def decode(self, data:bytes)->list[tuple[dict, dict]]:
+        """
+        data: next bytes received, can be any part of frames
+        output: list of (dict_header, dict_obj) completed by this data, can be empty
+        """
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        self.__buffer__ += data
+        outputs = []
+        view = memoryview(self.__buffer__)
+        size = len(self.__buffer__)
+        offset = 0
+        byte_length = self.byte_length
+        try:
+            while size - offset >= byte_length * 2:
+                total_size = int.from_bytes(view[offset:offset+byte_length], byteorder=self.byte_order)
+                if size - offset < total_size:
+                    break # wait for more
+                header_end = offset + byte_length*2 + int.from_bytes(view[offset+byte_length:offset+byte_length*2], byteorder=self.byte_order)
+                header = json_loads(bytes(view[offset+byte_length*2:header_end]))
+                dict_obj = json_loads(bytes(view[header_end:offset+total_size]))
+                outputs.append((header, dict_obj))
+                offset += total_size
+        finally:
+            view.release()
+        if offset > 0: # drop decoded frames
+            del self.__buffer__[:offset]
+        return outputs
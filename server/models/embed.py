@@ -6,25 +6,89 @@
 """
 
 
-from ollama import Client
+import os
+import json
+import logging
 import numpy as np
 
 from interface.interface_model import IEmbeddingModel
+from anbutils import text_chunker
+from models import ollama_pool
+from models.ollama_pool import ollama_host_pool
+
+def normalize_l2(x):
+    x = np.array(x)
+    if x.ndim == 1:
+        norm = np.linalg.norm(x)
+        if norm == 0:
+            return x
+        return x / norm
+    else:
+        norm = np.linalg.norm(x, 2, axis=1, keepdims=True)
+        return np.where(norm == 0, x, x / norm)
+
+def read_probe_cache(path:str, key:str)->int:
+    """
+    the embedding dimension of key probed before, 0 if unknown
+    """
+    if path is None or not os.path.exists(path):
+        return 0
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return int(json.load(f).get(key, 0))
+    except (OSError, ValueError, TypeError):
+        return 0
+
+def write_probe_cache(path:str, key:str, dim:int):
+    if path is None:
+        return
+    try:
+        cache = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        cache[key] = dim
+        tmp = f"{path}.{os.getpid()}.tmp" # worker processes may write at the same time
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmp, path)
+    except (OSError, ValueError, TypeError) as e:
+        logging.warning(f"embedding probe cache: failed to write {path}. {e}")
 
 class OllamaNomicEmbeddingModel(IEmbeddingModel):
-    def __init__(self, host:str="http://localhost:11434", model:str='nomic-embed-text', max_context_length=8192, max_embedding_dim=512) -> None:
-        # assuming the model is running at host:str="http://localhost:11434",
+    def __init__(self, host:str|list[str]="http://localhost:11434", model:str='nomic-embed-text', max_context_length=8192, max_embedding_dim=512, keep_alive:str|float=None, embedding_dim:int=0, probe_cache:str=None, chunk_tokens:int=512) -> None:
+        """
+        assuming the model is running at host:str="http://localhost:11434", or a list of hosts serving the same model
+        chunk_tokens: tokens of a retrieval chunk, at most max_context_length
+        embedding_dim: the model's embedding dimension, 0 is from probe_cache, else probed by a request
+        probe_cache: a json file of the probed dimensions, kept across restarts
+        """
         token_ex = 0.7 # 1 token ~= 0.7 character
         # max length 5000 = 8192*0.7
         self.MAX_LENGTH = int(max_context_length * token_ex)
+        self.MAX_TOKENS = max_context_length
+        self.CHUNK_TOKENS = min(chunk_tokens, self.MAX_TOKENS)
         self.model = model
-        self.client = Client(host=host)
-        e = self.client.embeddings(model=model, prompt="hello")
-        embedding_size = len(e['embedding'])
+        self.pool = ollama_host_pool(host) # requests go to the least busy healthy host
+        self.client = self.pool.client
+        self.keep_alive = keep_alive # how long ollama keeps the model loaded, None is ollama's default
+        embedding_size = embedding_dim if embedding_dim > 0 else read_probe_cache(probe_cache, self.probe_key(model))
+        if embedding_size <= 0: # probe
+            e = self.pool.call(lambda client: client.embeddings(model=model, prompt="hello", keep_alive=keep_alive))
+            embedding_size = len(e['embedding'])
+            write_probe_cache(probe_cache, self.probe_key(model), embedding_size)
         #if embedding_size is larger, then trim the dim to max_embedding_dim
         self.need_normalize = (embedding_size > max_embedding_dim)
         embedding_size = embedding_size if embedding_size < max_embedding_dim else max_embedding_dim
         self.EMBED_SIZE = embedding_size # embedding dimension of nomic
+
+    @staticmethod
+    def probe_key(model:str)->str:
+        return f"ollama:{model}"
+
+    def warmup(self):
+        # load the model on every host
+        self.pool.each(lambda client: client.embeddings(model=self.model, prompt="hello", keep_alive=self.keep_alive))
         
 
     def encode(self, inputs:str, to_list=False):
@@ -32,26 +96,30 @@ class OllamaNomicEmbeddingModel(IEmbeddingModel):
         inputs: string
         output: 2d shape (1, embed_size)
         """
-        def normalize_l2(x):
-            x = np.array(x)
-            if x.ndim == 1:
-                norm = np.linalg.norm(x)
-                if norm == 0:
-                    return x
-                return x / norm
-            else:
-                norm = np.linalg.norm(x, 2, axis=1, keepdims=True)
-                return np.where(norm == 0, x, x / norm)
-        #response = ollama.embeddings(model=self.model, prompt=inputs)
-        response = self.client.embeddings(model=self.model, prompt=inputs)
-        cut_dim = response['embedding'][:self.EMBED_SIZE]
+        def compute():
+            #response = ollama.embeddings(model=self.model, prompt=inputs)
+            response = self.pool.call(lambda client: client.embeddings(model=self.model, prompt=inputs, keep_alive=self.keep_alive))
+            return self.__embedding_output__(response['embedding'], to_list)
+        return self.__coalesced_encode__(inputs, to_list, compute) # identical encodes in flight share one call
+
+    async def aencode(self, inputs:str, to_list=False):
+        async def compute():
+            response = await self.pool.acall(lambda client: client.embeddings(model=self.model, prompt=inputs, keep_alive=self.keep_alive))
+            return self.__embedding_output__(response['embedding'], to_list)
+        return await self.__acoalesced_encode__(inputs, to_list, compute)
+
+    def __embedding_output__(self, embedding:list, to_list:bool):
+        cut_dim = embedding[:self.EMBED_SIZE]
         norm_dim = normalize_l2(cut_dim) if self.need_normalize else cut_dim
         if not to_list:
             norm_dim = norm_dim.reshape(1, -1) # reshape to (1, EMBED_SIZE)
         return norm_dim
 
+    async def aclose(self):
+        await ollama_pool.aclose_async_clients()
+
 # support OpenAI    
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
 class GPTEmbeddingModel(IEmbeddingModel):
     gpt_embedding = {
@@ -71,33 +139,65 @@ class GPTEmbeddingModel(IEmbeddingModel):
             'seq_length': 8192,
         }
     }
-    def __init__(self, key:str, model='text-embedding-3-small', max_embedding_dim=512):
+    def __init__(self, key:str, model='text-embedding-3-small', max_embedding_dim=512, chunk_tokens:int=512):
         self.EMBED_SIZE = self.gpt_embedding[model]['emb_length_use']
         self.EMBED_SIZE = self.EMBED_SIZE if self.EMBED_SIZE < max_embedding_dim else max_embedding_dim
         self.need_normalize = self.EMBED_SIZE != self.gpt_embedding[model]['emb_length_model']
         token_ex = 0.7
         self.MAX_LENGTH = int(self.gpt_embedding[model]['seq_length'] * token_ex)
+        self.MAX_TOKENS = self.gpt_embedding[model]['seq_length']
+        self.CHUNK_TOKENS = min(chunk_tokens, self.MAX_TOKENS)
+        self.token_counter = text_chunker.get_token_counter('cl100k_base') # openai embedding tokenizer
         self.model = model
         self.client = OpenAI(api_key=key)
+        self.__key__ = key
+        self.__aclient__ = None # AsyncOpenAI, shares one connection pool for all async requests
+
+    def count_tokens(self, text:str)->int:
+        return self.token_counter(text)
 
     def encode(self, inputs:str, to_list=False):
         """
         inputs: string
         output: 2d shape (1, embed_size)
         """
-        def normalize_l2(x):
-            x = np.array(x)
-            if x.ndim == 1:
-                norm = np.linalg.norm(x)
-                if norm == 0:
-                    return x
-                return x / norm
-            else:
-                norm = np.linalg.norm(x, 2, axis=1, keepdims=True)
-                return np.where(norm == 0, x, x / norm)
-        response = self.client.embeddings.create(model=self.model, input=inputs)
-        cut_dim = response.data[0].embedding[:self.EMBED_SIZE]
+        def compute():
+            response = self.client.embeddings.create(model=self.model, input=inputs)
+            return self.__embedding_output__(response.data[0].embedding, to_list)
+        return self.__coalesced_encode__(inputs, to_list, compute) # identical encodes in flight share one call
+
+    async def aencode(self, inputs:str, to_list=False):
+        async def compute():
+            response = await self.aclient.embeddings.create(model=self.model, input=inputs)
+            return self.__embedding_output__(response.data[0].embedding, to_list)
+        return await self.__acoalesced_encode__(inputs, to_list, compute)
+
+    async def aencode_batch(self, inputs:list, to_list=False):
+        """
+        inputs: a list of strings, embedded by one request
+        output: 2d shape (len(inputs), embed_size), or a list of embeddings if to_list
+        """
+        if len(inputs) == 0:
+            return [] if to_list else np.zeros((0, self.EMBED_SIZE), dtype=np.float32)
+        response = await self.aclient.embeddings.create(model=self.model, input=inputs)
+        outputs = [self.__embedding_output__(data.embedding, to_list) for data in sorted(response.data, key=lambda d: d.index)]
+        return outputs if to_list else np.vstack(outputs)
+
+    def __embedding_output__(self, embedding:list, to_list:bool):
+        cut_dim = embedding[:self.EMBED_SIZE]
         norm_dim = normalize_l2(cut_dim) if self.need_normalize else cut_dim
         if not to_list:
             norm_dim = norm_dim.reshape(1, -1) # reshape to (1, EMBED_SIZE)
-        return norm_dim
\ No newline at end of file
+        return norm_dim
+
+    @property
+    def aclient(self)->AsyncOpenAI:
+        # created at the first use, in the event loop that uses it
+        if self.__aclient__ is None:
+            self.__aclient__ = AsyncOpenAI(api_key=self.__key__)
+        return self.__aclient__
+
+    async def aclose(self):
+        if self.__aclient__ is not None:
+            await self.__aclient__.close()
+            self.__aclient__ = None
\ No newline at end of file
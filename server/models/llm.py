@@ -4,18 +4,29 @@
 """
 
 from interface.interface_model import ILanguageModel
-from ollama import Client
+from anbutils import text_chunker
+from models import ollama_pool
+from models.ollama_pool import ollama_host_pool
 
 class OllamaModel(ILanguageModel):
-    def __init__(self, host:str="http://localhost:11434", model:str='local_llm', max_context_length=8192, seed=20240907) -> None:
+    def __init__(self, host:str|list[str]="http://localhost:11434", model:str='local_llm', max_context_length=8192, seed=20240907, keep_alive:str|float=None, num_ctx:int=0) -> None:
+        """
+        host: an ollama host, or a list of hosts serving the same model, requests go to the least busy healthy host
+        keep_alive: how long ollama keeps the model loaded after a request, e.g., '30m', -1 forever, None is ollama's default
+        num_ctx: the context window of every request, 0 is MAX_LENGTH
+            it is the same for all requests, a different num_ctx reloads the model and drops its prompt cache
+        """
         token_ex = 0.7 # 1 token ~= 0.7 character
         # max length 5000 = 8192*0.7
         max_context_length = int(max_context_length * token_ex)
         super().__init__(max_context_length, token_ex, seed)
         self.stop = []
         self.model = model
-        self.client = Client(host=host)
+        self.pool = ollama_host_pool(host)
+        self.client = self.pool.client
         self.MAX_NEW_TOKENS = 4096 # max tokens to be genreated by model
+        self.keep_alive = keep_alive
+        self.NUM_CTX = num_ctx if num_ctx > 0 else self.MAX_LENGTH
 
     def generate(self, inputs, splitter='', stop=None, replace_stop=True, **kwargs):
         stop = stop if stop is not None else []
@@ -48,22 +59,77 @@ class OllamaModel(ILanguageModel):
         return self.stream_chat(inputs, self.model, splitter=splitter, stop=stop, replace_stop=replace_stop, output_delta=output_delta, **kwargs)
 
     def chat(self, inputs, system_prompt='', assistant_prompt='', history=[], splitter='', stop=None, replace_stop=True, **kwargs):
-        stop = stop if stop is not None else []
-        if not replace_stop:
-            stop.extend(self.stop)
-        seed = self.seed if self.seed > 0 else None
-        # consruct message
-        messages = self.__construct_chat_message__(inputs, system_prompt, assistant_prompt, history)
-        kwargs = self.__kwargs_compatible__(messages, kwargs)
-        kwargs['stop'] = stop
-        kwargs['seed'] = seed
-        response = self.client.chat(model=self.model, messages=messages, options=kwargs)
-        answer = response['message']['content']
-        answer = answer if answer is not None else ''
+        use_cache = kwargs.pop('use_cache', True) # False to bypass the response cache
+        messages, kwargs = self.__chat_request__(inputs, system_prompt, assistant_prompt, history, stop, replace_stop, kwargs)
+        def compute():
+            response = self.pool.call(lambda client: client.chat(model=self.model, messages=messages, options=kwargs, keep_alive=self.keep_alive))
+            answer = response['message']['content']
+            return answer if answer is not None else ''
+        answer = self.__cached_answer__(messages, kwargs, compute, use_cache=use_cache)
         answer = answer if len(splitter)==0 else answer.split(splitter)[-1]
         return answer
 
     def stream_chat(self, inputs, system_prompt='', assistant_prompt='', history=[], splitter='', stop=None, replace_stop=True, output_delta=False, **kwargs):
+        kwargs.pop('use_cache', None) # streams are not cached
+        continue_flag = kwargs.pop('continue_flag', None) # stops this stream
+        messages, kwargs = self.__chat_request__(inputs, system_prompt, assistant_prompt, history, stop, replace_stop, kwargs)
+
+        def make_stream():
+            response = self.pool.stream(lambda client: client.chat(model=self.model, messages=messages, stream=True, options=kwargs, keep_alive=self.keep_alive))
+            try:
+                texts = ''
+                for chunk in response:
+                    t = chunk['message']['content']
+                    t = t if t is not None else ''
+                    if output_delta: # output delta only
+                        texts = t
+                    else:
+                        texts += t
+                        texts = texts.split(splitter)[-1] if len(splitter)>0 else texts # split by splitter, if any
+                    yield texts
+            finally:
+                response.close() # stopped or done, the backend stops generating
+        # identical streams in flight share one backend stream
+        yield from self.__shared_stream__(messages, kwargs, make_stream, continue_flag=continue_flag, splitter=splitter, output_delta=output_delta)
+
+    async def achat(self, inputs, system_prompt='', assistant_prompt='', history=[], splitter='', stop=None, replace_stop=True, **kwargs):
+        use_cache = kwargs.pop('use_cache', True)
+        messages, kwargs = self.__chat_request__(inputs, system_prompt, assistant_prompt, history, stop, replace_stop, kwargs)
+        async def compute():
+            response = await self.pool.acall(lambda client: client.chat(model=self.model, messages=messages, options=kwargs, keep_alive=self.keep_alive))
+            answer = response['message']['content']
+            return answer if answer is not None else ''
+        answer = await self.__acached_answer__(messages, kwargs, compute, use_cache=use_cache)
+        answer = answer if len(splitter)==0 else answer.split(splitter)[-1]
+        return answer
+
+    async def astream_chat(self, inputs, system_prompt='', assistant_prompt='', history=[], splitter='', stop=None, replace_stop=True, output_delta=False, **kwargs):
+        kwargs.pop('use_cache', None)
+        continue_flag = kwargs.pop('continue_flag', None)
+        messages, kwargs = self.__chat_request__(inputs, system_prompt, assistant_prompt, history, stop, replace_stop, kwargs)
+
+        async def make_stream():
+            response = self.pool.astream(lambda client: client.chat(model=self.model, messages=messages, stream=True, options=kwargs, keep_alive=self.keep_alive))
+            try:
+                texts = ''
+                async for chunk in response:
+                    t = chunk['message']['content']
+                    t = t if t is not None else ''
+                    if output_delta:
+                        texts = t
+                    else:
+                        texts += t
+                        texts = texts.split(splitter)[-1] if len(splitter)>0 else texts
+                    yield texts
+            finally:
+                await response.aclose()
+        async for texts in self.__ashared_stream__(messages, kwargs, make_stream, continue_flag=continue_flag, splitter=splitter, output_delta=output_delta):
+            yield texts
+
+    def __chat_request__(self, inputs, system_prompt, assistant_prompt, history, stop, replace_stop, kwargs)->tuple[list, dict]:
+        """
+        output: the messages and the options of a chat request
+        """
         stop = stop if stop is not None else []
         if not replace_stop:
             stop.extend(self.stop)
@@ -74,18 +140,18 @@ class OllamaModel(ILanguageModel):
         seed = self.seed if self.seed > 0 else None
         kwargs['stop'] = stop
         kwargs['seed'] = seed
+        return messages, kwargs
 
-        response = self.client.chat(model=self.model, messages=messages, stream=True, options=kwargs)
-        texts = ''
-        for chunk in response:
-            t = chunk['message']['content']
-            t = t if t is not None else ''
-            if output_delta: # output delta only
-                texts = t
-            else:
-                texts += t
-                texts = texts.split(splitter)[-1] if len(splitter)>0 else texts # split by splitter, if any
-            yield texts
+    async def aclose(self):
+        await ollama_pool.aclose_async_clients()
+
+    def warmup(self):
+        # load the model on every host, with the num_ctx of all requests so it is not reloaded
+        self.pool.each(lambda client: client.chat(model=self.model, messages=[], options={'num_ctx': self.NUM_CTX}, keep_alive=self.keep_alive))
+
+    def prompt_budget(self, max_new_tokens:int)->int:
+        # the prompt and the generated tokens share num_ctx
+        return self.NUM_CTX - max_new_tokens
 
     def __kwargs_compatible__(self, messages:list, kwargs):
         # get keys
@@ -103,16 +169,15 @@ class OllamaModel(ILanguageModel):
         key = 'do_sample' # remove do_sample key
         if key in kwargs.keys():
             kwargs.pop(key)
-        key = 'num_ctx'
-        if key not in kwargs.keys():
-            ctx_length = self.MAX_LENGTH - num_predict
-            kwargs['num_ctx'] = ctx_length
+        # one num_ctx for all requests, so the loaded model and its prompt cache are reused, unless the caller sets one
+        kwargs.setdefault('num_ctx', self.NUM_CTX)
 
         return kwargs
 
 # support OpenAI
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import tiktoken
+import tiktoken.model
 
 class GPTModel(ILanguageModel):
     gpt_max_tokens = {
@@ -130,8 +195,18 @@ class GPTModel(ILanguageModel):
         super().__init__(max_context_length, token_ex, seed)
         self.stop = []
         self.client = OpenAI(api_key=key)
+        self.__key__ = key
+        self.__aclient__ = None # AsyncOpenAI, shares one connection pool for all async requests
         self.model = model
         self.MAX_NEW_TOKENS = 4096 # max tokens to be genreated by model
+        try:
+            encoding = tiktoken.model.encoding_name_for_model(model)
+        except KeyError:
+            encoding = 'cl100k_base'
+        self.token_counter = text_chunker.get_token_counter(encoding)
+
+    def count_tokens(self, text:str)->int:
+        return self.token_counter(text)
 
     def generate(self, inputs, splitter='', stop=None, replace_stop=True, **kwargs):
         stop = stop if stop is not None else []
@@ -164,40 +239,97 @@ class GPTModel(ILanguageModel):
         return self.stream_chat(inputs, self.model, splitter=splitter, stop=stop, replace_stop=replace_stop, output_delta=output_delta, **kwargs)
 
     def chat(self, inputs, system_prompt='', assistant_prompt='', history=[], splitter='', stop=None, replace_stop=True, **kwargs):
-        stop = stop if stop is not None else []
-        if not replace_stop:
-            stop.extend(self.stop)
-        seed = self.seed if self.seed > 0 else None
-        # consruct message
-        messages = self.__construct_chat_message__(inputs, system_prompt, assistant_prompt, history)
-        kwargs = self.__kwargs_compatible__(messages, kwargs)
-        response = self.client.chat.completions.create(model=self.model, messages=messages, stop=stop, seed=seed, **kwargs)
-        answer = response.choices[0].message.content
-        answer = answer if answer is not None else ''
+        use_cache = kwargs.pop('use_cache', True) # False to bypass the response cache
+        messages, kwargs, stop, seed = self.__chat_request__(inputs, system_prompt, assistant_prompt, history, stop, replace_stop, kwargs)
+        def compute():
+            response = self.client.chat.completions.create(model=self.model, messages=messages, stop=stop, seed=seed, **kwargs)
+            answer = response.choices[0].message.content
+            return answer if answer is not None else ''
+        answer = self.__cached_answer__(messages, dict(kwargs, stop=stop, seed=seed), compute, use_cache=use_cache)
         answer = answer if len(splitter)==0 else answer.split(splitter)[-1]
         return answer
 
     def stream_chat(self, inputs, system_prompt='', assistant_prompt='', history=[], splitter='', stop=None, replace_stop=True, output_delta=False, **kwargs):
+        kwargs.pop('use_cache', None) # streams are not cached
+        continue_flag = kwargs.pop('continue_flag', None) # stops this stream
+        messages, kwargs, stop, seed = self.__chat_request__(inputs, system_prompt, assistant_prompt, history, stop, replace_stop, kwargs)
+
+        def make_stream():
+            response = self.client.chat.completions.create(model=self.model, messages=messages, stop=stop, seed=seed, stream=True, **kwargs)
+            try:
+                texts = ''
+                for chunk in response:
+                    t = chunk.choices[0].delta.content
+                    t = t if t is not None else ''
+                    if output_delta: # output delta only
+                        texts = t
+                    else:
+                        texts += t
+                        texts = texts.split(splitter)[-1] if len(splitter)>0 else texts # split by splitter, if any
+                    yield texts
+            finally:
+                response.close() # stopped or done, the backend stops generating
+        # identical streams in flight share one backend stream
+        yield from self.__shared_stream__(messages, dict(kwargs, stop=stop, seed=seed), make_stream, continue_flag=continue_flag, splitter=splitter, output_delta=output_delta)
+
+    async def achat(self, inputs, system_prompt='', assistant_prompt='', history=[], splitter='', stop=None, replace_stop=True, **kwargs):
+        use_cache = kwargs.pop('use_cache', True)
+        messages, kwargs, stop, seed = self.__chat_request__(inputs, system_prompt, assistant_prompt, history, stop, replace_stop, kwargs)
+        async def compute():
+            response = await self.aclient.chat.completions.create(model=self.model, messages=messages, stop=stop, seed=seed, **kwargs)
+            answer = response.choices[0].message.content
+            return answer if answer is not None else ''
+        answer = await self.__acached_answer__(messages, dict(kwargs, stop=stop, seed=seed), compute, use_cache=use_cache)
+        answer = answer if len(splitter)==0 else answer.split(splitter)[-1]
+        return answer
+
+    async def astream_chat(self, inputs, system_prompt='', assistant_prompt='', history=[], splitter='', stop=None, replace_stop=True, output_delta=False, **kwargs):
+        kwargs.pop('use_cache', None)
+        continue_flag = kwargs.pop('continue_flag', None)
+        messages, kwargs, stop, seed = self.__chat_request__(inputs, system_prompt, assistant_prompt, history, stop, replace_stop, kwargs)
+
+        async def make_stream():
+            response = await self.aclient.chat.completions.create(model=self.model, messages=messages, stop=stop, seed=seed, stream=True, **kwargs)
+            try:
+                texts = ''
+                async for chunk in response:
+                    t = chunk.choices[0].delta.content
+                    t = t if t is not None else ''
+                    if output_delta:
+                        texts = t
+                    else:
+                        texts += t
+                        texts = texts.split(splitter)[-1] if len(splitter)>0 else texts
+                    yield texts
+            finally:
+                await response.close() # stopped or done, the backend stops generating
+        async for texts in self.__ashared_stream__(messages, dict(kwargs, stop=stop, seed=seed), make_stream, continue_flag=continue_flag, splitter=splitter, output_delta=output_delta):
+            yield texts
+
+    @property
+    def aclient(self)->AsyncOpenAI:
+        # created at the first use, in the event loop that uses it
+        if self.__aclient__ is None:
+            self.__aclient__ = AsyncOpenAI(api_key=self.__key__)
+        return self.__aclient__
+
+    async def aclose(self):
+        if self.__aclient__ is not None:
+            await self.__aclient__.close()
+            self.__aclient__ = None
+
+    def __chat_request__(self, inputs, system_prompt, assistant_prompt, history, stop, replace_stop, kwargs)->tuple[list, dict, list, int]:
+        """
+        output: the messages, the options, the stop words and the seed of a chat request
+        """
         stop = stop if stop is not None else []
         if not replace_stop:
             stop.extend(self.stop)
+        seed = self.seed if self.seed > 0 else None
         # consruct message
         messages = self.__construct_chat_message__(inputs, system_prompt, assistant_prompt, history)
         kwargs = self.__kwargs_compatible__(messages, kwargs)
-        #seed
-        seed = self.seed if self.seed > 0 else None
-
-        response = self.client.chat.completions.create(model=self.model, messages=messages, stop=stop, seed=seed, stream=True, **kwargs)
-        texts = ''
-        for chunk in response:
-            t = chunk.choices[0].delta.content
-            t = t if t is not None else ''
-            if output_delta: # output delta only
-                texts = t
-            else:
-                texts += t
-                texts = texts.split(splitter)[-1] if len(splitter)>0 else texts # split by splitter, if any
-            yield texts
+        return messages, kwargs, stop, seed
 
     def __kwargs_compatible__(self, messages:list, kwargs):
         # get keys
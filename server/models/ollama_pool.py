@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Ollama host pool - balance requests over several Ollama hosts
+    Author: awtestergit
+"""
+
+import time
+import logging
+from threading import Lock, Thread, Event
+import httpx
+from ollama import Client, AsyncClient, ResponseError
+
+# async clients by host url, shared by all pools of the process, so the llm and the embedding model on a host share one connection pool
+__async_clients__ = {}
+__async_lock__ = Lock()
+ASYNC_MAX_CONNECTIONS = 512 # per host, a stream holds a connection till it ends
+
+def get_async_client(url:str)->AsyncClient:
+    with __async_lock__:
+        client = __async_clients__.get(url, None)
+        if client is None:
+            limits = httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=ASYNC_MAX_CONNECTIONS // 4)
+            client = AsyncClient(host=url, limits=limits)
+            __async_clients__[url] = client
+        return client
+
+async def aclose_async_clients():
+    with __async_lock__:
+        clients = list(__async_clients__.values())
+        __async_clients__.clear()
+    for client in clients:
+        await client.close()
+
+class ollama_host():
+    def __init__(self, url:str, client:Client) -> None:
+        self.url = url
+        self.client = client
+        self.outstanding = 0 # requests in flight
+        self.failures = 0 # consecutive failures
+        self.ejected_until = 0. # monotonic time, ejected till then
+
+    @property
+    def async_client(self)->AsyncClient:
+        # created at the first use, in the event loop that uses it
+        return get_async_client(self.url)
+
+class ollama_host_pool():
+    """
+    ollama clients of several hosts, a request goes to the healthy host with the least outstanding requests
+        a host failing max_failures times in a row is ejected for eject_seconds, and reinstated by the health check or after the time
+        a failed request is retried on another host, a stream only if it failed before its first chunk
+    hosts: a host url or a list of them
+    health_interval: seconds between health checks of ejected hosts, 0 is no health check
+    """
+    def __init__(self, hosts:str|list[str], max_failures=3, eject_seconds=30, health_interval=10, **client_kwargs) -> None:
+        hosts = [hosts] if isinstance(hosts, str) else list(hosts)
+        if len(hosts) == 0:
+            raise ValueError("ollama host pool: no host.")
+        self.hosts = [ollama_host(url, Client(host=url, **client_kwargs)) for url in hosts]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.health_interval = health_interval
+        self.__lock__ = Lock()
+        self.__stop__ = Event()
+        self.__health__ = None
+        if len(self.hosts) > 1 and health_interval > 0:
+            self.__health__ = Thread(target=self.__health_proc__, daemon=True)
+            self.__health__.start()
+
+    @property
+    def client(self)->Client:
+        # the first host, for calls that do not need balancing
+        return self.hosts[0].client
+
+    def __is_retryable__(self, e:Exception)->bool:
+        # the host is down or failing, not the request
+        if isinstance(e, (ConnectionError, httpx.TransportError)):
+            return True
+        if isinstance(e, ResponseError):
+            return e.status_code < 0 or e.status_code >= 500
+        return False
+
+    def acquire(self, exclude:set=None)->ollama_host:
+        """
+        the healthy host with the least outstanding requests, else the one ejected the earliest
+        """
+        with self.__lock__:
+            now = time.monotonic()
+            candidates = [host for host in self.hosts if exclude is None or host not in exclude]
+            if len(candidates) == 0:
+                return None
+            healthy = [host for host in candidates if host.ejected_until <= now]
+            if len(healthy) > 0:
+                host = min(healthy, key=lambda h: h.outstanding)
+            else:
+                host = min(candidates, key=lambda h: h.ejected_until)
+            host.outstanding += 1
+            return host
+
+    def release(self, host:ollama_host, error:Exception=None):
+        with self.__lock__:
+            host.outstanding -= 1
+            if error is None:
+                host.failures = 0
+                host.ejected_until = 0.
+                return
+            host.failures += 1
+            if host.failures >= self.max_failures:
+                host.ejected_until = time.monotonic() + self.eject_seconds
+                logging.warning(f"ollama host pool: {host.url} ejected for {self.eject_seconds}s after {host.failures} failures. {error}")
+
+    def call(self, fn):
+        """
+        fn(client) on a host, retried on the other hosts if the host fails
+        """
+        tried = set()
+        while True:
+            host = self.acquire(exclude=tried)
+            if host is None:
+                raise last_error
+            tried.add(host)
+            try:
+                result = fn(host.client)
+            except Exception as e:
+                retryable = self.__is_retryable__(e)
+                self.release(host, e if retryable else None)
+                if not retryable:
+                    raise
+                last_error = e
+                logging.debug(f"ollama host pool: {host.url} failed, retry. {e}")
+                continue
+            self.release(host)
+            return result
+
+    def stream(self, fn):
+        """
+        a generator of fn(client) stream chunks, the host counts the request till the stream ends
+            retried on the other hosts if the host fails before the first chunk
+        """
+        tried = set()
+        while True:
+            host = self.acquire(exclude=tried)
+            if host is None:
+                raise last_error
+            tried.add(host)
+            started = False
+            error = None
+            stream = None
+            try:
+                stream = fn(host.client)
+                for chunk in stream:
+                    started = True
+                    yield chunk
+            except Exception as e:
+                error = e if self.__is_retryable__(e) else None
+                if started or error is None:
+                    raise
+                last_error = e
+                logging.debug(f"ollama host pool: {host.url} stream failed, retry. {e}")
+                continue
+            finally:
+                if stream is not None and hasattr(stream, 'close'):
+                    stream.close() # closes the http response, ollama stops generating
+                self.release(host, error)
+            return
+
+    def each(self, fn)->int:
+        """
+        fn(client) on every host, e.g., to load the model
+        output: the number of hosts it succeeded on, raises the last error if none
+        """
+        succeeded, last_error = 0, None
+        for host in self.hosts:
+            try:
+                fn(host.client)
+                succeeded += 1
+            except Exception as e:
+                last_error = e
+                logging.warning(f"ollama host pool: {host.url} failed. {e}")
+        if succeeded == 0 and last_error is not None:
+            raise last_error
+        return succeeded
+
+    async def acall(self, fn):
+        """
+        await fn(async client) on a host, retried on the other hosts if the host fails
+        """
+        tried = set()
+        while True:
+            host = self.acquire(exclude=tried)
+            if host is None:
+                raise last_error
+            tried.add(host)
+            try:
+                result = await fn(host.async_client)
+            except Exception as e:
+                retryable = self.__is_retryable__(e)
+                self.release(host, e if retryable else None)
+                if not retryable:
+                    raise
+                last_error = e
+                logging.debug(f"ollama host pool: {host.url} failed, retry. {e}")
+                continue
+            except BaseException: # cancelled
+                self.release(host)
+                raise
+            self.release(host)
+            return result
+
+    async def astream(self, fn):
+        """
+        an async generator of the chunks of the stream awaited from fn(async client)
+            retried on the other hosts if the host fails before the first chunk
+        """
+        tried = set()
+        while True:
+            host = self.acquire(exclude=tried)
+            if host is None:
+                raise last_error
+            tried.add(host)
+            started = False
+            error = None
+            stream = None
+            try:
+                stream = await fn(host.async_client)
+                async for chunk in stream:
+                    started = True
+                    yield chunk
+            except Exception as e:
+                error = e if self.__is_retryable__(e) else None
+                if started or error is None:
+                    raise
+                last_error = e
+                logging.debug(f"ollama host pool: {host.url} stream failed, retry. {e}")
+                continue
+            finally:
+                if stream is not None and hasattr(stream, 'aclose'):
+                    await stream.aclose() # closes the http response, ollama stops generating
+                self.release(host, error)
+            return
+
+    def __health_proc__(self):
+        while not self.__stop__.wait(self.health_interval):
+            now = time.monotonic()
+            with self.__lock__:
+                ejected = [host for host in self.hosts if host.ejected_until > now]
+            for host in ejected:
+                try:
+                    host.client.list() # GET /api/tags
+                except Exception:
+                    continue
+                with self.__lock__:
+                    host.failures = 0
+                    host.ejected_until = 0.
+                logging.info(f"ollama host pool: {host.url} is back.")
+
+    def close(self):
+        self.__stop__.set()
@@ -5,6 +5,7 @@
     Author: awtestergit
 """
 import logging
+import itertools
 
 from dataclasses import asdict
 from datetime import datetime
@@ -23,6 +24,7 @@ class qcVdbManager():
     each vdb manager holds 4 indexes: id, doctype, file, chunk
         + 1 FAQ
     """
+    UPSERT_BATCH = 64 # chunks embedded and upserted at a time by insert
     def __init__(self, model:ILanguageModel, collection_name="", client=None, total_faq_orgs:int=1000) -> None:
         """
         total_faq_orgs: the max number of organizations (including department, teams etc) to have FAQ
@@ -159,14 +161,18 @@ class qcVdbManager():
             type: the type of this file content
             type_desc: the description of the type
             chunks: a list of (meta, source_from) pair, where meta is the raw chunk text, source_from is the chunk's origin, e.g, file_path_page_2
+                or an iterable of them, embedded and upserted UPSERT_BATCH chunks at a time as it is read
         outputs:
             bool: if True, success, if False, the insert failed
             str: reason
         """
         reason = ''
-        if file_full_path is None or len(file_full_path)==0 or chunks is None or len(chunks)==0:
+        chunks = iter(chunks) if chunks is not None else iter([])
+        first = next(chunks, None)
+        if file_full_path is None or len(file_full_path)==0 or first is None:
             reason = 'either file path is empty or chunks is empty'
             return False, reason
+        chunks = itertools.chain([first], chunks)
 
         #else, insert
         ######doctype index######
@@ -196,20 +202,24 @@ class qcVdbManager():
 
 
         ######chunks######
-        # get the max point id
-        size = len(chunks)
-        point_id_start, point_id_end = self.qcindex.qcidindex.get_batch_point_id_max(size) # start and end index
-        file_content.point_id_start = point_id_start
-        file_content.point_id_end = point_id_end
-        # insert chunk to chunk index
-        point_ids = [i for i in range(point_id_start, point_id_end+1)] #[point_id_start, point_id_end] is the point ids
-        #vectors = [self.model.encode_numpy(text) for text, _ in chunks]
-        vectors = [self.model.encode(text, to_list=True) for text, _ in chunks]
-        contents = []
-        for idx, chunk in enumerate(chunks):
-            content = chunk_schema(chunk_id=idx, file_id=file_content.file_id, type=type, meta=chunk[0], source_from=chunk[1])
-            contents.append(content)
-        result = self.qcindex.qcchunkindex.add_chunks_to_vdb(contents, point_ids=point_ids, vectors=vectors)
+        # a batch of chunks at a time, the document is not held in memory
+        chunk_id = 0
+        for batch in iter(lambda: list(itertools.islice(chunks, self.UPSERT_BATCH)), []):
+            # get the max point id
+            point_id_start, point_id_end = self.qcindex.qcidindex.get_batch_point_id_max(len(batch)) # start and end index
+            if file_content.point_id_start < 0:
+                file_content.point_id_start = point_id_start
+            file_content.point_id_end = point_id_end
+            # insert chunk to chunk index
+            point_ids = [i for i in range(point_id_start, point_id_end+1)] #[point_id_start, point_id_end] is the point ids
+            #vectors = [self.model.encode_numpy(text) for text, _ in batch]
+            vectors = [self.model.encode(text, to_list=True) for text, _ in batch]
+            contents = []
+            for idx, chunk in enumerate(batch, start=chunk_id):
+                content = chunk_schema(chunk_id=idx, file_id=file_content.file_id, type=type, meta=chunk[0], source_from=chunk[1])
+                contents.append(content)
+            self.qcindex.qcchunkindex.add_chunks_to_vdb(contents, point_ids=point_ids, vectors=vectors)
+            chunk_id += len(batch)
         
         # insert file index
         self.qcindex.qcfileindex.add_file_index(file_content)
@@ -5,6 +5,7 @@
 """
 
 import logging
+import itertools
 import pandas as pd
 from dataclasses import asdict
 from datetime import datetime
@@ -70,14 +71,17 @@ class VectorDBManager():
         if check duplicate, check it first
         num_samples: how many samples of chunks to used to check duplicate
         threshold: the threshold, if greater than threshold, then it is believed to be duplicate
-        chunks: list[raw test, source of this raw test]
+        chunks: list[raw test, source of this raw test], or an iterable of them, e.g., text_chunker.iter_chunks, inserted as it is read
         output: bool, list[similar text in vdb, source of this text, file_id]
         """
+        chunks = iter(chunks)
+        first = next(chunks, None)
         # duplicate
-        if check_duplicate:
-            is_dup, dups = self.check_duplicate(chunks=chunks[0], type=type, num_samples=num_samples,threshold=threshold)
+        if check_duplicate and first is not None:
+            is_dup, dups = self.check_duplicate(chunks=first, type=type, num_samples=num_samples,threshold=threshold)
             if is_dup: # duplicate
                 return is_dup, dups
+        chunks = itertools.chain([first], chunks) if first is not None else []
         # else, insert
         result, _ = self.manager.insert(type=type, type_desc=type_desc, file_full_path=file_full_path,group_id=group_id, index_in_group=index_in_group, file_creation_time=file_creation_time, file_desc=file_desc, chunks=chunks)
         return result, []
@@ -138,17 +142,19 @@ class VectorDBManager():
         self.manager.update_description(doctype_id=doctype_id, desc=desc)
 
     def update_fileinfo(self, file_id, file_full_path:str='', group_id=-1, file_creation_time:datetime=None, file_desc:str='', chunks:list[str, str]=[])->bool:
-        # if chunks is [], then just update file_schema info, else
+        # if chunks is empty, then just update file_schema info, else
         # update file info (delete then insert)
         result = True
-        if len(chunks) == 0:
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        if first is None:
             # without creation time
             fileinfo:file_schema = file_schema(file_id=file_id, source_from=file_full_path, group_id=group_id, file_desc=file_desc)
             # now add
             fileinfo = self.manager.set_fileinfo_creation_time(fileinfo, file_creation_time)
             self.manager.update_fileinfo(fileinfo=fileinfo)
         else:
-            result, _ = self.manager.update(file_id=file_id, file_full_path=file_full_path, group_id=group_id, file_creation_time=file_creation_time, file_desc=file_desc, chunks=chunks)
+            result, _ = self.manager.update(file_id=file_id, file_full_path=file_full_path, group_id=group_id, file_creation_time=file_creation_time, file_desc=file_desc, chunks=itertools.chain([first], chunks))
         return result
 
     #
@@ -7,20 +7,188 @@
 
 
 import io
+import os
+import logging
+import tempfile
+import traceback
+import multiprocessing
+from collections import deque
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
 ### pdf
 from pdfminer.high_level import extract_pages
 from pdfminer.layout import LTTextContainer
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdftypes import resolve1
 #import pdfplumber
 
 from interface.interface_readwrite import IDocReaderWriter
 from interface.interface_model import llm_continue, ContinueExit
 
+class _pages_from():
+    # page_numbers container for pages from start to the end, without knowing the number of pages
+    def __init__(self, start:int) -> None:
+        self.start = start
+    def __contains__(self, idx:int)->bool:
+        return idx >= self.start
+
+__page_pool__ = None # process pool shared by all readers, created at first use
+__page_pool_lock__ = Lock()
+
+def __get_page_pool__(workers:int)->ProcessPoolExecutor:
+    global __page_pool__
+    with __page_pool_lock__:
+        if __page_pool__ is None:
+            # forkserver, the server process has threads which fork does not copy safely
+            __page_pool__ = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'))
+        return __page_pool__
+
+def close_page_pool():
+    global __page_pool__
+    with __page_pool_lock__:
+        if __page_pool__ is not None:
+            __page_pool__.shutdown(wait=False, cancel_futures=True)
+            __page_pool__ = None
+
+def parse_page_range(doc_path:str|bytes, start:int, end:int, remove_mark=[], strip=True)->list[tuple[int, list[str]]]:
+    """
+    parse pages [start, end) in a pool worker
+    output: [(page index, [paragraph texts])...]
+    """
+    reader = PDFReaderWriter()
+    with io.BytesIO(doc_path) if type(doc_path) is bytes else open(doc_path, 'rb') as file:
+        return [(idx, reader.__page_texts__(page, remove_mark=remove_mark, strip=strip)) for idx, page in reader.__iter_pages__(file, start_page=start+1, end_page=end)]
+
 class PDFReaderWriter(IDocReaderWriter):
     TYPE = "pdf"
+    PARALLEL_WORKERS = 0 # parse page ranges in a process pool if more than 1
+    PARALLEL_MIN_PAGES = 40 # documents with fewer pages to read are parsed in this process
+    PARALLEL_RANGE_PAGES = 8 # pages per range sent to a worker
     def __init__(self) -> None:
         super().__init__()
         self.type = self.TYPE
 
+    @classmethod
+    def configure_parallel(cls, workers:int=0, min_pages:int=40, range_pages:int=8):
+        cls.PARALLEL_WORKERS = workers
+        cls.PARALLEL_MIN_PAGES = min_pages
+        cls.PARALLEL_RANGE_PAGES = max(1, range_pages)
+
+    def __count_pages__(self, file)->int:
+        # number of pages from the page tree, without laying out; None if it can not be read
+        try:
+            document = PDFDocument(PDFParser(file))
+            count = resolve1(resolve1(document.catalog['Pages'])['Count'])
+            return int(count)
+        except:
+            logging.debug(f"pdf page count failed. {traceback.format_exc()}")
+            return None
+        finally:
+            file.seek(0)
+
+    def __iter_page_texts__(self, doc_path:str|bytes, start_page:int=0, end_page:int=-1, remove_mark=[], strip=True, continue_flag:llm_continue=None):
+        """
+        paragraph texts page by page, parsed in the process pool for large documents, in page order either way
+        output: a generator of (page index, [paragraph texts])
+        """
+        with io.BytesIO(doc_path) if type(doc_path) is bytes else open(doc_path, 'rb') as file:
+            workers = self.PARALLEL_WORKERS
+            num_pages = self.__count_pages__(file) if workers > 1 else None
+            start = start_page - 1 if start_page > 0 else 0
+            end = min(end_page, num_pages) if num_pages is not None and end_page >= 0 else num_pages
+            if num_pages is None or end - start < self.PARALLEL_MIN_PAGES:
+                for idx, page in self.__iter_pages__(file, start_page=start_page, end_page=end_page):
+                    # check continue
+                    if continue_flag:
+                        cf = continue_flag.check_continue_flag()
+                        if not cf:
+                            raise ContinueExit('pdf read exit.')
+                    output = self.__page_texts__(page, remove_mark=remove_mark, strip=strip)
+                    del page # release the layout before the next page
+                    yield idx, output
+                return
+        # parallel, by page ranges, at most 2 ranges per worker in flight
+        pool = __get_page_pool__(workers)
+        ranges = ((first, min(first + self.PARALLEL_RANGE_PAGES, end)) for first in range(start, end, self.PARALLEL_RANGE_PAGES))
+        window = deque()
+        temp_path = None
+        try:
+            if type(doc_path) is bytes: # written once, the ranges get its path, not a pickled copy of the document each
+                with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as temp:
+                    temp.write(doc_path)
+                    temp_path = temp.name
+            path = temp_path if temp_path is not None else doc_path
+            for first, last in ranges:
+                window.append(pool.submit(parse_page_range, path, first, last, remove_mark, strip))
+                while len(window) >= workers * 2 or (len(window) > 0 and window[0].done()):
+                    yield from self.__wait_range__(window.popleft(), continue_flag)
+            while len(window) > 0:
+                yield from self.__wait_range__(window.popleft(), continue_flag)
+        finally:
+            for future in window: # stopped or closed
+                future.cancel()
+            if temp_path is not None:
+                try:
+                    os.remove(temp_path) # a range still running keeps its open file
+                except OSError:
+                    pass
+
+    def __wait_range__(self, future, continue_flag:llm_continue=None):
+        # wait for a page range, checking stop, then yield its pages
+        while True:
+            if continue_flag:
+                cf = continue_flag.check_continue_flag()
+                if not cf:
+                    raise ContinueExit('pdf read exit.')
+            try:
+                pages = future.result(timeout=0.5)
+                break
+            except FutureTimeoutError:
+                continue
+        for idx, output in pages:
+            if continue_flag:
+                cf = continue_flag.check_continue_flag()
+                if not cf:
+                    raise ContinueExit('pdf read exit.')
+            yield idx, output
+
+    def __iter_pages__(self, file, start_page:int=0, end_page:int=-1):
+        """
+        lay out pages lazily, one at a time, so the first page is ready without parsing the whole document
+        start_page: 1-based first page, 0 is the first page
+        end_page: index after the last page, -1 to the end
+        output: a generator of (page index, page layout), the caller drops each layout after use
+        """
+        start = start_page - 1 if start_page > 0 else 0
+        end = end_page if end_page >= 0 else None
+        page_numbers = range(start, end) if end is not None else None
+        if page_numbers is None and start > 0:
+            page_numbers = _pages_from(start)
+        # maxpages stops parsing after the last page needed, 0 is no limit
+        pages = extract_pages(file, page_numbers=page_numbers, maxpages=end if end is not None else 0)
+        for idx, page in enumerate(pages, start=start):
+            yield idx, page
+
+    def __page_texts__(self, page, remove_mark=[], strip=True)->list[str]:
+        """
+        texts of the paragraphs (text containers) in the page layout
+        """
+        output = []
+        mark_pattern = self.__mark_pattern__(remove_mark)
+        for element in page:
+            if isinstance(element, LTTextContainer):
+                #
+                # this get_text is a paragraph
+                #
+                text = element.get_text() # this gets a paragraph
+                # do not include mark string line, remove the \n in the text, effectively this reconstruct a paragraph
+                text = self.__clean_text__(text, mark_pattern, strip=strip)
+                if text is None:
+                    continue
+                output.append(text)
+        return output
+
     def read_doc_to_texts_by_page(self, doc_path:str|bytes, start_page:int=0, end_page:int=-1, remove_mark=[], streaming=True, continue_flag:llm_continue=None):
         """
         read texts page by page
@@ -37,49 +205,14 @@ class PDFReaderWriter(IDocReaderWriter):
         if not valid: # either file does not exist, or file extension is not 'pdf'
             raise ValueError(f"PdfReaderWriter read document by block failed. either file is not {self.type}, or it does not exist! File: {doc_path}")
         else:
-            #else, read pdf. if bytes, use bytesIO
-            with io.BytesIO(doc_path) if type(doc_path) is bytes else open(doc_path, 'rb') as file:
-                pages = extract_pages(file)
-                page_list = list(pages)
-                num_pages = len(page_list)
-                # convert page number to index
-                start_page = start_page - 1 if (start_page > 0 and start_page <= num_pages) else 0 # if start_page is too large
-                end_page = num_pages if (end_page >= num_pages or end_page < 0) else end_page
-                assert start_page <= end_page
-                for idx in range(start_page, end_page):
-                    # check continue
-                    if continue_flag:
-                        cf = continue_flag.check_continue_flag()
-                        if not cf:
-                            raise ContinueExit()
-
-                    page = page_list[idx]
-                    output = []
-                    for element in page:
-                        if isinstance(element, LTTextContainer):
-                            #
-                            # this get_text is a paragraph
-                            #
-                            text = element.get_text() # this gets a paragraph
-                            text = text.strip(' ')
-                            mark_removed = False
-                            if len(remove_mark)>0:
-                                for mark in remove_mark:
-                                    if text.find(mark)>-1:
-                                        mark_removed = True
-                                        break
-                            if mark_removed: # do not include mark string line
-                                continue
-
-                            # remove the \n in the text, effectively this reconstruct a paragraph
-                            text = self.__remove_newline_from_text__(text)
-                            text = text.strip()
-                            output.append(text)
-                    text = '\n'.join(t for t in output) # join every paragraph in the page, seperate by '\n'
-                    result_item = [text, f"page_{idx}"]
+            #else, read pdf. if bytes, read from bytes
+            for idx, output in self.__iter_page_texts__(doc_path, start_page=start_page, end_page=end_page, remove_mark=remove_mark, continue_flag=continue_flag):
+                text = '\n'.join(output) # join every paragraph in the page, seperate by '\n'
+                result_item = [text, f"page_{idx}"]
+                if streaming:
+                    yield result_item # if streaming, yield this page
+                else:
                     result.append(result_item) # save page
-                    if streaming:
-                        yield result_item # if streaming, yield this page
         if not streaming:
             yield from result # if not streaming, yield from all pages instead
     
@@ -103,50 +236,15 @@ class PDFReaderWriter(IDocReaderWriter):
         if not valid: # either file does not exist, or file extension is not 'pdf'
             raise ValueError(f"PdfReaderWriter read document by block failed. either file is not {self.type}, or it does not exist! File: {doc_path}")
         else:
-            #else, read pdf. if bytes, use bytesIO
-            with io.BytesIO(doc_path) if type(doc_path) is bytes else open(doc_path, 'rb') as file:
-                pages = extract_pages(file)
-                page_list = list(pages)
-                num_pages = len(page_list)
-                # convert page number to index
-                start_page = start_page - 1 if (start_page > 0 and start_page <= num_pages) else 0 # if start_page is too large
-                end_page = num_pages if (end_page >= num_pages or end_page < 0) else end_page
-                assert start_page <= end_page
-                for idx in range(start_page, end_page):
-                    # check continue
-                    if continue_flag:
-                        cf = continue_flag.check_continue_flag()
-                        if not cf:
-                            raise ContinueExit('pdf read exit.')
-
-                    page = page_list[idx]
-                    output = []
-                    for element in page:
-                        if isinstance(element, LTTextContainer):
-                            #
-                            # this get_text is a paragraph
-                            #
-                            text = element.get_text()
-                            text = text.strip(' ') if strip else text
-                            mark_removed = False
-                            if len(remove_mark)>0:
-                                for mark in remove_mark:
-                                    if text.find(mark)>-1:
-                                        mark_removed = True
-                                        break
-                            if mark_removed: # do not include mark string line
-                                continue
-
-                            # remove the \n in the text
-                            text = self.__remove_newline_from_text__(text)
-                            text = text.strip() if strip else text
-                            output.append(text)
-
-                            # if streaming and read by 'paragraph'
-                            if streaming and read_by==2:
-                                yield [text, f"page_{idx}"]
+            #else, read pdf. if bytes, read from bytes
+            for idx, output in self.__iter_page_texts__(doc_path, start_page=start_page, end_page=end_page, remove_mark=remove_mark, strip=strip, continue_flag=continue_flag):
+                # if streaming and read by 'paragraph'
+                if streaming and read_by==2:
                     for text in output:
-                        result.append([text, f"page_{idx}"])
+                        yield [text, f"page_{idx}"]
+                    continue # streamed, not kept
+                for text in output:
+                    result.append([text, f"page_{idx}"])
         if not streaming or read_by==1:
             yield from result # if not streaming, or read by 'document'
 
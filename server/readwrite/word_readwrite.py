@@ -6,9 +6,28 @@
 
 # microsoft docx
 from docx import Document
+from docx.oxml.ns import qn
 from interface.interface_readwrite import IDocReaderWriter
 from interface.interface_model import llm_continue, ContinueExit
 
+W_LAST_RENDERED_PAGE_BREAK = qn('w:lastRenderedPageBreak')
+W_BR = qn('w:br')
+W_TYPE = qn('w:type')
+
+def run_page_breaks(run)->tuple[bool, bool]:
+    """
+    page breaks in the run, by its child elements, without serializing the run xml
+    output: softbreak (w:lastRenderedPageBreak), hardbreak (w:br w:type="page")
+    """
+    softbreak, hardbreak = False, False
+    for child in run._element:
+        tag = child.tag
+        if tag == W_LAST_RENDERED_PAGE_BREAK:
+            softbreak = True
+        elif tag == W_BR and child.get(W_TYPE) == 'page':
+            hardbreak = True
+    return softbreak, hardbreak
+
 class WordReaderWriter(IDocReaderWriter):
     TYPE = "docx"
 
@@ -42,6 +61,7 @@ class WordReaderWriter(IDocReaderWriter):
             #with io.BytesIO(doc_path) if type(doc_path) is bytes else open(doc_path, 'rb') as file:
             result = []
             softbreak = False #track softbreak, for softbreak there's text in the run to be handled
+            mark_pattern = self.__mark_pattern__(remove_mark)
             with open(doc_path, 'rb') as file: # read only
                 current_page = 0
                 document = Document(file)
@@ -59,21 +79,14 @@ class WordReaderWriter(IDocReaderWriter):
                         if not cf:
                             raise ContinueExit()
 
-                    run_length = len(parag.runs)
                     for idx, run in enumerate(parag.runs):
+                        run_text = run.text # built from the run elements on every access
                         # remove mark, if any
-                        mark_removed = False
-                        if len(remove_mark)>0:
-                            for mark in remove_mark:
-                                if run.text.find(mark)>-1:
-                                    mark_removed = True
-                                    break
-                        if mark_removed: # do not include mark string line
+                        if mark_pattern is not None and mark_pattern.search(run_text) is not None: # do not include mark string line
                             continue
 
                         # check page break
-                        softbreak = True if 'lastRenderedPageBreak' in run._element.xml else False
-                        hardbreak = True if ('w:br' in run._element.xml and 'type="page"' in run._element.xml) else False
+                        softbreak, hardbreak = run_page_breaks(run)
                         page_break = softbreak or hardbreak
                         # check start page
                         if check_start and start_page > 0:
@@ -93,7 +106,7 @@ class WordReaderWriter(IDocReaderWriter):
                             text = self.__remove_newline_from_text__(text)
                             text = text.strip()
                             output.append(text)
-                            text = '\n'.join(t for t in output) # for each page
+                            text = '\n'.join(output) # for each page
                             page_content = [text, f"page_{current_page}"]
                             result.append(page_content) # add to result
 
@@ -107,9 +120,9 @@ class WordReaderWriter(IDocReaderWriter):
                             text = ''
                             if softbreak:
                                 # treat softbreak text as a seperate paragraph, especially for pdf vs word comparation
-                                text = run.text # this soft pagebreak text
+                                text = run_text # this soft pagebreak text
                         else: # normal
-                            text += run.text
+                            text += run_text
 
                         if not check_end: # if so, meaning we have finished reading the end_page
                             break # break for run loop
@@ -125,7 +138,7 @@ class WordReaderWriter(IDocReaderWriter):
                         break # break for paragraph loop
                 # check any leftover
                 if len(output)>0:
-                    text = '\n'.join(t for t in output)
+                    text = '\n'.join(output)
                     page_content = [text, f"page_{current_page}"]
                     result.append(page_content) # add to result
 
@@ -165,6 +178,7 @@ class WordReaderWriter(IDocReaderWriter):
             check_start, check_end = True, True # flag to check start & end
             # if bytes, use bytesIO
             #with io.BytesIO(doc_path) if type(doc_path) is bytes else open(doc_path, 'rb') as file:
+            mark_pattern = self.__mark_pattern__(remove_mark)
             with open(doc_path, 'rb') as file: # read only
                 current_page = 0
                 document = Document(file)
@@ -181,25 +195,18 @@ class WordReaderWriter(IDocReaderWriter):
                             raise ContinueExit()
 
                     text = ''
-                    run_length = len(parag.runs)
                     for idx, run in enumerate(parag.runs):
+                        run_text = run.text # built from the run elements on every access
                         # remove mark, if any
-                        mark_removed = False
-                        if len(remove_mark)>0:
-                            for mark in remove_mark:
-                                if run.text.find(mark)>-1:
-                                    mark_removed = True
-                                    break
-                        if mark_removed: # do not include mark string line
+                        if mark_pattern is not None and mark_pattern.search(run_text) is not None: # do not include mark string line
                             continue
 
                         # check page break
-                        softbreak = True if 'lastRenderedPageBreak' in run._element.xml else False
-                        hardbreak = True if ('w:br' in run._element.xml and 'type="page"' in run._element.xml) else False
+                        softbreak, hardbreak = run_page_breaks(run)
 
                         if softbreak:
                             if reconstruct_paragraph_at_pagebreak: # if to make a complete paragraph
-                                text += run.text
+                                text += run_text
                             else: # treat softbreak text as a seperate paragraph, especially for pdf vs word comparation
                                 text = self.__remove_newline_from_text__(text)
                                 text = text.strip() if strip else text
@@ -209,9 +216,9 @@ class WordReaderWriter(IDocReaderWriter):
                                 if streaming and read_by == 2: # if streaming and read by 'paragraph'
                                     yield parag_content
 
-                                text = run.text # this soft pagebreak text
+                                text = run_text # this soft pagebreak text
                         else: # normal
-                            text += run.text
+                            text += run_text
 
                         page_break = softbreak or hardbreak
                         # check start page
@@ -0,0 +1,87 @@
+"""
+    a local stub of the ollama http api, for the tests and the benchmarks
+    Author: awtestergit
+"""
+
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class stub_ollama():
+    """
+    a local http server answering /api/tags, /api/embeddings and /api/chat as ollama does
+    delay: seconds an embeddings or chat request takes, or a function (path, request dict)->seconds, e.g., to model a prompt cache
+    status: http status of embeddings and chat, e.g., 500 for a failing host
+    words: the streamed chat answer, one word per chunk
+    word_seconds: if > 0, each chunk of a streamed chat is sent and flushed this many seconds apart, as ollama generates,
+        streamed counts the chunks sent, disconnected is set when the client closed the response
+    """
+    def __init__(self, port:int=0, delay=0., status=200, words=('a', 'b', 'c'), word_seconds=0.) -> None:
+        self.delay = delay
+        self.status = status
+        self.words = words
+        self.word_seconds = word_seconds
+        self.requests = 0
+        self.streamed = 0
+        self.disconnected = threading.Event()
+        self.__lock__ = threading.Lock()
+        stub = self
+        class handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def __reply__(self, status:int, body:bytes, content_type='application/json'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def __stream__(self, lines:list):
+                # no content length, the response ends when the connection closes
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                try:
+                    for line in lines:
+                        time.sleep(stub.word_seconds)
+                        self.wfile.write((json.dumps(line) + '\n').encode())
+                        self.wfile.flush()
+                        with stub.__lock__:
+                            stub.streamed += 1
+                except (BrokenPipeError, ConnectionResetError):
+                    stub.disconnected.set()
+            def do_GET(self):
+                if self.path == '/api/tags':
+                    self.__reply__(200, json.dumps({'models': []}).encode())
+                else:
+                    self.__reply__(404, b'{}')
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                with stub.__lock__:
+                    stub.requests += 1
+                time.sleep(stub.delay(self.path, request) if callable(stub.delay) else stub.delay)
+                if stub.status != 200:
+                    self.__reply__(stub.status, json.dumps({'error': 'stub failure'}).encode())
+                elif self.path == '/api/embeddings':
+                    self.__reply__(200, json.dumps({'embedding': [0.1, 0.2, 0.3]}).encode())
+                elif self.path == '/api/chat' and request.get('stream', False):
+                    lines = [{'model': 'm', 'message': {'role': 'assistant', 'content': word}, 'done': False} for word in stub.words]
+                    lines.append({'model': 'm', 'message': {'role': 'assistant', 'content': ''}, 'done': True})
+                    if stub.word_seconds > 0:
+                        self.__stream__(lines)
+                    else:
+                        self.__reply__(200, ''.join(json.dumps(line) + '\n' for line in lines).encode(), 'application/x-ndjson')
+                elif self.path == '/api/chat':
+                    self.__reply__(200, json.dumps({'model': 'm', 'message': {'role': 'assistant', 'content': 'abc'}, 'done': True}).encode())
+                else:
+                    self.__reply__(404, b'{}')
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,124 @@
+"""
+    abortable_stream of the server routes, stopped by /stop or by the client disconnecting
+        an OllamaModel stream_chat of a stub ollama generating slowly is streamed to the client,
+        once stopped, no further chunk is read from the backend, and the backend http response is closed
+    run from the server folder:
+        python -m pytest -q tests
+    Author: awtestergit
+"""
+
+import time
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from interface.interface_model import llm_continue, ContinueExit
+from models.llm import OllamaModel
+from ubox_server_fastapi import abortable_stream
+from tests.stub_ollama import stub_ollama
+
+class chat_app():
+    """
+    /chat streams the deltas of stream_chat through abortable_stream, /stop sets the continue flag, as the server routes do
+    """
+    def __init__(self, ollama:stub_ollama) -> None:
+        self.llm = OllamaModel(host=ollama.url, model='m')
+        self.continue_flag = llm_continue()
+        self.read = [] # deltas read from the backend
+        self.app = FastAPI()
+
+        @self.app.get('/chat')
+        async def chat(request:Request):
+            self.continue_flag.reset_stop_flag()
+            def body():
+                try:
+                    for delta in self.llm.stream_chat('hello', output_delta=True, continue_flag=self.continue_flag):
+                        self.read.append(delta)
+                        yield delta.encode()
+                except ContinueExit:
+                    return
+            return StreamingResponse(abortable_stream(request, body(), self.continue_flag), media_type='application/octet-stream')
+
+        @self.app.get('/stop')
+        async def stop():
+            self.continue_flag.set_stop_flag()
+            return PlainTextResponse('stopped')
+
+    async def call(self, path:str, disconnect:asyncio.Event=None)->list[bytes]:
+        """
+        one asgi request, the client disconnects when disconnect is set
+        output: the body chunks sent
+        """
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET', 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+                 'root_path': '', 'query_string': b'', 'headers': [], 'server': ('testserver', 80), 'client': ('testclient', 50000)}
+        disconnect = disconnect if disconnect is not None else asyncio.Event()
+        requested = False
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            await disconnect.wait()
+            return {'type': 'http.disconnect'}
+        chunks = []
+        async def send(message):
+            if message['type'] == 'http.response.body' and len(message.get('body', b'')) > 0:
+                chunks.append(message['body'])
+        await self.app(scope, receive, send)
+        return chunks
+
+async def wait_for(condition, timeout=5.):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    return condition()
+
+def assert_backend_stopped(ollama:stub_ollama, app:chat_app, read:int):
+    assert read < 200 # stopped long before the end of the answer
+    assert ollama.disconnected.wait(5) # the backend http response is closed
+    streamed = ollama.streamed
+    time.sleep(0.2)
+    assert ollama.streamed == streamed # the backend sends nothing more
+    assert len(app.read) <= read + 1 # at most the chunk read when the stop came
+
+def test_stop_route_stops_the_backend_stream():
+    ollama = stub_ollama(words=[f"w{i} " for i in range(200)], word_seconds=0.02)
+    app = chat_app(ollama)
+    async def run():
+        chat = asyncio.ensure_future(app.call('/chat'))
+        assert await wait_for(lambda: len(app.read) >= 3)
+        await app.call('/stop')
+        chunks = await asyncio.wait_for(chat, 5) # the response ends
+        return chunks, len(app.read)
+    try:
+        chunks, read = asyncio.run(run())
+        assert b''.join(chunks).decode() == ''.join(app.read)
+        assert_backend_stopped(ollama, app, read)
+    finally:
+        ollama.close()
+
+def test_client_disconnect_stops_the_backend_stream():
+    ollama = stub_ollama(words=[f"w{i} " for i in range(200)], word_seconds=0.02)
+    app = chat_app(ollama)
+    async def run():
+        disconnect = asyncio.Event()
+        chat = asyncio.ensure_future(app.call('/chat', disconnect))
+        assert await wait_for(lambda: len(app.read) >= 3)
+        disconnect.set() # http.disconnect
+        await asyncio.wait_for(chat, 5)
+        assert not app.continue_flag.check_continue_flag(timeout=0) # stopped as by /stop
+        return len(app.read)
+    try:
+        read = asyncio.run(run())
+        assert_backend_stopped(ollama, app, read)
+    finally:
+        ollama.close()
+
+def test_unstopped_stream_reads_the_whole_answer():
+    ollama = stub_ollama(words=[f"w{i} " for i in range(20)], word_seconds=0.005)
+    app = chat_app(ollama)
+    try:
+        chunks = asyncio.run(app.call('/chat'))
+        assert b''.join(chunks).decode() == ''.join(f"w{i} " for i in range(20))
+        assert not ollama.disconnected.is_set()
+    finally:
+        ollama.close()
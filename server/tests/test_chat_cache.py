@@ -0,0 +1,98 @@
+"""
+    chat_history_cache, chats added while the ring of a uid is loaded from or deleted in the db
+        the db read of the first get_recent_history is held until a chat of the same uid is added,
+        the chat must be in the ring and in the db afterwards, once each
+    run from the server folder:
+        python -m pytest -q tests
+    Author: awtestergit
+"""
+
+import threading
+import pytest
+from file_management.chat_manager import chat_history_mgr, chat_history_cache
+
+class held_chat_mgr(chat_history_mgr):
+    """
+    chat_history_mgr whose get_chat_history and delete_chat_history wait for 'proceed' once 'hold' is set
+    """
+    def __init__(self, db_path:str, db_name:str) -> None:
+        super().__init__(db_path, db_name)
+        self.hold = threading.Event()
+        self.holding = threading.Event()
+        self.proceed = threading.Event()
+
+    def __wait__(self):
+        if self.hold.is_set():
+            self.holding.set()
+            assert self.proceed.wait(5)
+
+    def get_chat_history(self, uuid:str, recent=-1)->list:
+        self.__wait__()
+        return super().get_chat_history(uuid, recent)
+
+    def delete_chat_history(self, uuid:str, keep_recent=-1):
+        self.__wait__()
+        super().delete_chat_history(uuid, keep_recent)
+
+@pytest.fixture
+def chat_mgr(tmp_path):
+    mgr = held_chat_mgr(str(tmp_path), 'chat.db')
+    yield mgr
+    mgr.close_db()
+
+def queries(rows)->list[str]:
+    return [row[0] for row in rows]
+
+def run_held(chat_mgr:held_chat_mgr, target, during):
+    # run target in a thread, call during while target is held in the db, then let it go
+    chat_mgr.hold.set()
+    thread = threading.Thread(target=target)
+    thread.start()
+    assert chat_mgr.holding.wait(5)
+    chat_mgr.hold.clear()
+    during()
+    chat_mgr.proceed.set()
+    thread.join(5)
+    assert not thread.is_alive()
+
+def test_chat_added_during_first_load_is_kept(chat_mgr):
+    cache = chat_history_cache(chat_mgr, capacity=10, flush_ms=10000) # the writer would not write q2 by itself
+    cache.add_chat('u', 'q1', 'a1')
+    loaded = []
+    run_held(chat_mgr, lambda: loaded.append(cache.get_recent_history('u', recent=10)), lambda: cache.add_chat('u', 'q2', 'a2'))
+    assert queries(loaded[0]) == ['q1', 'q2']
+    assert queries(cache.get_recent_history('u', recent=10)) == ['q1', 'q2'] # from the ring
+    cache.close()
+    assert queries(reversed(chat_mgr.get_chat_history('u'))) == ['q1', 'q2'] # written once
+
+def test_chat_added_during_delete_is_kept(chat_mgr):
+    cache = chat_history_cache(chat_mgr, capacity=10, flush_ms=10000)
+    for i in range(3):
+        cache.add_chat('u', f"q{i}", f"a{i}")
+    assert queries(cache.get_recent_history('u', recent=10)) == ['q0', 'q1', 'q2']
+    run_held(chat_mgr, lambda: cache.delete_chat_history('u', keep_recent=1), lambda: cache.add_chat('u', 'q3', 'a3'))
+    assert queries(cache.get_recent_history('u', recent=10)) == ['q2', 'q3']
+    cache.close()
+    assert queries(reversed(chat_mgr.get_chat_history('u'))) == ['q2', 'q3']
+
+def test_concurrent_chats_and_first_reads_agree_with_db(chat_mgr):
+    cache = chat_history_cache(chat_mgr, capacity=1000, flush_ms=5)
+    uids = [f"u{i}" for i in range(4)]
+    def add(uid:str, start:int):
+        for i in range(start, start + 50):
+            cache.add_chat(uid, f"q{i}", f"a{i}")
+    def read(uid:str):
+        for _ in range(20):
+            cache.get_recent_history(uid, recent=1000)
+            cache.evict(uid) # the next read loads again
+    threads = [threading.Thread(target=add, args=(uid, start)) for uid in uids for start in (0, 50)]
+    threads += [threading.Thread(target=read, args=(uid,)) for uid in uids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for uid in uids:
+        ring = cache.get_recent_history(uid, recent=1000)
+        assert sorted(queries(ring)) == sorted(f"q{i}" for i in range(100))
+        assert queries(ring) == queries(reversed(cache.get_chat_history(uid)))
+    cache.close()
@@ -0,0 +1,110 @@
+"""
+    ollama_host_pool against local stub ollama servers
+        balancing by outstanding requests, retry and ejection of a dead or failing host, and re-admission by the health check
+    run from the server folder:
+        python -m pytest -q tests
+    Author: awtestergit
+"""
+
+import time
+import socket
+import threading
+import pytest
+from models.ollama_pool import ollama_host_pool
+from tests.stub_ollama import stub_ollama
+
+def free_port()->int:
+    # a port nothing listens on, a dead host
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def embed(pool:ollama_host_pool):
+    return pool.call(lambda client: client.embeddings(model='m', prompt='hello'))
+
+@pytest.fixture
+def stubs():
+    created = []
+    def make(**kwargs)->stub_ollama:
+        stub = stub_ollama(**kwargs)
+        created.append(stub)
+        return stub
+    yield make
+    for stub in created:
+        stub.close()
+
+def test_least_outstanding_host_is_acquired(stubs):
+    a, b = stubs(), stubs()
+    pool = ollama_host_pool([a.url, b.url], health_interval=0)
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second # the busy host is not picked again
+    pool.release(first)
+    assert pool.acquire() is first # now the least outstanding
+    pool.release(first)
+    pool.release(second)
+    assert all(host.outstanding == 0 for host in pool.hosts)
+
+def test_concurrent_requests_spread_over_hosts(stubs):
+    a, b = stubs(delay=0.2), stubs(delay=0.2)
+    pool = ollama_host_pool([a.url, b.url], health_interval=0)
+    threads = [threading.Thread(target=embed, args=(pool,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert a.requests + b.requests == 8 and abs(a.requests - b.requests) <= 1
+    assert all(host.outstanding == 0 for host in pool.hosts)
+
+def test_dead_host_is_retried_and_ejected(stubs):
+    live = stubs()
+    dead_url = f"http://127.0.0.1:{free_port()}"
+    pool = ollama_host_pool([dead_url, live.url], max_failures=1, eject_seconds=60, health_interval=0)
+    dead = pool.hosts[0]
+    for _ in range(4):
+        assert embed(pool)['embedding'] == [0.1, 0.2, 0.3]
+    assert live.requests == 4
+    assert dead.failures == 1 # tried once, then ejected
+    assert dead.ejected_until > time.monotonic()
+    assert all(host.outstanding == 0 for host in pool.hosts)
+
+def test_failing_host_is_ejected_after_max_failures(stubs):
+    failing, live = stubs(status=500), stubs()
+    pool = ollama_host_pool([failing.url, live.url], max_failures=2, eject_seconds=60, health_interval=0)
+    bad = pool.hosts[0]
+    for _ in range(6):
+        embed(pool)
+    assert failing.requests == 2 # ejected at the second failure
+    assert bad.ejected_until > time.monotonic()
+    assert live.requests == 6
+
+def test_all_hosts_dead_raises():
+    pool = ollama_host_pool([f"http://127.0.0.1:{free_port()}", f"http://127.0.0.1:{free_port()}"], health_interval=0)
+    with pytest.raises(ConnectionError):
+        embed(pool)
+    assert all(host.outstanding == 0 for host in pool.hosts)
+
+def test_stream_retries_before_the_first_chunk(stubs):
+    live = stubs()
+    pool = ollama_host_pool([f"http://127.0.0.1:{free_port()}", live.url], max_failures=1, health_interval=0)
+    chunks = list(pool.stream(lambda client: client.chat(model='m', messages=[{'role': 'user', 'content': 'hi'}], stream=True)))
+    assert ''.join(chunk['message']['content'] for chunk in chunks) == 'abc'
+    assert all(host.outstanding == 0 for host in pool.hosts)
+
+def test_health_check_reinstates_a_recovered_host(stubs):
+    live = stubs()
+    port = free_port()
+    pool = ollama_host_pool([f"http://127.0.0.1:{port}", live.url], max_failures=1, eject_seconds=60, health_interval=0.1)
+    try:
+        embed(pool)
+        dead = pool.hosts[0]
+        assert dead.ejected_until > time.monotonic()
+        recovered = stubs(port=port) # the host comes back on its port
+        deadline = time.monotonic() + 5
+        while dead.ejected_until > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert dead.ejected_until == 0 and dead.failures == 0
+        embed(pool) # two idle hosts, the first is picked
+        assert recovered.requests == 1
+    finally:
+        pool.close()
@@ -0,0 +1,173 @@
+"""
+    single flight streams, identical streams in flight share one backend stream
+        identical stream_chat calls share one ollama request, a late joiner replays from the first item,
+        a stopped subscriber does not stop the others, the backend stream is closed once the last subscriber leaves
+    run from the server folder:
+        python -m pytest -q tests
+    Author: awtestergit
+"""
+
+import time
+import asyncio
+import threading
+from anbutils.single_flight import stream_flight, async_stream_flight
+from interface.interface_model import ContinueExit
+from models.llm import OllamaModel
+from tests.stub_ollama import stub_ollama
+
+class backend():
+    """
+    a backend stream of 0, 1, 2..., one item when released, or every interval seconds if set
+    """
+    def __init__(self, count=1000, interval=None) -> None:
+        self.count = count
+        self.interval = interval
+        self.made = 0 # make_stream calls
+        self.produced = 0
+        self.closed = threading.Event()
+        self.__release__ = threading.Semaphore(0)
+
+    def release(self, items=1):
+        for _ in range(items):
+            self.__release__.release()
+
+    def make_stream(self):
+        self.made += 1
+        try:
+            for idx in range(self.count):
+                if self.interval is None:
+                    assert self.__release__.acquire(timeout=5)
+                else:
+                    time.sleep(self.interval)
+                self.produced += 1
+                yield idx
+        finally:
+            self.closed.set()
+
+    async def amake_stream(self):
+        self.made += 1
+        try:
+            for idx in range(self.count):
+                await asyncio.sleep(self.interval)
+                self.produced += 1
+                yield idx
+        finally:
+            self.closed.set()
+
+def read(flight:stream_flight, source:backend, outputs:list, check=None):
+    # a subscriber thread, collects the items or the error
+    def run():
+        try:
+            for item in flight.subscribe('key', source.make_stream, check):
+                outputs.append(item)
+        except ContinueExit as e:
+            outputs.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+def wait_for(condition, timeout=5.):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+def test_identical_stream_chats_share_one_request():
+    ollama = stub_ollama(delay=0.3) # all requests are in flight together
+    try:
+        llm = OllamaModel(host=ollama.url, model='m')
+        outputs = [None] * 6
+        def chat(idx:int):
+            outputs[idx] = list(llm.stream_chat('hello', system_prompt='be brief'))
+        threads = [threading.Thread(target=chat, args=(idx,)) for idx in range(len(outputs))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        assert ollama.requests == 1
+        assert all(output == ['a', 'ab', 'abc', 'abc'] for output in outputs)
+        list(llm.stream_chat('hello', system_prompt='be brief')) # finished streams are not joined
+        assert ollama.requests == 2
+    finally:
+        ollama.close()
+
+def test_late_joiner_replays_from_the_first_item():
+    flight, source = stream_flight(), backend(count=5)
+    first, late = [], []
+    first_thread = read(flight, source, first)
+    source.release(2)
+    assert wait_for(lambda: len(first) == 2)
+    late_thread = read(flight, source, late) # joins after two items
+    source.release(3)
+    first_thread.join(5)
+    late_thread.join(5)
+    assert first == late == [0, 1, 2, 3, 4]
+    assert source.made == 1
+
+def test_stopped_subscriber_does_not_stop_the_others():
+    flight, source = stream_flight(), backend(count=5)
+    stop = threading.Event()
+    def check():
+        if stop.is_set():
+            raise ContinueExit()
+    stopped, others = [], [[], []]
+    stopped_thread = read(flight, source, stopped, check)
+    other_threads = [read(flight, source, outputs) for outputs in others]
+    source.release(2)
+    assert wait_for(lambda: len(stopped) == 2 and all(len(outputs) == 2 for outputs in others))
+    stop.set()
+    source.release(1)
+    stopped_thread.join(5)
+    assert isinstance(stopped[-1], ContinueExit) and stopped[:-1] == [0, 1, 2]
+    source.release(2)
+    for thread in other_threads:
+        thread.join(5)
+    assert others == [[0, 1, 2, 3, 4], [0, 1, 2, 3, 4]]
+    assert source.made == 1
+
+def test_backend_is_closed_when_the_last_subscriber_leaves():
+    flight = stream_flight()
+    source = backend(interval=0.01)
+    subscribers = [flight.subscribe('key', source.make_stream) for _ in range(3)]
+    for subscriber in subscribers:
+        assert next(subscriber) == 0
+    assert source.made == 1
+    for subscriber in subscribers[:-1]:
+        subscriber.close()
+    time.sleep(0.1)
+    assert not source.closed.is_set() # one subscriber is still reading
+    subscribers[-1].close()
+    assert source.closed.wait(5)
+    produced = source.produced
+    time.sleep(0.1)
+    assert source.produced == produced # nothing is read after the close
+    next(flight.subscribe('key', source.make_stream)) # a new stream, the stopped one is not joined
+    assert source.made == 2
+
+def test_async_late_joiner_and_close():
+    async def run():
+        flight = async_stream_flight()
+        source = backend(interval=0.01)
+        first = flight.subscribe('key', source.amake_stream)
+        assert [await first.__anext__() for _ in range(3)] == [0, 1, 2]
+        late = flight.subscribe('key', source.amake_stream)
+        assert [await late.__anext__() for _ in range(4)] == [0, 1, 2, 3] # replayed, then live
+        assert source.made == 1
+        await first.aclose()
+        await asyncio.sleep(0.05)
+        assert not source.closed.is_set()
+        await late.aclose()
+        await asyncio.sleep(0.05)
+        assert source.closed.is_set()
+        produced = source.produced
+        await asyncio.sleep(0.05)
+        assert source.produced == produced
+    asyncio.run(run())
+
+def test_disabled_flight_calls_make_stream_per_subscriber():
+    flight = stream_flight()
+    flight.enabled = False
+    source = backend(count=2, interval=0.)
+    assert list(flight.subscribe('key', source.make_stream)) == [0, 1]
+    assert list(flight.subscribe('key', source.make_stream)) == [0, 1]
+    assert source.made == 2
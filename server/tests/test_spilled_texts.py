@@ -0,0 +1,20 @@
+"""
+    spilled_texts round trip, the texts read back from disk are the texts written
+    run from the server folder:
+        python -m pytest -q tests
+    Author: awtestergit
+"""
+
+from frontend.session import spilled_texts
+
+def test_texts_round_trip_losslessly(tmp_path):
+    # lone surrogates, e.g., from a pdf with broken text, are kept rather than dropped
+    texts = ['the party shall', '甲方应当\ud800付款', '', 'emoji 😀', '\udcff']
+    spilled_texts.write(texts, str(tmp_path / 'texts.blob'), str(tmp_path / 'texts.offsets'))
+    spilled = spilled_texts(str(tmp_path / 'texts.blob'), str(tmp_path / 'texts.offsets'))
+    try:
+        assert len(spilled) == len(texts)
+        assert list(spilled) == texts
+        assert spilled[-1] == texts[-1] and spilled[1:3] == texts[1:3]
+    finally:
+        spilled.close()
@@ -0,0 +1,59 @@
+"""
+    AnbJsonStreamEncoder to AnbJsonStreamDecoder round trip
+        plain and deflate streams, coalesced deltas, and the output fed to the decoder in arbitrary pieces
+    run from the server folder:
+        python -m pytest -q tests
+    Author: awtestergit
+"""
+
+import random
+import pytest
+from interface.interface_stream import AnbJsonStreamCoder, AnbJsonStreamEncoder, AnbJsonStreamDecoder
+
+HEADER = {'type': 'answer', 'status': 'success'}
+
+def feed(decoder:AnbJsonStreamDecoder, data:bytes, rng:random.Random)->list:
+    # the decoder gets the bytes cut at random points, as the client receives them
+    outputs, offset = [], 0
+    while offset < len(data):
+        size = rng.randint(1, 17)
+        outputs.extend(decoder.decode(data[offset:offset+size]))
+        offset += size
+    return outputs
+
+def deltas(count:int)->list[dict]:
+    words = ['the', ' party', ' shall', ' 甲方', ' 应当', ' pay', '\n', ' "quoted"', ' \\']
+    return [{'answer': words[i % len(words)], 'source': 'doc' if i < count // 2 else 'web'} for i in range(count)]
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_frames_round_trip(compress):
+    encoder = AnbJsonStreamEncoder(header=HEADER, compress=compress)
+    objs = deltas(50)
+    data = b''.join(encoder.push(obj) for obj in objs)
+    data += encoder.encode({'answer': 'done'}, dict_header={'type': 'end'})
+    data += encoder.close()
+    outputs = feed(AnbJsonStreamDecoder(compress=compress), data, random.Random(compress))
+    assert outputs == [(HEADER, obj) for obj in objs] + [({'type': 'end'}, {'answer': 'done'})]
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_coalesced_deltas_round_trip(compress):
+    # never due by time, merged by size, split where the other keys change
+    encoder = AnbJsonStreamEncoder(header=HEADER, compress=compress, coalesce_key='answer', coalesce_ms=60000, coalesce_bytes=32)
+    objs = deltas(200)
+    data = b''.join(encoder.push(obj) for obj in objs)
+    assert encoder.pending_seconds() is not None # a tail is pending
+    data += encoder.close()
+    outputs = feed(AnbJsonStreamDecoder(compress=compress), data, random.Random(7))
+    assert all(header == HEADER for header, _ in outputs)
+    assert outputs[0][1] == objs[0] # the first delta is sent at once
+    assert len(outputs) < len(objs)
+    for source in ('doc', 'web'):
+        assert ''.join(obj['answer'] for _, obj in outputs if obj['source'] == source) == ''.join(obj['answer'] for obj in objs if obj['source'] == source)
+    assert [obj['source'] for _, obj in outputs] == sorted((obj['source'] for _, obj in outputs), key=['doc', 'web'].index) # order kept
+
+def test_encoder_frames_match_coder():
+    encoder = AnbJsonStreamEncoder(header=HEADER)
+    obj = {'answer': 'abc'}
+    assert encoder.push(obj) == AnbJsonStreamCoder.encode(HEADER, obj)
+    header, dict_obj, rest = AnbJsonStreamCoder.decode(encoder.push(obj) + b'\x00')
+    assert (header, dict_obj, rest) == (HEADER, obj, b'\x00')
@@ -6,8 +6,9 @@
 import logging
 import json
 from argparse import ArgumentParser
+import os
 import uvicorn
-from ubox_server_fastapi import create_app
+from ubox_server_fastapi import create_app, cleanup_temp_folders
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -18,6 +19,7 @@ if __name__ == "__main__":
     parser.add_argument("-log", "--log-file", dest="logfile", type=str, default="ubox_server.log", help="UBOX AI server log file.")
     parser.add_argument("-l", "--log", dest="logging", type=str, default="./ubox_server.log", help="UBOX Server logging file.")
     parser.add_argument("-k", "--openai-key", dest="openai_key", type=str, default='', help="set your openai key here to use OpenAI model.")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1, help="number of uvicorn worker processes, sessions are shared by a file store if more than 1.")
     args = parser.parse_args()
     logging_file = args.logging
 
@@ -42,5 +44,15 @@ if __name__ == "__main__":
         json.dump(config, f, indent=4)
 
 
-    app = create_app(openai_key=openai_key)
-    uvicorn.run(app, log_level='debug', host="0.0.0.0", port=local_port)
+    workers = args.workers
+    if workers > 1:
+        # each worker builds its own app, pass options by environment
+        # note: socket.io polling needs sticky sessions if behind a load balancer
+        os.environ['UBOX_OPENAI_KEY'] = openai_key
+        os.environ['UBOX_WORKERS'] = str(workers)
+        cleanup_temp_folders(background=True) # once, before workers start
+        uvicorn.run("ubox_server_fastapi:create_app_from_env", factory=True, workers=workers, log_level='debug', host="0.0.0.0", port=local_port)
+        cleanup_temp_folders() # after all workers exit
+    else:
+        app = create_app(openai_key=openai_key)
+        uvicorn.run(app, log_level='debug', host="0.0.0.0", port=local_port)
@@ -4,11 +4,12 @@
     AIGC ubox server, serving users with AI
     Author: awtestergit
 """
+import time
 import logging
 import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, UploadFile, Request, Form
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from werkzeug.utils import secure_filename
 import socketio
@@ -17,26 +18,106 @@ from dataclasses import asdict, dataclass
 from pydantic import BaseModel
 import traceback
 import json
+import glob
 import shutil
+from threading import Thread
 from qdrant_client import QdrantClient
 from file_management.file_manager import server_file_mgr, server_file_item
-from file_management.chat_manager import chat_history_mgr
-from interface.interface_stream import AnbJsonStreamCoder
+from file_management.chat_manager import chat_history_mgr, chat_history_cache
+from interface.interface_stream import AnbJsonStreamCoder, AnbJsonStreamEncoder
 from frontend.frontend_server import webui_handlers
+from anbutils import metrics
 from frontend.session import session_manager
-from interface.interface_model import llm_continue, ContinueExit
+from frontend.session_backend import SharedFileSessionBackend
+from interface.interface_model import llm_continue, ContinueExit, aiterate, aiterate_ticks, iterate_in_thread
 from qdrantclient_vdb.qdrant_manager import qcVdbManager
 from models.llm import OllamaModel, GPTModel
-from models.embed import OllamaNomicEmbeddingModel, GPTEmbeddingModel
+from anbutils.response_cache import llm_response_cache
+from anbutils import single_flight
+from anbutils.startup import dependency_startup
+from models.embed import OllamaNomicEmbeddingModel, GPTEmbeddingModel, read_probe_cache
 from models.reranker import OllamaReRankerModel
+from readwrite.pdf_readwrite import PDFReaderWriter, close_page_pool
 
 import os
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
-def create_app(openai_key=''):
+BASE_FOLDER = os.path.join('.','tmp')
+CHAT_FOLDER = os.path.join('.', 'history')
+
+def cleanup_temp_folders(background=False):
+    """
+    clean up all temps
+    background: if True, the folders are renamed aside at once and removed by a background thread, so startup does not wait
+        folders left aside by an earlier run are removed as well
+    """
+    trash = []
+    for folder in (BASE_FOLDER, CHAT_FOLDER):
+        trash.extend(glob.glob(f"{folder}.old-*"))
+        if os.path.exists(folder):
+            if not background:
+                trash.append(folder)
+                continue
+            aside = f"{folder}.old-{os.getpid()}-{time.time_ns()}"
+            try:
+                os.replace(folder, aside)
+                trash.append(aside)
+            except OSError: # can not rename, remove in place
+                trash.append(folder)
+                background = False
+    def remove_all():
+        for folder in trash:
+            try:
+                shutil.rmtree(folder)
+            except:
+                pass
+    if background:
+        Thread(target=remove_all, daemon=True, name='cleanup-temp').start()
+    else:
+        remove_all()
+
+async def abortable_stream(request:Request, body, continue_flag:llm_continue):
+    """
+    body, a sync or async iterator of the response bytes, aborted as by /stop if the client disconnects
+        the continue flag stops the model streams, the readers and the handlers still running for the client,
+        and the model streams close their http responses, so the backend stops generating
+    """
+    async def watch_disconnect():
+        while True:
+            message = await request.receive()
+            if message['type'] == 'http.disconnect':
+                logging.debug(f"..........{request.url.path} client disconnected, stop.")
+                continue_flag.set_stop_flag()
+                return
+    watcher = asyncio.ensure_future(watch_disconnect())
+    items = aiterate(body) if hasattr(body, '__aiter__') else iterate_in_thread(body)
+    completed = False
+    try:
+        async for chunk in items:
+            yield chunk
+        completed = True
+    finally:
+        watcher.cancel()
+        if not completed: # cancelled or closed by the server, the client is gone
+            continue_flag.set_stop_flag()
+        await items.aclose()
+
+def create_app_from_env():
+    """
+    app factory for 'uvicorn --workers N', options passed by environment variables
+        UBOX_OPENAI_KEY: openai key, if any
+        UBOX_WORKERS: number of worker processes
+    """
+    openai_key = os.environ.get('UBOX_OPENAI_KEY', '')
+    workers = int(os.environ.get('UBOX_WORKERS', '1'))
+    return create_app(openai_key=openai_key, workers=workers)
+
+def create_app(openai_key='', workers=1):
     """
     default is to use Ollama for LLM and embedding
     if openai_key is provided, LLM and embedding will use OpenAI
+    workers: if more than 1, this app runs in one of the worker processes, sessions are kept in a shared file store
+        and temp folders are cleaned up by the parent process instead
     """
     config_file = "config.json"
 
@@ -44,8 +125,9 @@ def create_app(openai_key=''):
     with open(config_file) as f:
         g_config = json.load(f)
 
-    base_folder = os.path.join('.','tmp')
-    chat_folder = os.path.join('.', 'history')
+    is_shared = workers > 1
+    base_folder = BASE_FOLDER
+    chat_folder = CHAT_FOLDER
     # add rest config
     g_config["BASEFOLDER"] = base_folder
     g_config["SQLITE_FOLDER"] = base_folder
@@ -70,42 +152,76 @@ def create_app(openai_key=''):
     except:
         raise ValueError("server config.json does not have client_ip/client_port/local_port setting. make sure these are set.")
 
-    # clean up all temps
-    if os.path.exists(g_config['SQLITE_FOLDER']):
-        try:
-            shutil.rmtree(g_config['SQLITE_FOLDER'])
-        except:
-            pass
-    if os.path.exists(g_config['SQLITE_CHATFOLDER']):
-        try:
-            shutil.rmtree(g_config['SQLITE_CHATFOLDER'])
-        except:
-            pass
+    # clean up all temps, removed in background
+    if not is_shared:
+        cleanup_temp_folders(background=True)
 
-    file_mgr = server_file_mgr(db_path=g_config['SQLITE_FOLDER'], db_name=g_config['SQLITE_NAME'], file_path=g_config['UPLOAD_FOLDER'])
+    file_mgr = server_file_mgr(db_path=g_config['SQLITE_FOLDER'], db_name=g_config['SQLITE_NAME'], file_path=g_config['UPLOAD_FOLDER'], purge=not is_shared)
     g_config['FILEMGR'] = file_mgr
     chat_mgr = chat_history_mgr(db_path=g_config['SQLITE_CHATFOLDER'], db_name=g_config['SQLITE_CHATDB'])
-    g_config['CHATMGR'] = chat_mgr
+    # recent history served from memory, chats written behind in batches
+    chat_cache_size = int(g_config['CHAT_HISTORY_CACHE']) if 'CHAT_HISTORY_CACHE' in g_config else 100 # chats kept per uid, 0 reads from db
+    chat_flush_ms = int(g_config['CHAT_FLUSH_MS']) if 'CHAT_FLUSH_MS' in g_config else 200 # batch chats written within ms
+    chat_cache = chat_history_cache(chat_mgr, capacity=chat_cache_size, flush_ms=chat_flush_ms, cache_reads=not is_shared) # workers share history through the db
+    g_config['CHATMGR'] = chat_cache
 
     # session
     expires_in_minutes = int(g_config['SESSION_EXPIRATION']) if 'SESSION_EXPIRATION' in g_config else 30 # default 30 minutes
-    session = session_manager(file_mgr=file_mgr, chat_mgr=chat_mgr, expiration=expires_in_minutes)
+    memory_budget = int(g_config['SESSION_MEMORY_BUDGET']) * 1024 * 1024 if 'SESSION_MEMORY_BUDGET' in g_config else 0 # in MB, default 0, no budget
+    stream_coalesce_ms = int(g_config['STREAM_COALESCE_MS']) if 'STREAM_COALESCE_MS' in g_config else 0 # coalesce streamed deltas within ms, default 0, no coalescing
+    stream_coalesce_bytes = int(g_config['STREAM_COALESCE_BYTES']) if 'STREAM_COALESCE_BYTES' in g_config else 0 # or until bytes pending
+    session_backend = SharedFileSessionBackend(folder=os.path.join(base_folder, 'sessions')) if is_shared else None # default in memory
+    session = session_manager(file_mgr=file_mgr, chat_mgr=chat_cache, expiration=expires_in_minutes, memory_budget=memory_budget, backend=session_backend)
+    # parse large pdfs by page ranges in a process pool, 0 is no pool
+    pdf_workers = int(g_config['PDF_WORKERS']) if 'PDF_WORKERS' in g_config else 0
+    pdf_min_pages = int(g_config['PDF_PARALLEL_MIN_PAGES']) if 'PDF_PARALLEL_MIN_PAGES' in g_config else 40
+    PDFReaderWriter.configure_parallel(workers=pdf_workers, min_pages=pdf_min_pages)
+    # metrics
+    metrics.set_trace(bool(g_config['METRICS_TRACE']) if 'METRICS_TRACE' in g_config else False) # per-request trace logging, default off
+    session_memory_gauge = metrics.registry.gauge('ubox_session_memory_bytes', 'bytes held in memory by sessions of this process')
+    session_memory_gauge.callback = lambda: session.memory_usage
+
+    # models and the vdb are started concurrently, in background if not ready in time
+    startup = dependency_startup(retry_seconds=int(g_config['STARTUP_RETRY_SECONDS']) if 'STARTUP_RETRY_SECONDS' in g_config else 5)
+    g_config['TOOLS'] = {}
 
     def server_preprocess():
         run_in_docker = g_config["RUN_IN_DOCKER"] == 1 # if running in a docker
         localhost = "127.0.0.1"
         max_embedding_dim = g_config['MAX_EMBEDDING_DIM']
+        chunk_tokens = int(g_config['CHUNK_TOKENS']) if 'CHUNK_TOKENS' in g_config else 512 # retrieval chunk size, the top chunks go into the llm prompt
         llm, embed = None, None
+        make_embed = None # if the embedding dimension is to be probed
         if len(openai_key) > 0:
             llm = GPTModel(openai_key)
-            embed = GPTEmbeddingModel(openai_key, max_embedding_dim=max_embedding_dim)
+            embed = GPTEmbeddingModel(openai_key, max_embedding_dim=max_embedding_dim, chunk_tokens=chunk_tokens)
         else:
             ollama_host = g_config["OLLAMA_HOST"] if run_in_docker else f"http://{localhost}:11434"
             ollama_model_name = g_config["OLLAMA_MODEL_NAME"]
             ollama_embed_name = g_config["OLLAMA_EMBED_NAME"]
             model_seq_length = g_config["MODEL_SEQ_LENGTH"]
-            llm = OllamaModel(host=ollama_host, model=ollama_model_name, max_context_length=model_seq_length)
-            embed = OllamaNomicEmbeddingModel(host=ollama_host, model=ollama_embed_name, max_context_length=model_seq_length, max_embedding_dim=max_embedding_dim)
+            ollama_keep_alive = g_config['OLLAMA_KEEP_ALIVE'] if 'OLLAMA_KEEP_ALIVE' in g_config else None # keep models loaded between bursts, e.g., '30m', -1 forever
+            ollama_num_ctx = int(g_config['OLLAMA_NUM_CTX']) if 'OLLAMA_NUM_CTX' in g_config else 0 # fixed context window, 0 is from MODEL_SEQ_LENGTH
+            # several ollama hosts serving the same models, empty is ollama_host only
+            ollama_llm_hosts = g_config['OLLAMA_LLM_HOSTS'] if 'OLLAMA_LLM_HOSTS' in g_config and len(g_config['OLLAMA_LLM_HOSTS']) > 0 else [ollama_host]
+            ollama_embed_hosts = g_config['OLLAMA_EMBED_HOSTS'] if 'OLLAMA_EMBED_HOSTS' in g_config and len(g_config['OLLAMA_EMBED_HOSTS']) > 0 else [ollama_host]
+            # embedding dimension from config, else from the probes of earlier runs, else probed at startup
+            probe_cache = g_config['MODEL_PROBE_CACHE'] if 'MODEL_PROBE_CACHE' in g_config else None
+            embed_dim = int(g_config['OLLAMA_EMBED_DIM']) if 'OLLAMA_EMBED_DIM' in g_config else 0
+            embed_dim = embed_dim if embed_dim > 0 else read_probe_cache(probe_cache, OllamaNomicEmbeddingModel.probe_key(ollama_embed_name))
+            llm = OllamaModel(host=ollama_llm_hosts, model=ollama_model_name, max_context_length=model_seq_length, keep_alive=ollama_keep_alive, num_ctx=ollama_num_ctx)
+            make_embed = lambda: OllamaNomicEmbeddingModel(host=ollama_embed_hosts, model=ollama_embed_name, max_context_length=model_seq_length, max_embedding_dim=max_embedding_dim, keep_alive=ollama_keep_alive, embedding_dim=embed_dim, probe_cache=probe_cache, chunk_tokens=chunk_tokens)
+            if embed_dim > 0: # no request
+                embed = make_embed()
+
+        # identical llm and embedding calls in flight share one backend call
+        single_flight.set_enabled(bool(g_config['MODEL_COALESCE']) if 'MODEL_COALESCE' in g_config else True)
+        # exact-match cache of non-streaming answers, e.g., extraction reruns
+        llm_cache_entries = int(g_config['LLM_CACHE_ENTRIES']) if 'LLM_CACHE_ENTRIES' in g_config else 0 # answers in memory, 0 is no cache
+        if llm_cache_entries > 0:
+            llm_cache_folder = g_config['LLM_CACHE_FOLDER'] if 'LLM_CACHE_FOLDER' in g_config else None # disk tier, kept across restarts
+            llm_cache_disk = int(g_config['LLM_CACHE_DISK_MB']) * 1024 * 1024 if 'LLM_CACHE_DISK_MB' in g_config else 0
+            llm.set_response_cache(llm_response_cache(max_entries=llm_cache_entries, folder=llm_cache_folder, max_disk_bytes=llm_cache_disk))
 
         # for reranker, skip it for now
         reranker = OllamaReRankerModel() # not yet supported by Ollama
@@ -113,36 +229,64 @@ def create_app(openai_key=''):
         #vdb
         vdb_ip = g_config['VDBIP'] if run_in_docker else localhost
         vdb_port = g_config['VDBPORT']
+        vdb_timeout = int(g_config['VDB_TIMEOUT']) if 'VDB_TIMEOUT' in g_config else 10 # seconds of a vdb request
         collection_name = g_config['VDBNAME']
-        client = QdrantClient(vdb_ip, port=vdb_port)
-        vdbmanager = qcVdbManager(model=embed,collection_name=collection_name,client=client)
-        # get tools from vdb
-        doctypes = vdbmanager.get_doctype()
-        tools = {} #{tool_name: tool desc}
-        for doctype in doctypes:
-            tool_name = doctype.type
-            tool_desc = doctype.description
-            tools[f"knowledge_{tool_name}"] = tool_desc # tool name: knowledge_AI
-
-        g_config['TOOLS'] = tools
+        def make_vdb(embed)->qcVdbManager:
+            client = QdrantClient(vdb_ip, port=vdb_port, timeout=vdb_timeout)
+            vdbmanager = qcVdbManager(model=embed,collection_name=collection_name,client=client)
+            # get tools from vdb
+            doctypes = vdbmanager.get_doctype()
+            tools = {} #{tool_name: tool desc}
+            for doctype in doctypes:
+                tool_name = doctype.type
+                tool_desc = doctype.description
+                tools[f"knowledge_{tool_name}"] = tool_desc # tool name: knowledge_AI
+            g_config['TOOLS'] = tools
+            return vdbmanager
+
+        def install_vdb(vdbmanager:qcVdbManager):
+            g_config['VDBMGR'] = vdbmanager
+            if 'WEBHANDLER' in g_config:
+                g_config['WEBHANDLER'].vdb_mgr = vdbmanager
 
         ocr_model = None
 
-        web_handler = webui_handlers(llm=llm, emb_model=embed, reranker_model=reranker, ocr=ocr_model, vdb_mgr=vdbmanager)
-        g_config['WEBHANDLER'] = web_handler
+        diff_engine = g_config['COMPARE_DIFF_ENGINE'] if 'COMPARE_DIFF_ENGINE' in g_config else 'token' # 'token' or 'differ'
+        diff_workers = int(g_config['COMPARE_DIFF_WORKERS']) if 'COMPARE_DIFF_WORKERS' in g_config else 0 # process pool size to diff page pairs, 0 is no pool
+        align_blocks = bool(g_config['COMPARE_ALIGN']) if 'COMPARE_ALIGN' in g_config else True # align pages/paragraphs by content before diffing
+        align_window = int(g_config['COMPARE_ALIGN_WINDOW']) if 'COMPARE_ALIGN_WINDOW' in g_config else 32 # blocks read ahead to align, pairs stream as they are aligned
+        prompt_token_budget = int(g_config['PROMPT_TOKEN_BUDGET']) if 'PROMPT_TOKEN_BUDGET' in g_config else 0 # doc_know prompt tokens, 0 is the llm's limit
+        def install_handler(embed):
+            # the vdb is set when it is ready
+            vdbmanager = g_config['VDBMGR'] if 'VDBMGR' in g_config else None
+            web_handler = webui_handlers(llm=llm, emb_model=embed, reranker_model=reranker, ocr=ocr_model, vdb_mgr=vdbmanager, diff_engine=diff_engine, diff_workers=diff_workers, align_blocks=align_blocks, align_window=align_window, prompt_token_budget=prompt_token_budget)
+            g_config['WEBHANDLER'] = web_handler
+
+        # the models are loaded by the backend, the vdb collections are checked, all at the same time
+        startup.add('llm', llm.warmup)
+        if embed is not None:
+            install_handler(embed)
+            startup.add('embedding', embed.warmup)
+            startup.add('vdb', lambda: make_vdb(embed), on_ready=install_vdb)
+        else: # the handler and the vdb wait for the probe
+            startup.add('embedding', make_embed, on_ready=install_handler)
+            startup.add('vdb', lambda: make_vdb(startup.result('embedding')), on_ready=install_vdb, after=['embedding'])
+        startup.start()
 
     def server_shutdown():
-        # clean up all temps
-        if os.path.exists(g_config['SQLITE_FOLDER']):
-            try:
-                shutil.rmtree(g_config['SQLITE_FOLDER'])
-            except:
-                pass
-        if os.path.exists(g_config['SQLITE_CHATFOLDER']):
-            try:
-                shutil.rmtree(g_config['SQLITE_CHATFOLDER'])
-            except:
-                pass
+        startup.close()
+        # finish pending session cleanups
+        session.close(timeout=10)
+        # stop diff and pdf workers
+        if 'WEBHANDLER' in g_config:
+            g_config['WEBHANDLER'].close()
+        close_page_pool()
+        # write pending chats
+        chat_cache.close(timeout=10)
+        chat_mgr.close_db()
+        # clean up all temps, if shared, the parent process does it after all workers exit
+        if not is_shared:
+            cleanup_temp_folders()
 
     async def periodic_cleanup():
         schedule = 60 * g_config["CLEANUP_SCHEDULE"] if "CLEANUP_SCHEDULE" in g_config else 60 # default 60 seconds
@@ -175,10 +319,24 @@ def create_app(openai_key=''):
     def yield_response_bytes(r): # client use reader().read, so yield
         yield r
 
+    STARTING_REASON = 'The server is starting, please try again shortly.'
+
+    def get_web_handler()->webui_handlers:
+        # None till the embedding dependency is ready and the handler is installed
+        return g_config.get('WEBHANDLER', None)
+
+    def starting_stream_response(reason=STARTING_REASON):
+        # a 'fail' stream with the reason, as the other failures of the streaming routes, 503 as /ready
+        r = dc_response_header()
+        r.status = 'fail'
+        r.reason = reason
+        response_bytes = AnbJsonStreamCoder.encode(asdict(r), {})
+        return StreamingResponse(yield_response_bytes(response_bytes), media_type='application/octet-stream', status_code=503)
+
     def get_reset_continue_flag(uid:str):
         # create continueflag session
         if not session.get_session_key(uid, session.CONTINUE_KEY):
-            cf = llm_continue()
+            cf = session.new_continue_flag(uid)
             session.set_session(uid, session.CONTINUE_KEY, cf) # set
 
         # reset continue flag
@@ -192,6 +350,10 @@ def create_app(openai_key=''):
     async def lifespan(app: FastAPI):
         #preprocess
         server_preprocess()
+        # serve once the dependencies are ready or the timeout passes, the rest keep starting in background
+        startup_timeout = float(g_config['STARTUP_TIMEOUT']) if 'STARTUP_TIMEOUT' in g_config else 30
+        if not await asyncio.to_thread(startup.wait, startup_timeout):
+            logging.warning(f"startup: not ready in {startup_timeout}s, serving while starting: {startup.status()}")
         # Schedule session cleanup periodically
         asyncio.create_task(periodic_cleanup())
         # print out client connection
@@ -204,6 +366,8 @@ def create_app(openai_key=''):
         print("************************************************")
         yield
         # Clean up 
+        if 'WEBHANDLER' in g_config:
+            await g_config['WEBHANDLER'].aclose()
         server_shutdown()
 
     def cors_allowed():
@@ -230,6 +394,7 @@ def create_app(openai_key=''):
     logging.debug(f"..........cors allowed: {origins}")
 
     app = FastAPI(lifespan=lifespan, debug=True)
+    app.add_middleware(metrics.MetricsMiddleware, paths=['/doc_upload', '/dochat_chat', '/doctract', '/docompare', '/docknow'])
     app.add_middleware(
         CORSMiddleware,
         allow_origins=origins,
@@ -247,6 +412,18 @@ def create_app(openai_key=''):
     def init():
         return 'success'
 
+    @app.get('/ready')
+    def ready():
+        # readiness of this worker, 503 until all dependencies are warm
+        is_ready = startup.is_ready()
+        content = {'ready': is_ready, 'dependencies': startup.status()}
+        return JSONResponse(content, status_code=200 if is_ready else 503)
+
+    @app.get('/metrics')
+    def get_metrics():
+        # prometheus text format
+        return PlainTextResponse(metrics.registry.render(), media_type='text/plain; version=0.0.4')
+
     @app.post('/doc_upload')
     async def doc_upload(file: UploadFile, uid:str = Form(...), ocr:int = Form(...), read_by:int = Form(...)):
 
@@ -267,6 +444,14 @@ def create_app(openai_key=''):
             r.reason = 'No files uploaded!'
             response_json = asdict(r)
             return response_json
+
+        # get web handler
+        web_handler:webui_handlers = get_web_handler()
+        if web_handler is None:
+            r = dc_response_header()
+            r.status = 'fail'
+            r.reason = STARTING_REASON
+            return JSONResponse(asdict(r), status_code=503)
         
         filename = secure_filename(file.filename)
         # set session id
@@ -292,11 +477,9 @@ def create_app(openai_key=''):
                 contents = await file.read()
                 f.write(contents)
 
-            # get web handler
-            web_handler:webui_handlers = g_config['WEBHANDLER']
             # build index
             with open(saved_filepaths[0]) as f:
-                index, texts = web_handler.doc_upload(f, is_ocr, read_by=read_by, continue_flag=continue_flag)
+                index, texts = await web_handler.adoc_upload(f, is_ocr, read_by=read_by, continue_flag=continue_flag)
                 # save to session
                 session.set_session(uid, session.FAISS_KEY, index)
                 session.set_session(uid, session.FAISS_TEXTS, texts)
@@ -327,9 +510,10 @@ def create_app(openai_key=''):
             await file.close() # close
 
     @app.get('/dochat_chat')
-    async def dochat_chat(uid:str, q:str, words:int):
+    async def dochat_chat(request: Request, uid:str, q:str, words:int):
         """
         """
+        meter = metrics.stream_meter('/dochat_chat')
         faiss_index=None
         texts = []
         query = q
@@ -367,25 +551,28 @@ def create_app(openai_key=''):
             r_bytes = AnbJsonStreamCoder.encode(r_header, r_obj)
             return StreamingResponse(yield_response_bytes(r_bytes), media_type='application/octet-stream')
 
+        # get web handler
+        web_handler:webui_handlers = get_web_handler()
+        if web_handler is None:
+            return starting_stream_response()
+
         # get and reset continue flag
         continue_flag:llm_continue = get_reset_continue_flag(uid)
 
-        # get web handler
-        web_handler:webui_handlers = g_config['WEBHANDLER']
         reranker_conf = g_config['RERANKCONF']
         reranker_min_score = g_config['RERANKMINSCORE']
         ###
-        # use asyncio.to thread to await for all web_handler long executions
-        # this await will enable stop event to be executed in between long executions
-        results = await asyncio.to_thread(web_handler.doc_question, query=query, words=words, faiss_index=faiss_index, texts=texts, rerank_threshold=reranker_conf, rerank_min_score=reranker_min_score, continue_flag=continue_flag)
+        # the async model clients stream in the event loop, a stream costs a coroutine, not a thread
+        results = web_handler.adoc_question(query=query, words=words, faiss_index=faiss_index, texts=texts, rerank_threshold=reranker_conf, rerank_min_score=reranker_min_score, continue_flag=continue_flag)
         
         async def convert_results_to_stream(results):
             error = None # exception
             try:
-                for output in results:
+                async for output in results:
                     status  = output['status']
                     r = dc_response_header()
                     if status == 0: # success
+                        meter.token()
                         r.status = 'success'
                         r_header = asdict(r)
                         r_obj = {
@@ -421,6 +608,7 @@ def create_app(openai_key=''):
                 error = traceback.format_exc()
                 #print(f"exception error: {error}; e is: {e}")
                 logging.error(f"exception error: {error}")
+            meter.done()
 
             # if error
             if error is not None:
@@ -445,7 +633,7 @@ def create_app(openai_key=''):
 
         rs = convert_results_to_stream(results)
         # use application/octet-stream mimetype
-        return StreamingResponse(rs, media_type='application/octet-stream')
+        return StreamingResponse(abortable_stream(request, rs, continue_flag), media_type='application/octet-stream')
 
     class elements_in(BaseModel):
         #elements:list = lambda: []
@@ -453,7 +641,7 @@ def create_app(openai_key=''):
         uid:str
 
     @app.post('/doctract')
-    async def doctract(params: elements_in):
+    async def doctract(request: Request, params: elements_in):
         """
         """
         results = None
@@ -483,12 +671,15 @@ def create_app(openai_key=''):
             logging.warning(f".........in doctract: {r_bytes}")
             return StreamingResponse(yield_response_bytes(r_bytes),media_type='application/octet-stream')
 
+        # get web handler
+        web_handler:webui_handlers = get_web_handler()
+        if web_handler is None:
+            return starting_stream_response()
+
         # get and reset continue flag
         continue_flag = get_reset_continue_flag(uid)
 
         try:
-            # get web handler
-            web_handler:webui_handlers = g_config['WEBHANDLER']
             rerank_threshold = g_config['RERANKCONF']
             rerank_min_score = g_config['RERANKMINSCORE']
             results = await asyncio.to_thread(web_handler.doc_extract, elements, faiss_index=faiss_index, texts=texts, rerank_threshold=rerank_threshold, rerank_min_score=rerank_min_score, continue_flag=continue_flag)
@@ -569,7 +760,7 @@ def create_app(openai_key=''):
 
         rs = convert_results_to_stream(results)
         # use application/octet-stream mimetype
-        return StreamingResponse(rs,media_type='application/octet-stream')
+        return StreamingResponse(abortable_stream(request, rs, continue_flag),media_type='application/octet-stream')
 
     @app.post('/docompare')
     #async def docompare(A:UploadFile, B:UploadFile, uid:str, compare:str, a_ocr:str, b_ocr:str):
@@ -626,6 +817,11 @@ def create_app(openai_key=''):
         #print(f"client file info: {a_filename}, {b_filename}, {uid}, {compare_by}")
         logging.debug(f"client file info: {a_filename}, {b_filename}, {uid}, {compare_by}")
 
+        # get web handler
+        web_handler:webui_handlers = get_web_handler()
+        if web_handler is None:
+            return starting_stream_response()
+
         # get and reset continue flag
         continue_flag:llm_continue = get_reset_continue_flag(uid)
 
@@ -645,9 +841,6 @@ def create_app(openai_key=''):
             contents = await b_file.read()
             f.write(contents)
 
-        # get web handler
-        web_handler:webui_handlers = g_config['WEBHANDLER']
-
         # processing
         def compare_proc():
             error = None
@@ -718,7 +911,7 @@ def create_app(openai_key=''):
             # end
             return
 
-        return StreamingResponse(compare_proc(), media_type='application/octet-stream')
+        return StreamingResponse(abortable_stream(request, compare_proc(), continue_flag), media_type='application/octet-stream')
 
 
     @app.get('/docknow_clear_history')
@@ -734,8 +927,8 @@ def create_app(openai_key=''):
         error = None
         try:
             recent = int(recent) if len(recent)>0 else -1
-            chat_mgr:chat_history_mgr = g_config['CHATMGR']
-            chat_mgr.delete_chat_history(uuid=uid, keep_recent=recent)
+            chat_mgr:chat_history_cache = g_config['CHATMGR']
+            await asyncio.to_thread(chat_mgr.delete_chat_history, uuid=uid, keep_recent=recent) # waits for the uid's pending chats
         except:
             error = traceback.format_exc()
         status = 'success' if error is None else 'fail'
@@ -749,6 +942,7 @@ def create_app(openai_key=''):
     async def docknow(request: Request):
         """
         """
+        meter = metrics.stream_meter('/docknow')
         params = await request.form()
         uid = params.get('uid')
         query = params.get('query')
@@ -761,6 +955,7 @@ def create_app(openai_key=''):
         repetition_penalty = params.get('repetition_penalty')
         faq_conf = params.get('faq_conf')
         vdb_conf = params.get('vdb_conf')
+        compress = params.get('compress') # if '1', the stream is deflate compressed
 
         is_same_uid = session.cross_check_uid_in_session(uid)
         if not is_same_uid:
@@ -814,16 +1009,18 @@ def create_app(openai_key=''):
             return StreamingResponse(yield_response_bytes(r_bytes), media_type='application/octet-stream')
 
 
-        # get web handler
-        web_handler:webui_handlers = g_config['WEBHANDLER']
+        # get web handler, the knowledge base needs the vdb too
+        web_handler:webui_handlers = get_web_handler()
+        if web_handler is None or not startup.is_ready('vdb'):
+            return starting_stream_response('The knowledge base is starting, please try again shortly.')
         reranker_conf = g_config['RERANKCONF']
         reranker_min_score = g_config['RERANKMINSCORE']
         # chat history
         chat_history = []
         try:
-            chat_mgr:chat_history_mgr = g_config['CHATMGR']
-            chat_history = chat_mgr.get_chat_history(uuid=uid, recent=recent_history)
-            chat_history = [(history[0], history[1]) for history in reversed(chat_history)] # chat_history was [query, answer, time], get rid of time
+            chat_mgr:chat_history_cache = g_config['CHATMGR']
+            # may wait for the uid's pending chats and read the db, off the event loop
+            chat_history = await asyncio.to_thread(chat_mgr.get_recent_history, uuid=uid, recent=recent_history) # [(query, answer)...], oldest first
         except (ContinueExit, GeneratorExit):
             # log
             #print('..............docknow @ 2 received stop signal.')
@@ -840,36 +1037,48 @@ def create_app(openai_key=''):
         streaming_delta = True # only delta
         # get and reset continue flag
         continue_flag:llm_continue = get_reset_continue_flag(uid)
-        results = await asyncio.to_thread(web_handler.doc_know, query=query, tools=tools, history=chat_history, faq_conf=faq_conf, vdb_conf=vdb_conf, rerank_threshold=reranker_conf, rerank_min_score=reranker_min_score, bot_name=bot_name, streaming=True, streaming_delta=streaming_delta, continue_flag=continue_flag, **kwargs)
-        def convert_results_to_stream(results):
+        # retrieval runs in a thread, the answer streams from the async llm client in the event loop
+        results = await asyncio.to_thread(web_handler.doc_know, query=query, tools=tools, history=chat_history, faq_conf=faq_conf, vdb_conf=vdb_conf, rerank_threshold=reranker_conf, rerank_min_score=reranker_min_score, bot_name=bot_name, streaming=True, streaming_delta=streaming_delta, continue_flag=continue_flag, async_stream=True, **kwargs)
+        # one encoder per stream, the 'success' header is serialized once
+        is_compress = compress == '1'
+        r = dc_response_header()
+        r.status = 'success'
+        encoder = AnbJsonStreamEncoder(header=asdict(r), compress=is_compress, coalesce_key='answer' if stream_coalesce_ms > 0 else None, coalesce_ms=stream_coalesce_ms, coalesce_bytes=stream_coalesce_bytes)
+        async def convert_results_to_stream(results):
             error = None # exception
             full_answer = ''
             # results: [iterator, sources]
             sources = results[1]
             answers = results[0]
             try:
-                for answer in answers:
+                # ticks None when the coalesced deltas are due and no token came, e.g., slow generation
+                async for answer in aiterate_ticks(answers, encoder.pending_seconds): # an async stream, or a list of the FAQ answer
+                    if answer is None:
+                        r_bytes = encoder.flush()
+                        if len(r_bytes) > 0:
+                            yield r_bytes
+                        continue
+                    meter.token()
                     full_answer += answer
-                    r = dc_response_header()
-                    r.status = 'success'
-                    r_header = asdict(r)
                     r_obj = {
                         'answer': answer,
                         'sources': '',
                     }
-                    r_bytes = AnbJsonStreamCoder.encode(r_header,r_obj)
-                    yield r_bytes
+                    start = time.perf_counter()
+                    r_bytes = encoder.push(r_obj)
+                    meter.encode_seconds += time.perf_counter() - start
+                    if len(r_bytes) > 0: # empty if coalesced
+                        yield r_bytes
+                meter.done()
                 # now send 'sources'
                 for source in sources:
-                    r = dc_response_header()
-                    r.status = 'success'
-                    r_header = asdict(r)
                     r_obj = {
                         'answer': '',
                         'sources': source,
                     }
-                    r_bytes = AnbJsonStreamCoder.encode(r_header,r_obj)
-                    yield r_bytes
+                    r_bytes = encoder.push(r_obj)
+                    if len(r_bytes) > 0:
+                        yield r_bytes
 
             except (ContinueExit, GeneratorExit):
                 # log
@@ -898,7 +1107,7 @@ def create_app(openai_key=''):
                 r.reason = f"an error happened. technical details: {error}"
                 r_header = asdict(r)
                 r_obj = {}
-                r_bytes = AnbJsonStreamCoder.encode(r_header, r_obj)
+                r_bytes = encoder.encode(r_obj, r_header) # pending deltas go first
                 yield r_bytes
 
             # send 'end'
@@ -906,13 +1115,14 @@ def create_app(openai_key=''):
             r.status = 'end'
             r_header = asdict(r)
             r_obj = {}
-            r_bytes = AnbJsonStreamCoder.encode(r_header, r_obj)
-            yield r_bytes
+            r_bytes = encoder.encode(r_obj, r_header)
+            yield r_bytes + encoder.close()
             # end
 
         rs = convert_results_to_stream(results)
-        # use application/octet-stream mimetype
-        return StreamingResponse(rs, media_type='application/octet-stream')
+        # use application/octet-stream mimetype, the client decodes 'deflate' as the stream arrives
+        headers = {'Content-Encoding': 'deflate'} if is_compress else None
+        return StreamingResponse(abortable_stream(request, rs, continue_flag), media_type='application/octet-stream', headers=headers)
 
     @app.get('/stop')
     async def stop_gen(uid:str):
@@ -974,13 +1184,9 @@ def create_app(openai_key=''):
             # clear all key/value
             session.remove_session_sid(sid)
             session.remove_session(uid) # remove uid k/v, should have been removed at remove_session_sid, but in case...
-            # clear files
+            # clear files and history, in background
             if uid:
-                mgr:server_file_mgr = g_config['FILEMGR']
-                mgr.delete_file_remove_path_from_db(uuid=uid)
-                # clear history
-                chat_mgr:chat_history_mgr = g_config['CHATMGR']
-                chat_mgr.delete_chat_history(uuid=uid)
+                session.schedule_cleanup(uid)
         except Exception:
             e = traceback.format_exc()
             #print(f"client disconnect exception: {e}")
@@ -26,6 +26,7 @@ from qdrantclient_vdb.qdrant_base import doctype_schema, file_schema, chunk_sche
 from interface.interface_readwrite import *
 from readwrite.pdf_readwrite import PDFReaderWriter
 from readwrite.word_readwrite import WordReaderWriter
+from anbutils import text_chunker
 
 def main(
         collection_name = 'vdb_ubox',
@@ -45,6 +46,9 @@ def main(
             config['OCR_DET'] = _config['OCR_DET']
             config['OCR_CLS'] = _config['OCR_CLS']
             config['OCR_REC'] = _config['OCR_REC']
+            # parse large pdfs by page ranges in a process pool
+            if 'PDF_WORKERS' in _config:
+                PDFReaderWriter.configure_parallel(workers=int(_config['PDF_WORKERS']), min_pages=int(_config['PDF_PARALLEL_MIN_PAGES']) if 'PDF_PARALLEL_MIN_PAGES' in _config else 40)
     except:
         e = traceback.format_exc()
         logging.error(f"loading config.json failed. {e}")
@@ -288,10 +292,10 @@ def main(
                 if file_obj is not None:# new file uploaded
                     reader:IDocReaderWriter = __get_reader_by_filename__(filename=file_obj)
                     text_source = reader.read_doc_to_texts_with_source(file_obj)
-                    max_length = webui_manager.manager.model.MAX_LENGTH
-                    overlap = int(max_length/20)
+                    model = webui_manager.manager.model
+                    overlap = int(model.CHUNK_TOKENS/20) # overlap tokens
                     overlap = overlap if overlap <= 50 else 50
-                    text_source = utilities.convert_text_with_source_list_to_chunks(text_source=text_source, doc_path=source_from, chunk_size=max_length, overlap=overlap, merge=True)
+                    text_source = text_chunker.iter_chunks(text_source, max_tokens=model.CHUNK_TOKENS, overlap_tokens=overlap, count_tokens=model.count_tokens, doc_path=source_from)
                 webui_manager.update_fileinfo(file_id=file_id, file_desc=file_desc, file_full_path=source_from, file_creation_time=creation_time, chunks=text_source)
                 status = f"DocID:{file_id} {status}"
             except Exception as e:
@@ -347,10 +351,10 @@ def main(
                     file_time_creation = datetime.strptime(file_time_creation, webui_manager.time_format)
                     reader:IDocReaderWriter = __get_reader_by_filename__(filename=file_obj)
                     texts = reader.read_doc_to_texts_with_source(file_obj, remove_mark=remove_mark)
-                    max_length = webui_manager.manager.model.MAX_LENGTH
-                    overlap = int(max_length/20)
+                    model = webui_manager.manager.model
+                    overlap = int(model.CHUNK_TOKENS/20) # overlap tokens
                     overlap = overlap if overlap <= 50 else 50
-                    texts = utilities.convert_text_with_source_list_to_chunks(text_source=texts, doc_path=source_from, chunk_size=max_length, overlap=overlap, merge=True)
+                    texts = text_chunker.iter_chunks(texts, max_tokens=model.CHUNK_TOKENS, overlap_tokens=overlap, count_tokens=model.count_tokens, doc_path=source_from)
                     doctype:doctype_schema = webui_manager.get_doctype_by_type(_type)
                     orig_file_id = doctype.file_ids[-1] # use the last id
                     result = webui_manager.insert_duplicate(orig_file_id=orig_file_id, file_full_path=source_from, file_creation_time=file_time_creation, file_desc=file_desc, chunks=texts)
@@ -393,10 +397,10 @@ def main(
                     file_time_creation = df['DocVersion'][idx]
                     file_time_creation = None if (file_time_creation is None or len(file_time_creation)==0) else datetime.strptime(file_time_creation, webui_manager.time_format)
                     file_desc = df['DocDescription'][idx]
-                    max_length = webui_manager.manager.model.MAX_LENGTH
-                    overlap = int(max_length/20)
+                    model = webui_manager.manager.model
+                    overlap = int(model.CHUNK_TOKENS/20) # overlap tokens
                     overlap = overlap if overlap <= 50 else 50
-                    texts = utilities.convert_text_with_source_list_to_chunks(text_source=texts, doc_path=source_from, chunk_size=max_length, overlap=overlap, merge=True)
+                    texts = text_chunker.iter_chunks(texts, max_tokens=model.CHUNK_TOKENS, overlap_tokens=overlap, count_tokens=model.count_tokens, doc_path=source_from)
                     result, dup_chunks = webui_manager.insert(type=_type, type_desc=_desc, file_full_path=source_from, file_creation_time=file_time_creation, file_desc=file_desc, chunks=texts, check_duplicate=check_duplicate, threshold=threshold)
                     if len(dup_chunks)>0: # duplicated
                         dups.append(dup_chunks[0][1]) #only source part. dup_chunks: [chunk, source, duplicate_file_id]